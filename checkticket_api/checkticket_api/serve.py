@@ -35,10 +35,13 @@ Author(s):
 """
 
 import os
+from falcon import HTTP_SERVICE_UNAVAILABLE
 from psycopg2.extras import DictConnection
 import hug
 import logging
 
+from intelmq_fody_backend import dbpool, metrics, rawjson
+
 # The intelmqmail module needs an UTF-8 locale, so we set a common one
 # available in Ubuntu 14.04/LTS here explicitely. This also removes the
 # necessity to configure the calling http server to set the locale correctly.
@@ -59,36 +62,55 @@ except ImportError as err:
 ENDPOINT_PREFIX = '/api/checkticket'
 ENDPOINT_NAME = 'Checkticket'
 
-# We are using global variables for postgresql db connection
-# TODO: should be checked that parallel requests via hug/falcon behave well
-# TODO: a cleanup and reopening may be better if we run this long time
+# Times the serialisation of the results, see metrics.py.
+hug.API(__name__).http.output_format = metrics.timed_output(
+    hug.output_format.json)
+
+# We are using a global pool of postgresql db connections,
+# each request borrows a connection from it.
+# The pool can be configured by a "connection pool" entry
+# in the intelmq-mailgen configuration.
 config = None
-conn = None
-cur = None
+checkticket_pool = None
 
 
 @hug.startup()
 def setup(api):
-    global config, conn, cur
+    global config, checkticket_pool
     config = cb.read_configuration()
 
-    conn = cb.open_db_connection(config, connection_factory=DictConnection)
-    cur = conn.cursor()
+    checkticket_pool = dbpool.get_pool(
+        "checkticket_api",
+        lambda: cb.open_db_connection(config,
+                                      connection_factory=DictConnection),
+        config.get("connection pool"))
+
+
+@hug.exception(dbpool.PoolTimeout)
+def handle_pool_timeout(exception, response):
+    log.warning(exception)
+    response.status = HTTP_SERVICE_UNAVAILABLE
+    return {"error": "The server is too busy, try again later."}
 
 
 @hug.cli()
 @hug.get(ENDPOINT_PREFIX + '/getEventIDsForTicket')
 def getEventIDsForTicket(ticket: hug.types.length(17, 18)):
-    global cur
     event_ids = []
-    try:
-        cur.execute("SELECT array_agg(d.events_id ORDER BY d.events_id) AS a"
+    with checkticket_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            with metrics.timer('db'):
+                cur.execute(
+                    "SELECT array_agg(d.events_id ORDER BY d.events_id)"
+                    "       AS a"
                     "   FROM directives AS d "
                     "   JOIN sent ON d.sent_id = sent.id "
                     "   WHERE sent.intelmq_ticket = %s;", (ticket,))
-        event_ids = cur.fetchone()["a"]
-    finally:
-        cur.connection.commit()  # end transaction
+            with metrics.timer('fetch'):
+                event_ids = cur.fetchone()["a"]
+        finally:
+            conn.commit()  # end transaction
 
     return event_ids
 
@@ -101,23 +123,22 @@ class ListOfIds(hug.types.Multiple):
         return [int(i) for i in value]
 
 
-@hug.cli()
 @hug.get(ENDPOINT_PREFIX + '/getEvents')
 def getEvents(ids: ListOfIds()):
-    global cur
-    events = []
-
-    try:
-        cur.execute("SELECT * FROM events WHERE id = ANY(%s)", (ids,))
-        rows = cur.fetchall()
-        for row in rows:
-            # remove None entries from the resulting dict
-            event = {k: v for k, v in row.items() if v is not None}
-            events.append(event)
-    finally:
-        cur.connection.commit()  # end transaction
-
-    return events
+    with checkticket_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            with metrics.timer('db'):
+                cur.execute(rawjson.select_rows(
+                    "SELECT * FROM events WHERE id = ANY(%s)"), (ids,))
+            with metrics.timer('fetch'):
+                rows = cur.fetchall()
+            metrics.add_rows(len(rows))
+        finally:
+            conn.commit()  # end transaction
+
+    # the events are passed on as PostgreSQL encoded them
+    return rawjson.stream(rawjson.array(row[rawjson.COLUMN] for row in rows))
 
 
 @hug.get(ENDPOINT_PREFIX + '/getEventsForTicket')
@@ -128,12 +149,14 @@ def getEventsForTicket(ticket: hug.types.length(17, 18), limit: int=None):
 
 @hug.get(ENDPOINT_PREFIX + '/getLastTicketNumber')
 def getLastTicketNumber():
-    global cur
     last_ticket_number = None
-    try:
-        last_ticket_number = db.last_ticket_number(cur)
-    finally:
-        cur.connection.commit()  # end transaction
+    with checkticket_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            with metrics.timer('db'):
+                last_ticket_number = db.last_ticket_number(cur)
+        finally:
+            conn.commit()  # end transaction
 
     return last_ticket_number
 
@@ -143,5 +166,4 @@ def main():
     setup(hug.API('cli'))
     getEventIDsForTicket.interface.cli()
 
-    cur.close()
-    conn.close()
+    checkticket_pool.closeall()
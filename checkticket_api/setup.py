@@ -14,6 +14,7 @@ setup(
 
     packages=find_packages(),
 
-    install_requires=['hug', 'psycopg2', 'intelmqmail'],
+    install_requires=['hug', 'psycopg2', 'intelmqmail',
+                      'intelmq-fody-backend'],
 
 )
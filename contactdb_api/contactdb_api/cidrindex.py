@@ -0,0 +1,214 @@
+"""Look up the organisations of networks in memory for /searchcidr.
+
+In the database `searchcidr` needs `address <<= %s OR address >> %s`,
+which often cannot use an index and scans all networks. A CidrIndex
+keeps the networks of the manual and the automatic tables with their
+organisation ids in memory instead:
+
+ * the networks contained in the searched one are a range of a list
+   sorted by the first address, found by bisection,
+ * the networks containing it are found with one dict lookup per
+   prefix length in use, at most 32 (128 for IPv6).
+
+A thread loads the tables at startup and checks every `refresh` seconds
+if the tables changed, using the counters of pg_stat_user_tables, so
+re-imports of the automatic tables and commits of other processes are
+noticed. A variant is only loaded again if its tables changed.
+After a commit of this process invalidate() loads the manual tables
+right away. Until both variants are loaded, search() returns None.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import bisect
+import ipaddress
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+# The table variants with the suffix of their tables.
+VARIANTS = (("manual", ""), ("auto", "_automatic"))
+
+DEFAULT_REFRESH = 60
+
+NETWORKS_SQL = """
+    SELECT n.address::text, otn.organisation{0}_id
+        FROM network{0} AS n
+        JOIN organisation_to_network{0} AS otn
+            ON n.network{0}_id = otn.network{0}_id
+    """
+
+# The tables a variant is loaded from. Their number of changed rows
+# tells if they have to be loaded again.
+CHANGES_SQL = """
+    SELECT relname, n_tup_ins + n_tup_upd + n_tup_del
+        FROM pg_stat_user_tables
+        WHERE relname = ANY(%s)
+    """
+
+
+def _tables(suffix: str) -> list:
+    return ["network" + suffix, "organisation_to_network" + suffix]
+
+
+class NetworkIndex:
+    """The networks of one table variant and their organisations."""
+
+    def __init__(self, rows):
+        """
+        Args:
+            rows: (address, organisation_id) tuples
+        """
+        networks = {}
+        for address, org_id in rows:
+            network = ipaddress.ip_network(address)
+            key = (network.version, int(network.network_address),
+                   network.prefixlen)
+            networks.setdefault(key, set()).add(org_id)
+
+        # per IP version: the sorted keys of the networks, the first
+        # addresses for bisection and the networks by prefix length
+        self._keys = {4: [], 6: []}
+        self._starts = {4: [], 6: []}
+        self._by_prefixlen = {4: {}, 6: {}}
+        for key in sorted(networks):
+            version, start, prefixlen = key
+            self._keys[version].append(key)
+            self._starts[version].append(start)
+            self._by_prefixlen[version].setdefault(prefixlen, {})[start] = \
+                networks[key]
+        self._networks = networks
+
+    def __len__(self) -> int:
+        return len(self._networks)
+
+    def organisation_ids(self, network) -> set:
+        """Returns the ids of the organisations of the networks
+        contained in or equal to `network` or containing it.
+
+        Args:
+            network: an ipaddress.IPv4Network or IPv6Network
+        """
+        version = network.version
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        org_ids = set()
+
+        # address <<= network
+        keys = self._keys[version]
+        starts = self._starts[version]
+        for index in range(bisect.bisect_left(starts, first),
+                           bisect.bisect_right(starts, last)):
+            if keys[index][2] >= network.prefixlen:
+                org_ids.update(self._networks[keys[index]])
+
+        # address >> network
+        max_prefixlen = network.max_prefixlen
+        for prefixlen, networks in self._by_prefixlen[version].items():
+            if prefixlen < network.prefixlen:
+                mask = ((1 << prefixlen) - 1) << (max_prefixlen - prefixlen)
+                org_ids.update(networks.get(first & mask, ()))
+        return org_ids
+
+
+class CidrIndex:
+    """The networks of both table variants, refreshed by a thread."""
+
+    def __init__(self, pool, refresh: float=DEFAULT_REFRESH):
+        """
+        Args:
+            pool: the dbpool.ConnectionPool of the contactdb
+            refresh: seconds between the checks for changed tables
+        """
+        self.pool = pool
+        self.refresh = refresh
+        self._indexes = {}
+        self._changes = {}
+        self._invalid = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the thread loading and refreshing the networks."""
+        self._thread = threading.Thread(target=self._run,
+                                        name="cidrindex", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.load()
+            except Exception:
+                log.exception("Loading the networks failed.")
+            self._wake.wait(self.refresh)
+            self._wake.clear()
+
+    def invalidate(self, variant: str="manual"):
+        """Loads the networks of the variant again soon."""
+        with self._lock:
+            self._invalid.add(variant)
+        self._wake.set()
+
+    def load(self):
+        """Loads the networks of the variants whose tables changed."""
+        with self._lock:
+            invalid, self._invalid = self._invalid, set()
+
+        with self.pool.transaction(readonly=True) as conn:
+            cur = conn.cursor()
+            cur.execute(CHANGES_SQL, (sum((_tables(suffix)
+                                           for _, suffix in VARIANTS), []),))
+            changes = dict(cur.fetchall())
+
+            for variant, suffix in VARIANTS:
+                counts = tuple(changes.get(table)
+                               for table in _tables(suffix))
+                if (variant not in invalid and variant in self._indexes
+                        and counts == self._changes.get(variant)):
+                    continue
+                start = time.monotonic()
+                cur.execute(NETWORKS_SQL.format(suffix))
+                index = NetworkIndex(cur.fetchall())
+                with self._lock:
+                    self._indexes[variant] = index
+                    self._changes[variant] = counts
+                log.info("Loaded %d %s networks in %.1f s.", len(index),
+                         variant, time.monotonic() - start)
+
+    def search(self, address: str):
+        """Returns the organisation ids like /searchcidr.
+
+        Returns:
+            Dict("manual":list, "auto":list) or None if the networks
+            are not loaded yet.
+
+        Raises:
+            ValueError: if the address is not a valid network or address.
+        """
+        # host bits may be set, like for inet
+        network = ipaddress.ip_network(address, strict=False)
+        with self._lock:
+            indexes = dict(self._indexes)
+        if len(indexes) < len(VARIANTS):
+            return None
+        return {variant: sorted(indexes[variant].organisation_ids(network))
+                for variant, _ in VARIANTS}
@@ -39,17 +39,23 @@ Design rationale:
     [1] https://github.com/Intevation/intelmq-mailgen/blob/master/extras/checkticket_api/serve.py # noqa
 
 """
+import concurrent.futures
+import ipaddress
 import json
 import logging
 import os
 import sys
 from typing import List, Tuple, Union
 
-from falcon import HTTP_BAD_REQUEST, HTTP_NOT_FOUND
+from falcon import HTTP_BAD_REQUEST, HTTP_INTERNAL_SERVER_ERROR, \
+    HTTP_NOT_FOUND, HTTP_SERVICE_UNAVAILABLE
 import hug
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+from intelmq_fody_backend import dbpool, jsonstream, metrics
+from . import cidrindex
+
 
 # FUTURE if we are reading to raise the requirements to psycopg2 v>=2.5
 # we could rely only on psycopg2's json support and simplify by removing
@@ -117,6 +123,7 @@ EXAMPLE_CONF_FILE = r"""
                    "erhalte-de"],
   "libpg conninfo":
     "host=localhost dbname=contactdb user=apiuser password='USER\\'s DB PASSWORD'",
+  "connection pool": {"minconn": 1, "maxconn": 8, "checkout_timeout": 30},
   "logging_level": "INFO"
 }
 """  # noqa
@@ -124,6 +131,29 @@ EXAMPLE_CONF_FILE = r"""
 ENDPOINT_PREFIX = '/api/contactdb'
 ENDPOINT_NAME = 'ContactDB'
 
+# Threads querying the automatic tables of the searches in parallel,
+# set in setup() if "parallel search" is configured.
+SEARCH_EXECUTOR = None
+
+# The networks for /searchcidr in memory, see cidrindex.py.
+# Set in setup() if "cidr index" is configured.
+CIDR_INDEX = None
+
+# Maximal number of organisations of one request to /org/details,
+# can be set with "max org details" in the configuration.
+MAX_ORG_DETAILS = 100
+
+# Number of inputs of /resolve looked up with one statement.
+RESOLVE_BATCH_SIZE = 1000
+
+# Maximal number of inputs of one request to /resolve,
+# can be set with "max resolve inputs" in the configuration.
+MAX_RESOLVE_INPUTS = 100000
+
+# Times the serialisation of the results, see metrics.py.
+hug.API(__name__).http.output_format = metrics.timed_output(
+    hug.output_format.json)
+
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -136,15 +166,27 @@ class CommitError(Error):
     pass
 
 
-# Using a global object for the database connection
-# must be initialised once
+# Using a global pool of database connections, must be initialised once.
+# Each request borrows a connection with its first query and gives it
+# back with __commit_transaction() or __rollback_transaction().
+contactdb_pool = None
 contactdb_conn = None
 
 
-def open_db_connection(dsn: str):
-    global contactdb_conn
+def open_db_connection(dsn: str, settings: dict=None):
+    """Opens the pool of connections to the contactdb.
+
+    Parameters:
+        dsn: libpq connection string
+        settings: the "connection pool" section of the configuration
 
-    contactdb_conn = psycopg2.connect(dsn=dsn)
+    Returns:
+        dbpool.ThreadConnection: giving each thread its own connection
+    """
+    global contactdb_pool, contactdb_conn
+
+    contactdb_pool = dbpool.pool_for_dsn(dsn, settings)
+    contactdb_conn = dbpool.ThreadConnection(contactdb_pool)
     return contactdb_conn
 
 
@@ -164,7 +206,7 @@ def _db_query(operation: str,
               parameters: Union[dict, list]=None) -> Tuple[list, list]:
     """Does an database query.
 
-    Creates a cursor from the global database connection, runs
+    Creates a cursor from the connection of the current request, runs
     the query or command the fetches all results.
 
     | By default, the first time a command is sent to the database [..]
@@ -177,6 +219,7 @@ def _db_query(operation: str,
 
     Thus each endpoint must make sure explicitely call __commit_transaction()
     or __rollback_transaction() when done with all db operations.
+    This also gives the connection back to the pool.
     In case of a command failure __rollback_transaction() must be called
     until new commands will be executed.
 
@@ -196,12 +239,15 @@ def _db_query(operation: str,
 
     # pscopgy2.4 does not offer 'with' for cursor()
     # FUTURE use with
-    cur = contactdb_conn.cursor(cursor_factory=RealDictCursor)
+    cur = contactdb_conn.get().cursor(cursor_factory=RealDictCursor)
 
-    cur.execute(operation, parameters)
+    with metrics.timer('db'):
+        cur.execute(operation, parameters)
     log.log(DD, "Ran query={}".format(repr(cur.query.decode('utf-8'))))
     description = cur.description
-    results = cur.fetchall()
+    with metrics.timer('fetch'):
+        results = cur.fetchall()
+    metrics.add_rows(len(results))
 
     cur.close()
 
@@ -211,7 +257,8 @@ def _db_query(operation: str,
 def _db_manipulate(operation: str, parameters=None) -> int:
     """Manipulates the database.
 
-    Creates a cursor from the global database connection, runs the command.
+    Creates a cursor from the connection of the current request,
+    runs the command.
     Has the same requirements regarding transactions as _db_query().
 
     Parameters:
@@ -227,8 +274,9 @@ def _db_manipulate(operation: str, parameters=None) -> int:
 
     # pscopgy2.4 does not offer 'with' for cursor()
     # FUTURE use with
-    cur = contactdb_conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute(operation, parameters)
+    cur = contactdb_conn.get().cursor(cursor_factory=RealDictCursor)
+    with metrics.timer('db'):
+        cur.execute(operation, parameters)
     log.log(DD, "Ran query={}".format(cur.query.decode('utf-8')))
 
     return cur.rowcount
@@ -237,6 +285,14 @@ def _db_manipulate(operation: str, parameters=None) -> int:
 def __db_query_organisation_ids(operation_str: str,  parameters=None):
     """Inquires organisation_ids for a specific query.
 
+    Both table variants are queried with one statement, combined with
+    UNION ALL. If SEARCH_EXECUTOR is set and a second connection of the
+    pool is available right away, the automatic tables are queried
+    in parallel on it instead. Then the two table variants are read in
+    separate transactions on separate connections, so they may see
+    different snapshots of the database. The request never waits for
+    a second connection while holding one, which could exhaust the pool.
+
     Parameters:
         operation(str): must be a psycopg2 execute operation string that
             only returns an array of ids "AS organisation_ids" or nothing
@@ -246,24 +302,67 @@ def __db_query_organisation_ids(operation_str: str,  parameters=None):
         Dict("auto":list, "manual":list): lists of organisation_ids that
             where manually entered or imported automatically
     """
-    orgs = {}
-
-    description, results = _db_query(operation_str.format(""), parameters)
-    if len(results) == 1 and results[0]["organisation_ids"] is not None:
-        orgs["manual"] = results[0]["organisation_ids"]
-    else:
-        orgs["manual"] = []
-
-    description, results = _db_query(operation_str.format("_automatic"),
-                                     parameters)
-    if len(results) == 1 and results[0]["organisation_ids"] is not None:
-        orgs["auto"] = results[0]["organisation_ids"]
+    orgs = {"manual": [], "auto": []}
+
+    auto_conn = None
+    if SEARCH_EXECUTOR is not None:
+        auto_conn = contactdb_pool.getconn(wait=False)
+
+    if auto_conn is not None:
+        auto = SEARCH_EXECUTOR.submit(
+            __db_query_organisation_ids_in_thread, auto_conn,
+            operation_str.format("_automatic"), parameters, metrics.current())
+        try:
+            description, results = _db_query(operation_str.format(""),
+                                             parameters)
+        finally:
+            # the thread gives back its connection in any case,
+            # an error of the manual query is raised instead of its own
+            concurrent.futures.wait([auto])
+        auto_results = auto.result()
+        results = [dict(row, source="manual") for row in results] \
+            + [dict(row, source="auto") for row in auto_results]
     else:
-        orgs["auto"] = []
+        if parameters is not None and not isinstance(parameters, dict):
+            # the placeholders of both variants
+            parameters = tuple(parameters) * 2
+        description, results = _db_query("""
+            SELECT 'manual' AS source, organisation_ids FROM ({0}) AS manual
+            UNION ALL
+            SELECT 'auto' AS source, organisation_ids FROM ({1}) AS auto
+            """.format(operation_str.format(""),
+                       operation_str.format("_automatic")), parameters)
+
+    for row in results:
+        if row["organisation_ids"] is not None:
+            orgs[row["source"]] = row["organisation_ids"]
 
     return orgs
 
 
+def __db_query_organisation_ids_in_thread(conn, operation: str, parameters,
+                                          stats: metrics.RequestStats):
+    """Runs a query in a thread of SEARCH_EXECUTOR.
+
+    The connection was borrowed for the thread, which ends the transaction
+    and gives it back to the pool.
+    """
+    with metrics.use(stats):
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            with metrics.timer('db'):
+                cur.execute(operation, parameters)
+            with metrics.timer('fetch'):
+                results = cur.fetchall()
+            metrics.add_rows(len(results))
+            cur.close()
+            conn.commit()
+        finally:
+            # rolls back an unfinished transaction
+            contactdb_pool.putconn(conn)
+    return results
+
+
 def __db_query_org(org_id: int, table_variant: str) -> dict:
     """Returns details for an organisation.
 
@@ -273,114 +372,131 @@ def __db_query_org(org_id: int, table_variant: str) -> dict:
 
     Returns:
         containing the organisation and additional keys
-            'annotations', 'asns' (with 'annotations') and 'contacts'
+            'annotations', 'asns' (with 'annotations') and 'contacts',
+            empty if there is no such organisation
     """
+    return __db_query_orgs([org_id], table_variant).get(org_id, {})
 
-    operation_str = """
-        SELECT * FROM organisation{0} WHERE organisation{0}_id = %s
-        """.format(table_variant)
 
-    description, results = _db_query(operation_str, (org_id,))
+def __db_query_orgs(org_ids: List[int], table_variant: str) -> dict:
+    """Returns details for several organisations.
 
-    if not len(results) == 1:
-            return {}
-    else:
-        org = results[0]
-        if table_variant != '':  # keep plain id name for all table variants
-            org["organisation_id"] = org.pop(
-                    "organisation{0}_id".format(table_variant)
-                    )
+    The organisations and all linked entries are queried with one statement,
+    PostgreSQL aggregates the lists with json_agg(). So the number of
+    round trips does not grow with the number of organisations, networks
+    or fqdns.
 
-        # insert asns.
-        # HINT: we are not using __db_query_asn() because we don't know the
-        #   asns yet, so we'll have to do another query anyway and using
-        #   the function to encapsulate adding of the annotations would make
-        #   the code here less elegant.
-        operation_str = """
-            SELECT * FROM organisation_to_asn{0}
-                WHERE organisation{0}_id = %s
-                ORDER BY asn
-            """.format(table_variant)
+    Parameters:
+        org_ids: the organisation ids to be queried
+        table_variant: either "" or "_automatic"
 
-        description, results = _db_query(operation_str, (org_id,))
-        org["asns"] = results
+    Returns:
+        Dict(int, dict): the details like __db_query_org() by the ids
+            of the organisations found
+    """
+    def annotations(table, column_name, column_sql):
+        # they can only be there for manual tables
+        if table_variant != '':
+            return ""
+        return __annotations_column(table, column_name, column_sql)
 
-        # insert contacts
-        operation_str = """
-            SELECT * FROM contact{0}
-                WHERE organisation{0}_id = %s
-                ORDER BY lower(email)
-            """.format(table_variant)
+    # According to the postgresql 9.5:
+    #   "IPv4 addresses will always sort before IPv6 addresses"
+    operation_str = """
+        SELECT o.*{org_annotations},
+               asns.asns, contacts.contacts, national_certs.national_certs,
+               networks.networks, fqdns.fqdns
+            FROM organisation{0} AS o
+            CROSS JOIN LATERAL (
+                SELECT coalesce(json_agg(a ORDER BY a.asn), '[]') AS asns
+                    FROM (SELECT ota.*{asn_annotations}
+                              FROM organisation_to_asn{0} AS ota
+                              WHERE ota.organisation{0}_id
+                                  = o.organisation{0}_id) AS a
+                ) AS asns
+            CROSS JOIN LATERAL (
+                SELECT coalesce(json_agg(c ORDER BY lower(c.email)), '[]')
+                        AS contacts
+                    FROM contact{0} AS c
+                    WHERE c.organisation{0}_id = o.organisation{0}_id
+                ) AS contacts
+            CROSS JOIN LATERAL (
+                SELECT coalesce(json_agg(nc ORDER BY lower(nc.country_code)),
+                                '[]') AS national_certs
+                    FROM national_cert{0} AS nc
+                    WHERE nc.organisation{0}_id = o.organisation{0}_id
+                ) AS national_certs
+            CROSS JOIN LATERAL (
+                SELECT coalesce(json_agg(nw ORDER BY nw.address), '[]')
+                        AS networks
+                    FROM (SELECT n.network{0}_id AS network_id,
+                                 n.address, n.comment{network_annotations}
+                              FROM network{0} AS n
+                              JOIN organisation_to_network{0} AS otn
+                                  ON n.network{0}_id = otn.network{0}_id
+                              WHERE otn.organisation{0}_id
+                                  = o.organisation{0}_id) AS nw
+                ) AS networks
+            CROSS JOIN LATERAL (
+                SELECT coalesce(json_agg(fq ORDER BY lower(fq.fqdn)), '[]')
+                        AS fqdns
+                    FROM (SELECT f.fqdn{0}_id AS fqdn_id,
+                                 f.fqdn, f.comment{fqdn_annotations}
+                              FROM fqdn{0} AS f
+                              JOIN organisation_to_fqdn{0} AS of
+                                  ON f.fqdn{0}_id = of.fqdn{0}_id
+                              WHERE of.organisation{0}_id
+                                  = o.organisation{0}_id) AS fq
+                ) AS fqdns
+            WHERE o.organisation{0}_id = ANY(%s)
+        """.format(
+            table_variant,
+            org_annotations=annotations("organisation", "organisation_id",
+                                        "o.organisation_id"),
+            asn_annotations=annotations("autonomous_system", "asn",
+                                        "ota.asn"),
+            network_annotations=annotations("network", "network_id",
+                                            "n.network_id"),
+            fqdn_annotations=annotations("fqdn", "fqdn_id", "f.fqdn_id"))
+
+    description, results = _db_query(operation_str, (list(org_ids),))
 
-        description, results = _db_query(operation_str, (org_id,))
-        org["contacts"] = results
+    orgs = {}
+    for org in results:
+        if table_variant != '':  # keep plain id name for all table variants
+            org["organisation_id"] = org.pop(
+                    "organisation{0}_id".format(table_variant)
+                    )
 
-        # insert national certs
-        operation_str = """
-            SELECT * FROM national_cert{0}
-                WHERE organisation{0}_id = %s
-                ORDER BY lower(country_code)
-            """.format(table_variant)
-
-        description, results = _db_query(operation_str, (org_id,))
-        org["national_certs"] = results
-
-        # insert networks
-        # we need the `network_id`s to query annotations.
-        # According to the postgresql 9.5:
-        #   "IPv4 addresses will always sort before IPv6 addresses"
-        operation_str = """
-            SELECT n.network{0}_id AS network_id, address, comment
-                FROM network{0} AS n
-                JOIN organisation_to_network{0} AS otn
-                    ON n.network{0}_id = otn.network{0}_id
-                WHERE otn.organisation{0}_id = %s
-                ORDER BY n.address
-            """.format(table_variant)
+        for key in ["asns", "contacts", "national_certs", "networks",
+                    "fqdns", "annotations"]:
+            if key in org:
+                org[key] = to_Json(org[key])
 
-        description, results = _db_query(operation_str, (org_id,))
-        org["networks"] = results
+        orgs[org["organisation_id"]] = org
 
-        # insert fqdns
-        # we need the `fqdn_id`s to query annotations.
-        operation_str = """
-            SELECT f.fqdn{0}_id AS fqdn_id, fqdn, comment
-                FROM fqdn{0} AS f
-                JOIN organisation_to_fqdn{0} AS of
-                    ON f.fqdn{0}_id = of.fqdn{0}_id
-                WHERE of.organisation{0}_id = %s
-                ORDER BY lower(fqdn)
-            """.format(table_variant)
-
-        description, results = _db_query(operation_str, (org_id,))
-        org["fqdns"] = results
-
-        # add existing annotations to the result
-        # they can only be there for manual tables
-        if table_variant == '':
-            # insert annotations for the org
-            org["annotations"] = __db_query_annotations(
-                    "organisation", "organisation_id", org_id)
+    return orgs
 
-            # query annotations for each asn
-            for index, asn in enumerate(org["asns"][:]):
-                org["asns"][index]["annotations"] = \
-                    __db_query_annotations("autonomous_system", "asn",
-                                           asn["asn"])
 
-            # query annotations for each network
-            for index, network in enumerate(org["networks"][:]):
-                org["networks"][index]["annotations"] = \
-                    __db_query_annotations("network", "network_id",
-                                           network["network_id"])
+def __annotations_column(table: str, column_name: str,
+                         column_sql: str) -> str:
+    """Returns SQL selecting the annotations of a row as extra column.
 
-            # query annotations for each fqdn
-            for index, fqdn in enumerate(org["fqdns"][:]):
-                org["fqdns"][index]["annotations"] = \
-                    __db_query_annotations("fqdn", "fqdn_id",
-                                           fqdn["fqdn_id"])
+    Parameters:
+        table: the table name to which `_annotation` is added
+        column_name: which has to match for the WHERE clause
+        column_sql: the value to match, e.g. a column of the outer query
 
-        return org
+    Returns:
+        a column `annotations` to add to a select list, with all
+        annotations, even if one occurs several times
+    """
+    return """,
+        (SELECT coalesce(json_agg(annotation ORDER BY annotation->>'tag'),
+                         '[]')
+            FROM {0}_annotation
+            WHERE {1} = {2}) AS annotations""".format(
+                table, column_name, column_sql)
 
 
 def __db_query_annotations(table: str, column_name: str,
@@ -831,12 +947,31 @@ def _delete_org(org) -> int:
 
 @hug.startup()
 def setup(api):
-    global config
+    global config, MAX_ORG_DETAILS, MAX_RESOLVE_INPUTS, SEARCH_EXECUTOR, \
+        CIDR_INDEX
     config = read_configuration()
     if "logging_level" in config:
         log.setLevel(config["logging_level"])
-    open_db_connection(config["libpg conninfo"])
-    log.debug("Initialised DB connection for contactdb_api.")
+    MAX_ORG_DETAILS = config.get("max org details", MAX_ORG_DETAILS)
+    MAX_RESOLVE_INPUTS = config.get("max resolve inputs", MAX_RESOLVE_INPUTS)
+    workers = config.get("parallel search", {}).get("workers", 1)
+    if workers > 1:
+        SEARCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+    open_db_connection(config["libpg conninfo"], config.get("connection pool"))
+    log.debug("Initialised DB connection pool for contactdb_api.")
+    if "cidr index" in config:
+        CIDR_INDEX = cidrindex.CidrIndex(
+            contactdb_pool,
+            config["cidr index"].get("refresh", cidrindex.DEFAULT_REFRESH))
+        CIDR_INDEX.start()
+
+
+@hug.exception(dbpool.PoolTimeout)
+def handle_pool_timeout(exception, response):
+    log.warning(exception)
+    response.status = HTTP_SERVICE_UNAVAILABLE
+    return {"reason": "The server is too busy, try again later."}
 
 
 @hug.get(ENDPOINT_PREFIX + '/ping')
@@ -934,6 +1069,15 @@ def searchcidr(address: str, response):
     Strips leading and trailing whitespace.
     """
     address = address.strip()
+    if CIDR_INDEX is not None:
+        try:
+            query_results = CIDR_INDEX.search(address)
+        except ValueError:
+            # PostgreSQL may still accept it, e.g. "10/8", or tell why not
+            query_results = None
+        if query_results is not None:
+            return query_results
+
     try:
         # postgresql 9.3/docs/9.12:
         #   '<<=   is contained within or equals'
@@ -1089,6 +1233,51 @@ def get_auto_org_details(id: int):
     return query_results
 
 
+class ListOfIds(hug.types.Multiple):
+    """Only accept a list of numbers, also separated by commas."""
+
+    def __call__(self, value):
+        value = super().__call__(value)
+        return [int(i) for item in value for i in str(item).split(',')
+                if i.strip()]
+
+
+@hug.get(ENDPOINT_PREFIX + '/org/details')
+@hug.post(ENDPOINT_PREFIX + '/org/details')
+def get_org_details(response, manual: ListOfIds()=None,
+                    auto: ListOfIds()=None):
+    """Return the details of several manual and automatic organisations.
+
+    Takes the ids as returned by the search endpoints, e.g.
+    `?manual=1,2&auto=3` or as POST body `{"manual": [1, 2], "auto": [3]}`,
+    at most MAX_ORG_DETAILS altogether.
+
+    Returns:
+        Dict("manual":list, "auto":list): the details like
+            /org/manual/{id} and /org/auto/{id} in the order of the ids,
+            ids of organisations which do not exist are left out
+    """
+    manual = manual or []
+    auto = auto or []
+    if len(manual) + len(auto) > MAX_ORG_DETAILS:
+        response.status = HTTP_BAD_REQUEST
+        return {"reason": "At most {} organisations can be requested at once."
+                          "".format(MAX_ORG_DETAILS)}
+
+    result = {}
+    try:
+        for key, ids, table_variant in [("manual", manual, ""),
+                                        ("auto", auto, "_automatic")]:
+            orgs = __db_query_orgs(ids, table_variant) if ids else {}
+            result[key] = [orgs[org_id] for org_id in ids if org_id in orgs]
+    except psycopg2.DatabaseError:
+        __rollback_transaction()
+        raise
+    finally:
+        __commit_transaction()
+    return result
+
+
 @hug.get(ENDPOINT_PREFIX + '/asn/manual/{number}')
 def get_manual_asn_details(number: int, response):
     try:
@@ -1177,12 +1366,200 @@ def commit_pending_org_changes(body, request, response):
         return {"reason": "Commit failed, see server logs."}
     else:
         __commit_transaction()
+        if CIDR_INDEX is not None:
+            CIDR_INDEX.invalidate("manual")
 
     log.info("Commit successful, results = {}; "
              "remote_user = {}".format(results, remote_user))
     return results
 
 
+# The statements finding the organisations of a list of inputs per type,
+# with the same conditions as searchcidr, searchasn and searchfqdn.
+# They return the position of the input in the list as `ord`.
+# The networks are found with a branch per operator, as the index
+# on the addresses cannot serve a join on both of them with OR.
+RESOLVE_SQL = {
+    "ip": """
+        SELECT 'ip' AS type, '{1}' AS source, i.ord,
+               array_agg(DISTINCT otn.organisation{0}_id) AS organisation_ids
+            FROM unnest(%s::inet[]) WITH ORDINALITY AS i(value, ord)
+            CROSS JOIN LATERAL (
+                SELECT network{0}_id FROM network{0}
+                    WHERE address <<= i.value
+                UNION ALL
+                SELECT network{0}_id FROM network{0}
+                    WHERE address >> i.value) AS n
+            JOIN organisation_to_network{0} AS otn
+                ON n.network{0}_id = otn.network{0}_id
+            GROUP BY i.ord
+        """,
+    "asn": """
+        SELECT 'asn' AS type, '{1}' AS source, a.ord,
+               array_agg(DISTINCT ota.organisation{0}_id) AS organisation_ids
+            FROM unnest(%s::bigint[]) WITH ORDINALITY AS a(value, ord)
+            JOIN organisation_to_asn{0} AS ota ON ota.asn = a.value
+            GROUP BY a.ord
+        """,
+    "fqdn": """
+        SELECT 'fqdn' AS type, '{1}' AS source, d.ord,
+               array_agg(DISTINCT otf.organisation{0}_id) AS organisation_ids
+            FROM unnest(%s::text[]) WITH ORDINALITY AS d(value, ord)
+            JOIN fqdn{0} AS f
+                ON f.fqdn ILIKE d.value OR f.fqdn ILIKE '%%.' || d.value
+            JOIN organisation_to_fqdn{0} AS otf
+                ON f.fqdn{0}_id = otf.fqdn{0}_id
+            GROUP BY d.ord
+        """,
+}
+
+
+def _resolve_items(body) -> list:
+    """Returns the inputs of a /resolve request as (type, value) tuples.
+
+    Raises:
+        ValueError: if the body or one of the values is not valid.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Needs an object with the lists"
+                         " `ips`, `asns` and `fqdns`.")
+    items = []
+    for key, type_ in [("ips", "ip"), ("asns", "asn"), ("fqdns", "fqdn")]:
+        values = body.get(key) or []
+        if not isinstance(values, list):
+            raise ValueError("`{}` must be a list.".format(key))
+        if len(items) + len(values) > MAX_RESOLVE_INPUTS:
+            raise ValueError("At most {} inputs can be resolved at once."
+                             "".format(MAX_RESOLVE_INPUTS))
+        for value in values:
+            if type_ == "asn":
+                if isinstance(value, bool) or not isinstance(value,
+                                                             (int, str)):
+                    raise ValueError("Not an asn: {!r}".format(value))
+                value = int(value)
+            else:
+                if not isinstance(value, str):
+                    raise ValueError("Not a string: {!r}".format(value))
+                value = value.strip()
+                if type_ == "ip":
+                    # host bits may be set, like for inet
+                    ipaddress.ip_network(value, strict=False)
+            items.append((type_, value))
+    return items
+
+
+def __db_resolve(items: list) -> list:
+    """Finds the organisations of the inputs with one statement.
+
+    IPs are looked up in CIDR_INDEX if it is loaded.
+    Has the same requirements regarding transactions as _db_query().
+
+    Parameters:
+        items: (type, value) tuples as returned by _resolve_items()
+
+    Returns:
+        a dict per input with the `type`, the `value` and the lists
+            of organisation ids `manual` and `auto`
+    """
+    results = [{"type": type_, "value": value, "manual": [], "auto": []}
+               for type_, value in items]
+
+    # the positions of the inputs to query per type
+    positions = {type_: [] for type_ in RESOLVE_SQL}
+    for index, (type_, value) in enumerate(items):
+        if type_ == "ip" and CIDR_INDEX is not None:
+            found = CIDR_INDEX.search(value)
+            if found is not None:
+                results[index].update(found)
+                continue
+        positions[type_].append(index)
+
+    statements = []
+    parameters = []
+    for type_, indexes in positions.items():
+        if not indexes:
+            continue
+        for source, table_variant in [("manual", ""), ("auto", "_automatic")]:
+            statements.append(RESOLVE_SQL[type_].format(table_variant,
+                                                        source))
+            parameters.append([items[index][1] for index in indexes])
+    if not statements:
+        return results
+
+    description, rows = _db_query("UNION ALL".join(statements), parameters)
+
+    for row in rows:
+        index = positions[row["type"]][row["ord"] - 1]
+        results[index][row["source"]] = row["organisation_ids"]
+    return results
+
+
+def __db_resolve_batches(items: list):
+    """Yields the results of __db_resolve() per RESOLVE_BATCH_SIZE inputs.
+
+    Each batch is a transaction of its own, so the connection is only
+    borrowed while it is queried and not while the client reads.
+    An error of the first batch is raised. After an error of a later
+    batch, when the response has already started, a last batch with
+    only an `error` entry is yielded.
+    """
+    for start in range(0, len(items), RESOLVE_BATCH_SIZE):
+        try:
+            results = __db_resolve(items[start:start + RESOLVE_BATCH_SIZE])
+        except (psycopg2.Error, dbpool.PoolTimeout):
+            __rollback_transaction()
+            if start == 0:
+                raise
+            log.exception("Resolving the inputs from %d on failed.", start)
+            yield [{"error": "Resolving the remaining inputs failed,"
+                             " see server logs."}]
+            return
+        else:
+            __commit_transaction()
+        yield results
+
+
+@hug.post(ENDPOINT_PREFIX + '/resolve')
+def resolve(body, response,
+            format: hug.types.one_of(tuple(jsonstream.FORMATTERS))='json'):
+    """Find the organisations of many IPs, ASNs and FQDNs at once.
+
+    Takes a body like `{"ips": [...], "asns": [...], "fqdns": [...]}`,
+    at most MAX_RESOLVE_INPUTS altogether. The inputs are matched
+    like in searchcidr, searchasn and searchfqdn. They are looked up
+    RESOLVE_BATCH_SIZE at a time and the results are streamed,
+    as JSON array or with `format=ndjson` one per line.
+
+    Returns:
+        for each input a dict with the `type` ("ip", "asn" or "fqdn"),
+            the `value` and the lists of organisation ids `manual` and `auto`,
+            if a later batch failed a last entry with the `error`
+    """
+    try:
+        items = _resolve_items(body)
+    except ValueError as err:
+        response.status = HTTP_BAD_REQUEST
+        return {"reason": str(err)}
+
+    # run the first batch to be able to report errors
+    # before the streaming response has started
+    batches = __db_resolve_batches(items)
+    try:
+        first_batch = next(batches, [])
+    except psycopg2.DataError:
+        log.info("resolve failed with DataError", exc_info=True)
+        response.status = HTTP_BAD_REQUEST
+        return {"reason": "DataError, probably an invalid input."}
+    except psycopg2.Error:
+        log.exception("resolve failed")
+        response.status = HTTP_INTERNAL_SERVER_ERROR
+        return {"reason": "The query could not be processed."}
+
+    response.content_type = jsonstream.CONTENT_TYPES[format]
+    return jsonstream.ChunkStream(
+        jsonstream.FORMATTERS[format](first_batch, batches))
+
+
 @hug.get(ENDPOINT_PREFIX + '/email/{email}')
 def get_email_details(email: str):
     """Lookup status of an email address.
@@ -1256,7 +1633,9 @@ def main():
     print("log effective level = \"{}\"".format(
         logging.getLevelName(log.getEffectiveLevel())))
 
-    cur = open_db_connection(config["libpg conninfo"]).cursor()
+    conn = open_db_connection(config["libpg conninfo"],
+                              config.get("connection pool")).get()
+    cur = conn.cursor()
 
     for count in [
             "organisation_automatic",
@@ -1276,4 +1655,4 @@ def main():
         result = cur.fetchone()
         print("count_{} = {}".format(count, result[0]))
 
-    cur.connection.commit()  # end transaction
+    __commit_transaction()  # end transaction
@@ -14,6 +14,7 @@ setup(
 
     packages=find_packages(),
 
-    install_requires=['hug', 'psycopg2', 'typing'],
+    install_requires=['hug', 'psycopg2', 'typing',
+                      'intelmq-fody-backend'],
 
 )
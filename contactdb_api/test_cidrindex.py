@@ -0,0 +1,65 @@
+"""Tests for the in-memory index of the networks.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import ipaddress
+import unittest
+
+from contactdb_api import cidrindex
+
+NETWORKS = [
+    ("10.0.0.0/8", 1),
+    ("10.1.0.0/16", 2),
+    ("10.1.2.0/24", 3),
+    ("10.1.2.0/24", 4),
+    ("192.0.2.0/24", 5),
+    ("2001:db8::/32", 6),
+    ("2001:db8:1::/48", 7),
+]
+
+
+def search(index, address):
+    return index.organisation_ids(ipaddress.ip_network(address))
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.index = cidrindex.NetworkIndex(NETWORKS)
+
+    def test_address(self):
+        # only containing networks
+        self.assertEqual(search(self.index, "10.1.2.3"), {1, 2, 3, 4})
+        self.assertEqual(search(self.index, "10.2.0.1"), {1})
+        self.assertEqual(search(self.index, "172.16.0.1"), set())
+
+    def test_network(self):
+        # equal, contained and containing networks
+        self.assertEqual(search(self.index, "10.1.0.0/16"), {1, 2, 3, 4})
+        self.assertEqual(search(self.index, "192.0.0.0/8"), {5})
+        self.assertEqual(search(self.index, "0.0.0.0/0"), {1, 2, 3, 4, 5})
+
+    def test_ipv6(self):
+        self.assertEqual(search(self.index, "2001:db8:1::1"), {6, 7})
+        self.assertEqual(search(self.index, "2001:db8::/32"), {6, 7})
+        self.assertEqual(search(self.index, "2001:db9::/32"), set())
+
+    def test_not_loaded(self):
+        index = cidrindex.CidrIndex(pool=None)
+        self.assertIsNone(index.search("10.0.0.1"))
+        self.assertIsNone(index.search("10.0.0.1/8"))
+        with self.assertRaises(ValueError):
+            index.search("10.0.0.300")
@@ -22,12 +22,46 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 Author(s):
     Bernhard E. Reiter <bernhard@intevation.de>
 """
+import concurrent.futures
 import json
 import os
 import tempfile
 import unittest
 
+import psycopg2.extensions
+
 from contactdb_api import serve
+from intelmq_fody_backend import dbpool
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, operation, parameters=None):
+        self.connection.statements.append((operation, parameters))
+
+    def fetchall(self):
+        return [{"organisation_ids": [3]}]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    closed = False
+
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
 
 
 class Tests(unittest.TestCase):
@@ -58,3 +92,148 @@ class Tests(unittest.TestCase):
         os.environ["CONTACTDB_SERVE_CONF_FILE"] = self.conf_file_name
 
         self.assertIsInstance(serve.read_configuration(), dict)
+
+    def test_query_org_one_statement(self):
+        statements = []
+
+        def db_query(operation, parameters=None):
+            statements.append(operation)
+            return None, [{"organisation_automatic_id": 7, "name": "ISP",
+                           "asns": [{"asn": 64496}], "contacts": [],
+                           "national_certs": [], "networks": [],
+                           "fqdns": []}]
+
+        original, serve._db_query = serve._db_query, db_query
+        try:
+            org = getattr(serve, "__db_query_org")(7, "_automatic")
+        finally:
+            serve._db_query = original
+
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("_annotation", statements[0])
+        self.assertEqual(org["organisation_id"], 7)
+        self.assertEqual(org["asns"], [{"asn": 64496}])
+
+    def test_list_of_ids(self):
+        self.assertEqual(serve.ListOfIds()("1,2"), [1, 2])
+        self.assertEqual(serve.ListOfIds()([3, "4"]), [3, 4])
+        with self.assertRaises(ValueError):
+            serve.ListOfIds()("1,x")
+
+    def test_query_organisation_ids_union(self):
+        statements = []
+
+        def db_query(operation, parameters=None):
+            statements.append((operation, parameters))
+            return None, [{"source": "manual", "organisation_ids": [1, 2]},
+                          {"source": "auto", "organisation_ids": None}]
+
+        original, serve._db_query = serve._db_query, db_query
+        try:
+            orgs = getattr(serve, "__db_query_organisation_ids")(
+                "SELECT array_agg(organisation{0}_id) AS organisation_ids"
+                " FROM organisation_to_asn{0} WHERE asn=%s", (64496,))
+        finally:
+            serve._db_query = original
+
+        self.assertEqual(orgs, {"manual": [1, 2], "auto": []})
+        self.assertEqual(len(statements), 1)
+        self.assertIn("FROM organisation_to_asn_automatic",
+                      statements[0][0])
+        self.assertEqual(statements[0][1], (64496, 64496))
+
+    def test_query_organisation_ids_parallel(self):
+        statements = []
+
+        def db_query(operation, parameters=None):
+            statements.append((operation, parameters))
+            if "UNION ALL" in operation:
+                return None, [{"source": "manual", "organisation_ids": [1]}]
+            return None, [{"organisation_ids": [1]}]
+
+        operation = ("SELECT array_agg(organisation{0}_id)"
+                     " AS organisation_ids"
+                     " FROM organisation_to_asn{0} WHERE asn=%s")
+        auto_conn = FakeConnection()
+        pool = dbpool.ConnectionPool(lambda: auto_conn, minconn=0,
+                                     maxconn=1, validate=False)
+        original = (serve._db_query, serve.contactdb_pool,
+                    serve.SEARCH_EXECUTOR)
+        serve._db_query = db_query
+        serve.contactdb_pool = pool
+        serve.SEARCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            # a free connection: the automatic tables are queried on it
+            orgs = getattr(serve, "__db_query_organisation_ids")(
+                operation, (64496,))
+            self.assertEqual(orgs, {"manual": [1], "auto": [3]})
+            self.assertEqual(len(statements), 1)
+            self.assertIn("organisation_to_asn_automatic",
+                          auto_conn.statements[0][0])
+            self.assertEqual(pool.idle, 1)
+
+            # no free connection: one statement instead of waiting
+            held = pool.getconn()
+            orgs = getattr(serve, "__db_query_organisation_ids")(
+                operation, (64496,))
+            pool.putconn(held)
+            self.assertEqual(orgs, {"manual": [1], "auto": []})
+            self.assertEqual(statements[1][1], (64496, 64496))
+        finally:
+            serve.SEARCH_EXECUTOR.shutdown()
+            (serve._db_query, serve.contactdb_pool,
+             serve.SEARCH_EXECUTOR) = original
+
+    def test_query_organisation_ids_parallel_errors(self):
+        class FailingConnection(FakeConnection):
+            def cursor(self, cursor_factory=None):
+                raise psycopg2.OperationalError("auto failed")
+
+        def db_query(operation, parameters=None):
+            raise psycopg2.DataError("manual failed")
+
+        pool = dbpool.ConnectionPool(FailingConnection, minconn=0,
+                                     maxconn=1, validate=False)
+        original = (serve._db_query, serve.contactdb_pool,
+                    serve.SEARCH_EXECUTOR)
+        serve._db_query = db_query
+        serve.contactdb_pool = pool
+        serve.SEARCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            # the error of the manual query is the one raised
+            with self.assertRaisesRegex(psycopg2.DataError, "manual"):
+                getattr(serve, "__db_query_organisation_ids")(
+                    "SELECT array_agg(organisation{0}_id)"
+                    " AS organisation_ids FROM organisation_to_asn{0}"
+                    " WHERE asn=%s", (64496,))
+            self.assertEqual(pool.idle, 1)
+        finally:
+            serve.SEARCH_EXECUTOR.shutdown()
+            (serve._db_query, serve.contactdb_pool,
+             serve.SEARCH_EXECUTOR) = original
+
+    def test_resolve_items(self):
+        self.assertEqual(
+            serve._resolve_items({"ips": [" 192.0.2.1", "2001:db8::/32",
+                                          "192.0.2.1/24"],
+                                  "asns": [64496, "64497"],
+                                  "fqdns": ["example.com"]}),
+            [("ip", "192.0.2.1"), ("ip", "2001:db8::/32"),
+             ("ip", "192.0.2.1/24"),
+             ("asn", 64496), ("asn", 64497), ("fqdn", "example.com")])
+        for body in [None, {"ips": "192.0.2.1"}, {"ips": ["192.0.2.300"]},
+                     {"asns": ["AS64496"]}, {"fqdns": [1]}]:
+            with self.assertRaises(ValueError):
+                serve._resolve_items(body)
+
+    def test_resolve_items_limit(self):
+        original = serve.MAX_RESOLVE_INPUTS
+        serve.MAX_RESOLVE_INPUTS = 2
+        try:
+            self.assertEqual(len(serve._resolve_items(
+                {"ips": ["192.0.2.1"], "asns": [64496]})), 2)
+            with self.assertRaises(ValueError):
+                serve._resolve_items({"ips": ["192.0.2.1"],
+                                      "asns": [64496], "fqdns": ["a.example"]})
+        finally:
+            serve.MAX_RESOLVE_INPUTS = original
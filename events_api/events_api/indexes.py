@@ -0,0 +1,130 @@
+"""Indexes for the pattern subqueries of the events_api.
+
+The `_prefix` subqueries can use a btree index with text_pattern_ops,
+`_suffix`, `_contains` and `_icontains` (ILIKE) a trigram index of the
+pg_trgm extension.
+
+    python3 -m events_api.indexes | psql intelmq-events
+
+prints the CREATE INDEX CONCURRENTLY statements for the table
+configured as `database table`, or all tables of the `table tiers`,
+optionally only for the given columns.
+With `--tickets` also for the events table and the recipient address
+of the directives of intelmq-mailgen, used by the subqueries of the
+tickets_api.
+Creating the indexes needs a database user which may create them,
+each statement must run outside of a transaction block.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import re
+
+
+# The table and column of the directives with pattern subqueries
+# of the tickets_api.
+TICKETS_TABLE = 'directives'
+TICKETS_COLUMNS = ['recipient_address']
+
+# The table of the events joined by the tickets_api.
+TICKETS_EVENTS_TABLE = 'events'
+
+
+def index_name(table: str, column: str, kind: str) -> str:
+    """Returns the name of the index, e.g. events_feed_name_trgm_idx."""
+    return "{}_{}_{}_idx".format(re.sub(r'\W', '_', table),
+                                 re.sub(r'\W', '_', column), kind)
+
+
+def index_statements(table: str, columns,
+                     create_extension: bool=True) -> list:
+    """Returns the SQL statements to create the pattern indexes.
+
+    Args:
+        table: the name of the events table
+        columns: the names of the columns to index
+        create_extension: start with the statement creating pg_trgm
+
+    """
+    statements = []
+    if create_extension:
+        statements.append("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    for column in columns:
+        statements.append(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {}'
+            ' ("{}" text_pattern_ops);'.format(
+                index_name(table, column, 'pattern'), table, column))
+        statements.append(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {}'
+            ' USING gin ("{}" gin_trgm_ops);'.format(
+                index_name(table, column, 'trgm'), table, column))
+    return statements
+
+
+def events_tables(config: dict) -> list:
+    """Returns the tables with the events searched by the events_api.
+
+    Args:
+        config: the configuration of the events_api
+    """
+    if 'table tiers' in config:
+        return [tier['table'] for tier in config['table tiers']]
+    return [config.get("database table", "events")]
+
+
+def main():
+    from events_api import serve
+    columns = [column for _, column, _ in serve.QUERY_PATTERN_COLUMNS]
+
+    parser = argparse.ArgumentParser(
+        prog="python3 -m events_api.indexes",
+        description="Print the statements creating the indexes"
+                    " for the _prefix, _suffix, _contains and _icontains"
+                    " subqueries.")
+    parser.add_argument("columns", nargs="*", metavar="column",
+                        help="only for these columns"
+                             " (default: all of {})".format(
+                                 ", ".join(columns)))
+    parser.add_argument("--tickets", action="store_true",
+                        help="also for the columns of {} and {}.{}"
+                             " of the tickets api".format(
+                                 TICKETS_EVENTS_TABLE, TICKETS_TABLE,
+                                 ", ".join(TICKETS_COLUMNS)))
+    args = parser.parse_args()
+    for column in args.columns:
+        if column not in columns:
+            parser.error("no pattern subqueries for column " + column)
+
+    tables = events_tables(serve.read_configuration())
+    if args.tickets and TICKETS_EVENTS_TABLE not in tables:
+        tables.append(TICKETS_EVENTS_TABLE)
+
+    statements = ["CREATE EXTENSION IF NOT EXISTS pg_trgm;"]
+    for table in tables:
+        statements.extend(index_statements(table, args.columns or columns,
+                                           create_extension=False))
+    if args.tickets:
+        statements.extend(index_statements(TICKETS_TABLE, TICKETS_COLUMNS,
+                                           create_extension=False))
+    for statement in statements:
+        print(statement)
+
+
+if __name__ == '__main__':
+    main()
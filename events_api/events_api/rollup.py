@@ -0,0 +1,344 @@
+"""Hourly rollup of the events for the statistics of the events_api.
+
+The rollup table holds the number of events per hour and combination of
+the low cardinality columns in DIMENSIONS. It is refreshed incrementally
+from the last processed event id, e.g. by a cron job calling
+
+    python3 -m events_api.rollup
+
+Use `--create` once to create the tables (needs a database user
+which may create tables) and `--rebuild` after events have been deleted
+or modified.
+
+Statistics with only subqueries on these columns and time bounds
+on full hours are answered from the rollup table, together with the
+events inserted since the last refresh.
+
+The hours are truncated in the configured `time_zone`, which the
+events_api also uses for all its statistics if the rollup is
+configured. Otherwise the hours of a zone with an offset of e.g.
++05:30 would not match the ones of the rollup. Use `--rebuild`
+after changing it.
+
+With `table tiers` the rollup is built from the events of all tables,
+so events moved to an archive table keep being counted once.
+Events without `time.observation` are not counted.
+
+Caveat: an event is missed, if its id is lower than the last processed one
+when it is committed. This does not happen with a single inserting
+process like the postgresql output bot of IntelMQ.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import logging
+
+import psycopg2
+
+from . import tiers
+
+
+log = logging.getLogger(__name__)
+
+# Defaults for the "rollup" section of the configuration file.
+DEFAULT_SETTINGS = {
+    "table": "events_hourly",
+    "batch_size": 100000,
+    "time_zone": "UTC",
+}
+
+# The columns counted by the rollup table.
+DIMENSIONS = (
+    'classification.taxonomy',
+    'classification.type',
+    'classification.identifier',
+    'feed.provider',
+    'feed.name',
+    'malware.name',
+)
+
+# The subqueries only using columns of the rollup table.
+SUBQUERIES = frozenset((
+    'classification-taxonomy_is',
+    'classification-taxonomy_icontains',
+    'classification-taxonomy_in',
+    'classification-taxonomy_prefix',
+    'classification-taxonomy_suffix',
+    'classification-taxonomy_contains',
+    'classification-type_is',
+    'classification-type_icontains',
+    'classification-type_in',
+    'classification-type_prefix',
+    'classification-type_suffix',
+    'classification-type_contains',
+    'classification-identifier_is',
+    'classification-identifier_icontains',
+    'classification-identifier_in',
+    'classification-identifier_prefix',
+    'classification-identifier_suffix',
+    'classification-identifier_contains',
+    'feed-provider_is',
+    'feed-provider_icontains',
+    'feed-provider_in',
+    'feed-provider_prefix',
+    'feed-provider_suffix',
+    'feed-provider_contains',
+    'feed-name_is',
+    'feed-name_icontains',
+    'feed-name_in',
+    'feed-name_prefix',
+    'feed-name_suffix',
+    'feed-name_contains',
+    'malware-name_is',
+    'malware-name_icontains',
+    'malware-name_in',
+    'malware-name_prefix',
+    'malware-name_suffix',
+    'malware-name_contains',
+))
+
+TIME_AFTER = 'time-observation_after'
+TIME_BEFORE = 'time-observation_before'
+
+
+def _columns() -> str:
+    return ', '.join('"{}"'.format(column) for column in DIMENSIONS)
+
+
+def events_relation(config: dict) -> str:
+    """Returns the table or subquery with all events to count.
+
+    Args:
+        config: the configuration of the events_api
+    """
+    if 'table tiers' in config:
+        return tiers.Tiers(config['table tiers']).relation([])
+    return config.get("database table", "events")
+
+
+def create_statements(rollup_table: str) -> list:
+    """Returns the SQL statements to create the rollup tables."""
+    return [
+        """CREATE TABLE {rollup} (
+               "time.observation" TIMESTAMP WITH TIME ZONE NOT NULL,
+               {dimensions},
+               dimensions TEXT NOT NULL,
+               count BIGINT NOT NULL,
+               UNIQUE ("time.observation", dimensions)
+           )""".format(rollup=rollup_table, dimensions=',\n'.join(
+            '"{}" TEXT'.format(column) for column in DIMENSIONS)),
+        """CREATE TABLE {rollup}_state (
+               last_id BIGINT NOT NULL,
+               refreshed TIMESTAMP WITH TIME ZONE
+           )""".format(rollup=rollup_table),
+        "INSERT INTO {rollup}_state (last_id) VALUES (0)".format(
+            rollup=rollup_table),
+    ]
+
+
+def refresh(conn, events_table: str, rollup_table: str,
+            batch_size: int=100000, time_zone: str="UTC") -> int:
+    """Adds the events inserted since the last refresh to the rollup.
+
+    Each batch of event ids is added in its own transaction.
+
+    Args:
+        events_table: the table or subquery of the events,
+            see events_relation()
+        time_zone: the time zone the hours are truncated in
+
+    Returns: The last processed event id.
+    """
+    cur = conn.cursor()
+    cur.execute("SET TIME ZONE %s", (time_zone, ))
+    cur.execute("SELECT max(id) FROM {}".format(events_table))
+    max_id = cur.fetchone()[0] or 0
+    conn.commit()
+
+    # `dimensions` tells NULL and '' apart, which the unique
+    # constraint could not do on the columns themselves.
+    insert = """
+        INSERT INTO {rollup} ("time.observation", {columns},
+                              dimensions, count)
+        SELECT date_trunc('hour', "time.observation"), {columns},
+               json_build_array({columns})::text, count(*)
+          FROM {events}
+         WHERE id > %s AND id <= %s
+           AND "time.observation" IS NOT NULL
+         GROUP BY date_trunc('hour', "time.observation"), {columns}
+        ON CONFLICT ("time.observation", dimensions)
+        DO UPDATE SET count = {rollup}.count + EXCLUDED.count
+        """.format(rollup=rollup_table, events=events_table,
+                   columns=_columns())
+
+    while True:
+        # locking the state serialises concurrent refreshes
+        cur.execute("SELECT last_id FROM {}_state FOR UPDATE".format(
+            rollup_table))
+        last_id = cur.fetchone()[0]
+        if last_id >= max_id:
+            conn.rollback()
+            return last_id
+
+        upper = min(last_id + batch_size, max_id)
+        cur.execute(insert, (last_id, upper))
+        cur.execute("UPDATE {}_state SET last_id = %s, refreshed = now()"
+                    "".format(rollup_table), (upper,))
+        conn.commit()
+        log.info("Added events with %d < id <= %d to %s.",
+                 last_id, upper, rollup_table)
+
+
+def rebuild(conn, events_table: str, rollup_table: str,
+            batch_size: int=100000, time_zone: str="UTC") -> int:
+    """Recomputes the rollup from all events."""
+    cur = conn.cursor()
+    cur.execute("SELECT last_id FROM {}_state FOR UPDATE".format(
+        rollup_table))
+    cur.execute("TRUNCATE {}".format(rollup_table))
+    cur.execute("UPDATE {}_state SET last_id = 0, refreshed = NULL".format(
+        rollup_table))
+    conn.commit()
+    return refresh(conn, events_table, rollup_table, batch_size, time_zone)
+
+
+def covers(params: dict) -> bool:
+    """Tests if the statistics for `params` can use the rollup.
+
+    Args:
+        params: the parameters of the stats query, the time bounds
+            already converted to datetimes
+    """
+    for key in (TIME_AFTER, TIME_BEFORE):
+        bound = params.get(key)
+        # A bound with an explicit time zone may be a full hour there
+        # but not in the time zone of the database session, which
+        # truncates the rollup buckets.
+        if bound is None or bound.tzinfo is not None or (
+                bound.minute, bound.second, bound.microsecond) != (0, 0, 0):
+            return False
+    return all(key in SUBQUERIES for key in params
+               if key not in (TIME_AFTER, TIME_BEFORE))
+
+
+def query_prepare_stats(q, interval: str, after, before,
+                        events_table: str, rollup_table: str):
+    """ Prepares a Query-string for statistics from the rollup
+
+    The time range excludes `after` like the query on the events.
+    The rollup cannot tell events at the start of the hour apart,
+    so the events at exactly `after` are counted from the events
+    table and subtracted. The events inserted since the last refresh
+    are counted from the events table, too.
+
+    Args:
+        q: An array of Tuples created with query_build_query without
+            the time bounds
+        interval: 'month', 'week', 'day' or 'hour'
+
+    Returns: A tuple consisting of a query string and an array of parameters.
+
+    """
+    if interval not in ('month', 'week', 'day', 'hour'):
+        raise ValueError
+
+    def where(time_conditions):
+        conditions = []
+        params = []
+        for subquerytuple in list(q) + time_conditions:
+            conditions.append(subquerytuple[0])
+            params.extend((subquerytuple[1], ) *
+                          subquerytuple[0].count('%s'))
+        return " AND ".join(conditions), params
+
+    rollup_where, rollup_params = where(
+        [('"time.observation" >= %s', after),
+         ('"time.observation" < %s', before)])
+    boundary_where, boundary_params = where(
+        [('"time.observation" = %s', after)])
+    events_where, events_params = where(
+        [('"time.observation" > %s', after),
+         ('"time.observation" < %s', before)])
+
+    q_string = """
+        SELECT date_trunc('{interval}', "time.observation") AS date_trunc,
+               sum(count)::bigint AS count
+          FROM (SELECT "time.observation", count FROM {rollup}
+                 WHERE {rollup_where}
+                UNION ALL
+                SELECT "time.observation", -1 FROM {events}
+                 WHERE {boundary_where}
+                   AND id <= (SELECT last_id FROM {rollup}_state)
+                UNION ALL
+                SELECT "time.observation", 1 FROM {events}
+                 WHERE {events_where}
+                   AND id > (SELECT last_id FROM {rollup}_state)
+               ) AS counts
+         GROUP BY 1 HAVING sum(count) <> 0
+         ORDER BY 1""".format(interval=interval,
+                              rollup_where=rollup_where,
+                              boundary_where=boundary_where,
+                              events_where=events_where,
+                              rollup=rollup_table,
+                              events=events_table)
+    return q_string, rollup_params + boundary_params + events_params
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python3 -m events_api.rollup",
+        description="Refresh the hourly rollup of the events.")
+    parser.add_argument("--create", action="store_true",
+                        help="create the rollup tables")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="recompute the rollup from all events")
+    args = parser.parse_args()
+
+    from events_api import serve
+    config = serve.read_configuration()
+    logging.basicConfig(level=config.get("logging_level", "INFO"))
+
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(config.get("rollup", {}))
+    events_table = events_relation(config)
+    rollup_table = settings["table"]
+
+    # the user of the api only needs to read, so another one can be given
+    conn = psycopg2.connect(settings.get("libpg_conninfo",
+                                         config["libpg conninfo"]))
+    try:
+        if args.create:
+            cur = conn.cursor()
+            for statement in create_statements(rollup_table):
+                cur.execute(statement)
+            conn.commit()
+
+        if args.rebuild:
+            last_id = rebuild(conn, events_table, rollup_table,
+                              settings["batch_size"], settings["time_zone"])
+        else:
+            last_id = refresh(conn, events_table, rollup_table,
+                              settings["batch_size"], settings["time_zone"])
+        print("{} is up to date with event id {}.".format(rollup_table,
+                                                         last_id))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -30,25 +30,37 @@ TODO:
 
 """
 
+import collections
+import concurrent.futures
 import json
 import logging
 import os
+import re
 import sys
+import uuid
 # FUTURE the typing module is part of Python's standard lib for v>=3.5
 # try:
 #    from typing import Tuple, Union, Sequence, List
 # except:
 #    pass
 
-from falcon import HTTP_BAD_REQUEST, HTTP_INTERNAL_SERVER_ERROR
+from falcon import HTTP_BAD_REQUEST, HTTP_INTERNAL_SERVER_ERROR, \
+    HTTP_GATEWAY_TIMEOUT, HTTP_NOT_FOUND, HTTP_SERVICE_UNAVAILABLE
 import hug
 import psycopg2
+from psycopg2 import errorcodes
 import datetime
 import dateutil.parser
 import copy
 
 from psycopg2.extras import RealDictCursor
 
+from intelmq_fody_backend import copystream, dbpool, disconnect, \
+    jsonstream, metrics, pages, querycompiler, rawjson, subqueries
+from . import rollup
+from . import statscache
+from . import tiers
+
 
 log = logging.getLogger(__name__)
 # adding a custom log level for even more details when diagnosing
@@ -60,6 +72,17 @@ EXAMPLE_CONF_FILE = r"""
   "libpg conninfo":
     "host=localhost dbname=intelmq-events user=eventapiuser password='USER\\'s DB PASSWORD'",
   "database table": "events",
+  "table tiers": [{"table": "events", "from": "100 days ago"},
+                  {"table": "events_archive", "until": "90 days ago"}],
+  "connection pool": {"minconn": 1, "maxconn": 8, "checkout_timeout": 30},
+  "export batch size": 1000,
+  "stats cache": {"max_entries": 256, "max_buckets": 100000,
+                  "settle_seconds": 86400},
+  "rollup": {"table": "events_hourly", "batch_size": 100000,
+             "time_zone": "UTC"},
+  "statement timeouts": {"default": "60s", "search": "30s", "export": "30s"},
+  "parallel stats": {"workers": 4, "slice": "month"},
+  "prepared statements": false,
   "logging_level": "INFO",
   "subqueries": {
      "all_ips": {
@@ -75,6 +98,78 @@ EXAMPLE_CONF_FILE = r"""
 ENDPOINT_PREFIX = '/api/events'
 ENDPOINT_NAME = 'Events'
 
+# Times the serialisation of the results, see metrics.py.
+hug.API(__name__).http.output_format = metrics.timed_output(
+    hug.output_format.json)
+
+# Number of rows fetched per round trip by the streaming export,
+# can be overwritten by the configuration file.
+EXPORT_BATCH_SIZE = 1000
+
+# The columns returned by /search if no fields are requested.
+# The large columns like "raw" and "extra" are left out on purpose,
+# "raw" can be fetched for a single event with /raw.
+QUERY_SEARCH_FIELDS = (
+    'id',
+    'time.observation',
+    'time.source',
+    'source.ip',
+    'destination.ip',
+    'classification.taxonomy',
+    'classification.type',
+    'classification.identifier',
+    'malware.name',
+    'feed.provider',
+    'feed.name',
+)
+
+# Allowed characters of a field name requested with the `fields` parameter.
+FIELD_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# The type of the `fields` parameter, a comma separated list of names.
+FieldList = hug.types.delimited_list(',')
+
+# Per bucket counts of /stats, see statscache.py.
+# Replaced in setup() according to the configuration file.
+STATS_CACHE = statscache.StatsCache(**statscache.DEFAULT_SETTINGS)
+
+# Settings of the hourly rollup table, see rollup.py.
+# None if not configured.
+ROLLUP_SETTINGS = None
+
+# The time zone of the statistics, set in setup() to the one of the
+# rollup, so its hours match. None for the one of the database session.
+STATS_TIME_ZONE = None
+
+# Threads running the time slices of /stats concurrently and the length
+# of a slice, set in setup() if "parallel stats" is configured.
+STATS_EXECUTOR = None
+STATS_SLICE = 'month'
+
+# The columns /stats can split the series by with `group_by`
+# and the default and maximal number of values with their own series.
+STATS_GROUP_COLUMNS = (
+    'classification.type',
+    'feed.name',
+    'malware.name',
+    'source.asn',
+    'source.geolocation.cc',
+)
+STATS_GROUP_TOP = 10
+STATS_GROUP_TOP_MAX = 100
+
+# The tables of the events per time range, see tiers.py.
+# None if only the `database table` is used.
+QUERY_TIERS = None
+
+# Templates of the statements, PREPAREd on the connections
+# if "prepared statements" is configured. Replaced in setup().
+QUERY_COMPILER = querycompiler.QueryCompiler(name=ENDPOINT_NAME)
+
+# Limits for the statements of each endpoint, e.g. "30s",
+# can be set by the configuration file.
+STATEMENT_TIMEOUTS = {}
+
 
 def read_configuration() -> dict:
     """Read configuration file.
@@ -113,305 +208,153 @@ def read_configuration() -> dict:
     return config if isinstance(config, dict) else {}
 
 
-eventdb_conn = None
-# Using a global object for the database connection
-# must be initialised once
+eventdb_pool = None
+# Using a global pool of database connections,
+# must be initialised once. Each query borrows a connection.
 
 
-def open_db_connection(dsn: str):
-    """ Open the Connection to the EventDB
+def open_db_pool(dsn: str, settings: dict=None):
+    """ Open the pool of Connections to the EventDB
 
     Args:
         dsn: a Connection - String
+        settings: the "connection pool" section of the configuration
 
-    Returns: a Database Connection
+    Returns: a ConnectionPool
 
     """
-    global eventdb_conn
-
-    eventdb_conn = psycopg2.connect(dsn=dsn)
-    return eventdb_conn
-
-
-def __rollback_transaction():
-    global eventdb_conn
-    log.log(DD, "Calling rollback()")
-    eventdb_conn.rollback()
-
-
-QUERY_EVENT_SUBQUERY = {
-    # queryname: ['sqlstatement', 'description', 'label', 'Expected-Type']
-    'id': {
-        'sql': 'id = %s',
-        'description': 'Query for an Event matching this ID.',
-        'label': 'EventID',
-        'exp_type': 'integer'
-    },
-    # Time
-    'time-observation_before': {
-        'sql': '"time.observation" < %s',
-        'description': '',
-        'label': 'Observation Time before',
-        'exp_type': 'datetime'
-    },
-    'time-observation_before_encl': {
-        'sql': '"time.observation" <= %s',
-        'description': '',
-        'label': 'Observation Time before, including',
-        'exp_type': 'datetime'
-    },
-    'time-observation_after': {
-        'sql': '"time.observation" > %s',
-        'description': '',
-        'label': 'Observation Time after',
-        'exp_type': 'datetime'
-    },
-    'time-observation_after_encl': {
-        'sql': '"time.observation" > %s',
-        'description': '',
-        'label': 'Observation Time after, including',
-        'exp_type': 'datetime'
-    },
-    'time-source_before': {
-        'sql': '"time.source" < %s',
-        'description': '',
-        'label': 'Source Time before',
-        'exp_type': 'datetime'
-    },
-    'time-source_before_encl': {
-        'sql': '"time.source" <= %s',
-        'description': '',
-        'label': 'Source Time before, including',
-        'exp_type': 'datetime'
-    },
-    'time-source_after': {
-        'sql': '"time.source" > %s',
-        'description': '',
-        'label': 'Source Time after',
-        'exp_type': 'datetime'
-    },
-    'time-source_after_encl': {
-        'sql': '"time.source" > %s',
-        'description': '',
-        'label': 'Source Time after, including',
-        'exp_type': 'datetime'
-    },
-    # Source
-    'source-ip_in_sn': {
-        'sql': '"source.ip" <<= %s',
-        'description': '',
-        'label': 'Source IP-Network',
-        'exp_type': 'cidr'
-    },
-    'source-ip_is': {
-        'sql': '"source.ip" = %s',
-        'description': '',
-        'label': 'Source IP-Address',
-        'exp_type': 'ip'
-    },
-    'source-asn_is': {
-        'sql': '"source.asn" = %s',
-        'description': '',
-        'label': 'Source ASN',
-        'exp_type': 'integer'
-    },
-    'source-fqdn_is': {
-        'sql': '"source.fqdn" = %s',
-        'description': '',
-        'label': 'Source FQDN',
-        'exp_type': 'string'
-    },
-    'source-fqdn_icontains': {
-        'sql': '"source.fqdn" ILIKE %s',
-        'description': '',
-        'label': 'Source FQDN contains',
-        'exp_type': 'string'
-    },
-
-    # Destinations
-    'destination-ip_in_sn': {
-        'sql': '"destination.ip" <<= %s',
-        'description': '',
-        'label': 'Destination IP-Network',
-        'exp_type': 'cidr'
-    },
-    'destination-ip_is': {
-        'sql': '"destination.ip" = %s',
-        'description': '',
-        'label': 'Destination IP-Address',
-        'exp_type': 'ip'
-    },
-    'destination-asn_is': {
-        'sql': '"destination.asn" = %s',
-        'description': '',
-        'label': 'Destination ASN',
-        'exp_type': 'integer'
-    },
-    'destination-fqdn_is': {
-        'sql': '"destination.fqdn" = %s',
-        'description': '',
-        'label': 'Destination FQDN',
-        'exp_type': 'string'
-    },
-    'destination-fqdn_icontains': {
-        'sql': '"destination.fqdn" ILIKE %s',
-        'description': '',
-        'label': 'Destination FQDN contains',
-        'exp_type': 'string'
-    },
-
-    # Classification
-    'classification-taxonomy_is': {
-        'sql': '"classification.taxonomy" = %s',
-        'description': '',
-        'label': 'Classification Taxonomy',
-        'exp_type': 'string'
-    },
-    'classification-taxonomy_icontains': {
-        'sql': '"classification.taxonomy" ILIKE %s',
-        'description': '',
-        'label': 'Classification Taxonomy contains',
-        'exp_type': 'string'
-    },
-    'classification-type_is': {
-        'sql': '"classification.type" = %s',
-        'description': '',
-        'label': 'Classification Type',
-        'exp_type': 'string'
-    },
-    'classification-type_icontains': {
-        'sql': '"classification.type" ILIKE %s',
-        'description': '',
-        'label': 'Classification Type contains',
-        'exp_type': 'string'
-    },
-    'classification-identifier_is': {
-        'sql': '"classification.identifier" = %s',
-        'description': '',
-        'label': 'Classification Identifier',
-        'exp_type': 'string'
-    },
-    'classification-identifier_icontains': {
-        'sql': '"classification.identifier" ILIKE %s',
-        'description': '',
-        'label': 'Classification Identifier contains',
-        'exp_type': 'string'
-    },
-    'malware-name_is': {
-        'sql': '"malware.name" = %s',
-        'description': '',
-        'label': 'Malware Name',
-        'exp_type': 'string'
-    },
-    'malware-name_icontains': {
-        'sql': '"malware.name" ILIKE %s',
-        'description': '',
-        'label': 'Malware Name contains',
-        'exp_type': 'string'
-    },
-
-    # Feed
-    'feed-provider_is': {
-        'sql': '"feed.provider" = %s',
-        'description': '',
-        'label': 'Feed Provider',
-        'exp_type': 'string'
-    },
-    'feed-provider_icontains': {
-        'sql': '"feed.provider" ILIKE %s',
-        'description': '',
-        'label': 'Feed Provider contains',
-        'exp_type': 'string'
-    },
-    'feed-name_is': {
-        'sql': '"feed.name" = %s',
-        'description': '',
-        'label': 'Feed Name',
-        'exp_type': 'string'
-    },
-    'feed-name_icontains': {
-        'sql': '"feed.name" ILIKE %s',
-        'description': '',
-        'label': 'Feed Name contains',
-        'exp_type': 'string'
-    },
-}
+    global eventdb_pool
+
+    eventdb_pool = dbpool.pool_for_dsn(dsn, settings)
+    return eventdb_pool
+
+
+# The subqueries on the events, can be extended by the configuration.
+QUERY_EVENT_SUBQUERY = copy.deepcopy(subqueries.EVENT_SUBQUERIES)
+
+# The columns with pattern subqueries: (queryname prefix, column, label)
+QUERY_PATTERN_COLUMNS = subqueries.EVENT_PATTERN_COLUMNS
 
 
 def query_get_subquery(q: str):
     """ Return the query-Statement from the QUERY_EVENT_SUBQUERY
 
-    Basically this is a getter for the dict...
+    Raises:
+        ValueError: if there is no subquery `q`.
+    """
+    return subqueries.get_subquery(QUERY_EVENT_SUBQUERY, q)
+
+
+def query_build_subquery(q: str, p: str):
+    """Resolves the query-operation and the parameters into a tuple."""
+    return subqueries.build_subquery(QUERY_EVENT_SUBQUERY, q, p)
+
+
+def query_build_query(params):
+    """Returns the (SQL, value) tuples of the subqueries in `params`."""
+    return subqueries.build_query(QUERY_EVENT_SUBQUERY, params)
+
+
+def query_prepare_columns(fields=None) -> str:
+    """ Returns the SQL column list for a projection to the given fields
 
     Args:
-        q: A Key which can be found in QUERY_EVENT_SUBQUERY
+        fields: names of the columns, None or 'all' selects all columns
 
-    Returns: The subquery from QUERY_EVENT_SUBQUERY
+    Returns: The column list to be used in a SELECT statement.
+
+    Raises:
+        ValueError: if a field name contains unexpected characters.
 
     """
-    r = QUERY_EVENT_SUBQUERY.get(q, '')
-    s = None
-    if r:
-        s = r.get('sql', '')
-    if s:
-        return s
-    else:
-        raise ValueError('The Query-Paramter you asked for is not supported.')
+    if not fields or 'all' in fields:
+        return '*'
 
+    for field in fields:
+        if not FIELD_NAME_PATTERN.match(field):
+            raise ValueError('The field name {!r} is not valid.'.format(field))
+
+    return ', '.join('"{}"'.format(field) for field in fields)
 
-def query_build_subquery(q: str, p: str):
-    """Resolves the query-operation and the parameters into a tuple.
+
+def query_relation(q) -> str:
+    """ Returns the table or the tables to select the events from
 
     Args:
-        q: the column which should match the search value
-        p: the search value
+        q: An array of Tuples created with query_build_query
 
-    Returns: a tuple containing Query an Search Value
+    Returns: With QUERY_TIERS the tables for the time range of q,
+        otherwise QUERY_TABLE_NAME.
 
     """
-    t = (query_get_subquery(q), p)
-    return t
+    if QUERY_TIERS is None:
+        return QUERY_TABLE_NAME
+    return QUERY_TIERS.relation(q)
 
 
-def query_build_query(params):
+def query_prepare_export(q, columns: str='*'):
+    """ Prepares a Query-string in order to Export Everything from the DB
+
+    Args:
+        q: An array of Tuples created with query_build_query
+        columns: The column list created with query_prepare_columns
+
+    Returns: A Tuple consisting of a query string and an array of parameters.
+
     """
+    table = query_relation(q)
+    return QUERY_COMPILER.prepare(
+        ('export', table, columns), q,
+        lambda where: "SELECT {columns} FROM {table}{where}".format(
+            columns=columns, table=table, where=where))
+
+
+def query_prepare_count(q, limit: int=None):
+    """ Prepares a Query-string to count the matching events
 
     Args:
-        params:
+        q: An array of Tuples created with query_build_query
+        limit: stop counting after this number of events
 
-    Returns: An Array of tuples
+    Returns: A tuple consisting of a query string and an array of parameters.
 
     """
-    queries = []
-    for key in params:
-        queries.append(query_build_subquery(key, params[key]))
-    return queries
+    if limit is None:
+        return query_prepare_export(q, 'count(*) AS count')
 
+    table = query_relation(q)
+    return QUERY_COMPILER.prepare(
+        ('count', table), q,
+        lambda where: "SELECT count(*) AS count FROM"
+                      " (SELECT 1 FROM {table}{where} LIMIT %s) AS matches"
+                      "".format(table=table, where=where),
+        [limit])
 
-def query_prepare_export(q):
-    """ Prepares a Query-string in order to Export Everything from the DB
+
+def query_prepare_estimate(q):
+    """ Prepares a Query-string for the planner's estimate of the events
 
     Args:
         q: An array of Tuples created with query_build_query
 
-    Returns: A Tuple consisting of a query string and an array of parameters.
+    Returns: A tuple consisting of a query string and an array of parameters.
 
     """
-    q_string = "SELECT * FROM {table}".format(table=QUERY_TABLE_NAME)
-    params = []
-    # now iterate over q (which had to be created with query_build_query
-    # previously) and should be a list of tuples and concatenate
-    # the resulting query and a list of query parameters.
-    counter = 0
-    for subquerytuple in q:
-        if counter > 0:
-            q_string = q_string + " AND " + subquerytuple[0]
-            params.extend((subquerytuple[1], ) * subquerytuple[0].count('%s'))
-        else:
-            q_string = q_string + " WHERE " + subquerytuple[0]
-            params.extend((subquerytuple[1], ) * subquerytuple[0].count('%s'))
-        counter += 1
-    return q_string, params
+    q_string, params = query_prepare_export(q)
+    return "EXPLAIN (FORMAT JSON) " + q_string, params
+
+
+def plan_rows(rows) -> int:
+    """ Returns the estimated number of rows from the result of EXPLAIN
+
+    Args:
+        rows: the result of a query prepared with query_prepare_estimate
+
+    """
+    plan = rows[0]['QUERY PLAN']
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
 
 
 def query_prepare_stats(q, interval='day'):
@@ -430,51 +373,389 @@ def query_prepare_stats(q, interval='day'):
 
     trunc = "date_trunc('%s', \"time.observation\")" % (interval,)
 
-    q_string = """SELECT {trunc}, count(*) FROM {table}
-               """.format(trunc=trunc, table=QUERY_TABLE_NAME)
-
-    params = []
-    # now iterate over q (which had to be created with query_build_query
-    # previously) and should be a list of tuples and concatenate the
-    # resulting query and a list of query parameters
-    counter = 0
-    for subquerytuple in q:
-        if counter > 0:
-            q_string = q_string + " AND " + subquerytuple[0]
-            params.extend((subquerytuple[1], ) * subquerytuple[0].count('%s'))
+    table = query_relation(q)
+    return QUERY_COMPILER.prepare(
+        ('stats', table, interval), q,
+        lambda where: "SELECT {trunc}, count(*) FROM {table}{where}"
+                      " GROUP BY {trunc} ORDER BY date_trunc".format(
+                          trunc=trunc, table=table, where=where))
+
+
+def query_stats(params, timeres: str, statement_timeout=None):
+    """ Queries the statistics, reusing the counts of closed buckets
+
+    Args:
+        params: the query parameters including the datetimes
+            `time-observation_after` and `time-observation_before`
+        timeres: 'month', 'week', 'day' or 'hour'
+        statement_timeout: see endpoint_timeout()
+
+    Returns: The rows with the keys 'date_trunc' and 'count'.
+
+    """
+    time_after = params["time-observation_after"]
+    time_before = params["time-observation_before"]
+
+    filters = {key: value for key, value in params.items()
+               if key not in ("time-observation_after",
+                              "time-observation_before")}
+
+    # Bounds with an explicit time zone may not match the buckets
+    # of the database session, so they are not cached.
+    if not STATS_CACHE.enabled or time_after.tzinfo or time_before.tzinfo:
+        return query_stats_ranges(filters, timeres,
+                                  [(time_after, False, time_before)],
+                                  statement_timeout)
+
+    cache_key = (QUERY_TABLE_NAME, timeres,
+                 tuple(sorted((key, str(value))
+                              for key, value in filters.items())))
+
+    results, ranges, cacheable = STATS_CACHE.plan(
+        cache_key, time_after, time_before, timeres, query_now())
+
+    fetched = query_stats_ranges(filters, timeres, ranges, statement_timeout)
+
+    STATS_CACHE.store(cache_key, cacheable, fetched)
+
+    results.extend(fetched)
+    results.sort(key=lambda row: row['date_trunc'])
+    return results
+
+
+def query_now() -> datetime.datetime:
+    """ Returns the current time of the database
+
+    The time is naive and in the time zone of the statistics,
+    like the buckets of date_trunc(), which may differ from the one
+    of this host.
+
+    """
+    return query(("SELECT localtimestamp AS now", []),
+                 time_zone=STATS_TIME_ZONE)[0]['now']
+
+
+def query_stats_slices(ranges, length: str):
+    """ Splits time ranges into slices of a given length
+
+    Args:
+        ranges: list of (start, start_included, end) tuples
+        length: 'month', 'week', 'day' or 'hour'
+
+    Returns: A list of (start, start_included, end) tuples.
+
+    """
+    slices = []
+    for start, start_included, end in ranges:
+        for boundary, _ in statscache.buckets(start, end, length):
+            if boundary > start:
+                slices.append((start, start_included, boundary))
+                start, start_included = boundary, True
+        slices.append((start, start_included, end))
+    return slices
+
+
+def query_stats_ranges(filters, timeres: str, ranges,
+                       statement_timeout=None):
+    """ Queries the statistics for time ranges and merges the counts
+
+    With STATS_EXECUTOR the ranges are split into slices of STATS_SLICE,
+    which are queried concurrently on separate connections of the pool.
+
+    Args:
+        filters: the query parameters without the time bounds
+        timeres: 'month', 'week', 'day' or 'hour'
+        ranges: list of (start, start_included, end) tuples
+        statement_timeout: see endpoint_timeout()
+
+    Returns: The rows with the keys 'date_trunc' and 'count'.
+
+    """
+    if STATS_EXECUTOR is not None:
+        ranges = query_stats_slices(ranges, STATS_SLICE)
+
+    prepared = []
+    for start, start_included, end in ranges:
+        querylist = query_build_query(filters)
+        querylist.append(('"time.observation" >= %s' if start_included
+                          else '"time.observation" > %s', start))
+        querylist.append(('"time.observation" < %s', end))
+        prepared.append(query_prepare_stats(querylist, timeres))
+
+    if STATS_EXECUTOR is None or len(prepared) < 2:
+        parts = [query(prep, statement_timeout, STATS_TIME_ZONE)
+                 for prep in prepared]
+    else:
+        watcher = disconnect.current()
+        stats = metrics.current()
+
+        def run(prep):
+            with disconnect.use(watcher), metrics.use(stats):
+                return query(prep, statement_timeout, STATS_TIME_ZONE)
+
+        futures = [STATS_EXECUTOR.submit(run, prep) for prep in prepared]
+        try:
+            parts = [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+    # a bucket may span several slices, if they are not aligned to it
+    merged = {}
+    for rows in parts:
+        for row in rows:
+            if row['date_trunc'] in merged:
+                merged[row['date_trunc']]['count'] += row['count']
+            else:
+                merged[row['date_trunc']] = row
+    return sorted(merged.values(), key=lambda row: row['date_trunc'])
+
+
+def query_prepare_grouped_stats(q, interval: str, column: str, top: int):
+    """ Prepares a Query-string for statistics per value of a column
+
+    The events are counted per interval and value in one pass. The `top`
+    values with the most events keep their own rows, the others are
+    summed up in rows with `other` set.
+
+    Args:
+        q: An array of Tuples created with query_build_query
+        interval: 'month', 'week', 'day' or 'hour'
+        column: one of STATS_GROUP_COLUMNS
+        top: the number of values with their own rows
+
+    Returns: A tuple consisting of a query string and an array of parameters.
+
+    """
+    if interval not in ('month', 'week', 'day', 'hour'):
+        raise ValueError
+    if column not in STATS_GROUP_COLUMNS:
+        raise ValueError
+
+    # NULL is a value of its own, so it is joined with IS NOT DISTINCT FROM
+    template = """
+        WITH counts AS (
+            SELECT date_trunc('{interval}', "time.observation") AS date_trunc,
+                   "{column}" AS value, count(*) AS count
+              FROM {table}{where}
+             GROUP BY 1, 2),
+        top AS (
+            SELECT value, true AS ranked FROM counts
+             GROUP BY value ORDER BY sum(count) DESC, value LIMIT %s)
+        SELECT counts.date_trunc,
+               CASE WHEN top.ranked THEN counts.value END AS value,
+               top.ranked IS NULL AS other,
+               sum(counts.count)::bigint AS count
+          FROM counts LEFT JOIN top
+            ON counts.value IS NOT DISTINCT FROM top.value
+         GROUP BY 1, 2, 3 ORDER BY 1"""
+    table = query_relation(q)
+    return QUERY_COMPILER.prepare(
+        ('grouped stats', table, interval, column), q,
+        lambda where: template.format(interval=interval, column=column,
+                                      table=table, where=where),
+        [top])
+
+
+def stats_group_series(rows):
+    """ Splits the rows of query_prepare_grouped_stats() into series
+
+    Returns: A tuple of the series of the values, ordered by their total,
+        the series of the other values and the series of all events.
+        A series is a dict with the 'total' and the 'results'
+        with the keys 'date_trunc' and 'count'.
+
+    """
+    groups = collections.OrderedDict()
+    other = {'total': 0, 'results': []}
+    overall = collections.OrderedDict()
+    for row in rows:
+        point = {'date_trunc': row['date_trunc'], 'count': row['count']}
+        if row['other']:
+            series = other
         else:
-            q_string = q_string + " WHERE " + subquerytuple[0]
-            params.extend((subquerytuple[1], ) * subquerytuple[0].count('%s'))
-        counter += 1
-    q_string = q_string + " GROUP BY %s ORDER BY date_trunc" % (trunc, )
-    return q_string, params
+            series = groups.setdefault(
+                row['value'], {'value': row['value'], 'total': 0,
+                               'results': []})
+        series['total'] += row['count']
+        series['results'].append(point)
+        overall[row['date_trunc']] = \
+            overall.get(row['date_trunc'], 0) + row['count']
+
+    groups = sorted(groups.values(), key=lambda series: -series['total'])
+    results = [{'date_trunc': date, 'count': count}
+               for date, count in overall.items()]
+    return groups, other, results
+
+
+# Keyset pagination of /search over the sort key of the events.
+# The cursor value is a row of the same columns, so only one
+# query parameter is needed.
+QUERY_PAGE_KEYSET = '("time.observation", id) < %s'
+QUERY_PAGE_ORDER = ' ORDER BY "time.observation" DESC, id DESC'
+QUERY_PAGE_COLUMNS = ('time.observation', 'id')
+QUERY_PAGE_JSON_ORDER = ' ORDER BY e."time.observation" DESC, e.id DESC'
+
+
+def query_prepare_page(prepared_query, limit: int):
+    """ Adds ordering and limit for one page, see pages.prepare_page()"""
+    return pages.prepare_page(prepared_query, QUERY_PAGE_ORDER, limit)
+
+
+def query_prepare_json(prepared_query, paged: bool=False):
+    """ Returns the events of the query as JSON text without null values
+
+    Args:
+        prepared_query: A QueryString, Paramater pair created
+                        with query_prepare
+        paged: if the query is from query_prepare_page(), then
+               the columns of the keyset are returned, too,
+               and the order is kept
+
+    Returns: A Tuple consisting of a query string and an array of parameters,
+             with a PREPAREd name if `prepared_query` has one.
+
+    """
+    if paged:
+        keyset = ['"{}"'.format(c) for c in QUERY_PAGE_COLUMNS]
+        q_string = rawjson.select_rows(prepared_query[0], keyset,
+                                       QUERY_PAGE_JSON_ORDER)
+    else:
+        q_string = rawjson.select_rows(prepared_query[0])
+    if getattr(prepared_query, 'name', None) is None:
+        return q_string, list(prepared_query[1])
+    return querycompiler.Query(q_string, prepared_query[1],
+                               querycompiler.statement_name(q_string))
+
+
+def encode_page_cursor(row) -> str:
+    """Returns an opaque token for the page after the given row."""
+    return pages.encode_cursor(row, QUERY_PAGE_COLUMNS)
+
+
+def decode_page_cursor(token: str) -> tuple:
+    """Returns the keyset values of a token from encode_page_cursor().
+
+    Raises:
+        ValueError: if the token is not valid.
+    """
+    return pages.decode_cursor(token, QUERY_PAGE_COLUMNS)
 
 
-def query(prepared_query):
+def endpoint_timeout(endpoint: str):
+    """Returns the statement timeout configured for an endpoint."""
+    return dbpool.endpoint_timeout(STATEMENT_TIMEOUTS, endpoint)
+
+
+def query(prepared_query, statement_timeout=None, time_zone: str=None):
     """ Queries the Database for Events
 
     Args:
         prepared_query: A QueryString, Paramater pair created
                         with query_prepare
+        statement_timeout: see endpoint_timeout()
+        time_zone: for the transaction instead of the one of the session
 
     Returns: The results of the databasequery in JSON-Format.
 
     """
-    global eventdb_conn
+    global eventdb_pool
+
+    # a short read only transaction, which is always ended,
+    # so the connection is never left idle in transaction
+    with eventdb_pool.transaction(
+            readonly=True, statement_timeout=statement_timeout,
+            time_zone=time_zone) as conn:
+        # psycopgy2.4 does not offer 'with' for cursor()
+        # FUTURE use with
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+        operation = prepared_query[0]
+        parameters = prepared_query[1]
+        log.info(cur.mogrify(operation, parameters))
+        # canceled if the client of a watched request goes away
+        with disconnect.guard(conn), metrics.timer('db'):
+            QUERY_COMPILER.execute(cur, prepared_query)
+        log.log(DD, "Ran query={}".format(repr(cur.query.decode('utf-8'))))
+        # description = cur.description
+        with metrics.timer('fetch'):
+            results = cur.fetchall()
+        metrics.add_rows(len(results))
+
+    return results
+
+
+def query_batches(prepared_query, batch_size: int=None,
+                  statement_timeout=None, watcher=None):
+    """ Queries the Database for Events using a server-side cursor
+
+    This is a generator which yields the results in lists of at most
+    `batch_size` rows, so only one batch has to be held in memory
+    at any time. The transaction is ended when the generator is
+    exhausted or closed early, e.g. because the client went away.
+
+    Args:
+        prepared_query: A QueryString, Paramater pair created
+                        with query_prepare
+        batch_size: Number of rows to fetch per round trip,
+                    defaults to EXPORT_BATCH_SIZE
+        statement_timeout: limit for each round trip,
+                           see endpoint_timeout()
+        watcher: a disconnect.Watcher canceling the query
+                 if the client goes away, stopped when the generator ends
+
+    Yields: Lists of rows as dicts.
+
+    """
+    global eventdb_pool
 
-    # psycopgy2.4 does not offer 'with' for cursor()
-    # FUTURE use with
-    cur = eventdb_conn.cursor(cursor_factory=RealDictCursor)
+    batch_size = batch_size or EXPORT_BATCH_SIZE
 
     operation = prepared_query[0]
     parameters = prepared_query[1]
-    log.info(cur.mogrify(operation, parameters))
-    cur.execute(operation, parameters)
-    log.log(DD, "Ran query={}".format(repr(cur.query.decode('utf-8'))))
-    # description = cur.description
-    results = cur.fetchall()
 
-    return results
+    try:
+        # the transaction is kept until the generator is exhausted or closed,
+        # it is rolled back if the consumer stopped early
+        with eventdb_pool.transaction(
+                readonly=True, statement_timeout=statement_timeout) as conn:
+            # a named cursor is a server-side cursor,
+            # rows are only transferred when they are fetched.
+            cur = conn.cursor(name="export_{}".format(uuid.uuid4().hex),
+                              cursor_factory=RealDictCursor)
+            log.info(cur.mogrify(operation, parameters))
+            with disconnect.guard(conn, watcher):
+                cur.execute(operation, parameters)
+                log.log(DD, "Declared cursor for query={}".format(
+                    repr(cur.query.decode('utf-8'))))
+
+                with metrics.timer('fetch'):
+                    rows = cur.fetchmany(batch_size)
+                while rows:
+                    metrics.add_rows(len(rows))
+                    yield rows
+                    with metrics.timer('fetch'):
+                        rows = cur.fetchmany(batch_size)
+
+            cur.close()
+    finally:
+        if watcher is not None:
+            watcher.stop()
+
+
+def _collect_metrics():
+    info = STATS_CACHE.info()
+    yield ('fody_stats_cache_entries', 'gauge',
+           'Parameter sets with counts in the statistics cache.',
+           [({}, info['entries'])])
+    yield ('fody_stats_cache_hits_total', 'counter',
+           'Buckets of /stats taken from the cache.', [({}, info['hits'])])
+    yield ('fody_stats_cache_misses_total', 'counter',
+           'Buckets of /stats queried from the database.',
+           [({}, info['misses'])])
+
+
+metrics.register_collector(_collect_metrics)
 
 
 @hug.startup()
@@ -482,8 +763,8 @@ def setup(api):
     config = read_configuration()
     if "logging_level" in config:
         log.setLevel(config["logging_level"])
-    open_db_connection(config["libpg conninfo"])
-    log.debug("Initialised DB connection for events_api.")
+    open_db_pool(config["libpg conninfo"], config.get("connection pool"))
+    log.debug("Initialised DB connection pool for %s.", __name__)
 
     global QUERY_EVENT_SUBQUERY
     QUERY_EVENT_SUBQUERY.update(config.get('subqueries', {}))
@@ -491,6 +772,60 @@ def setup(api):
     global QUERY_TABLE_NAME
     QUERY_TABLE_NAME = config.get('database table', 'events')
 
+    global QUERY_TIERS
+    if 'table tiers' in config:
+        QUERY_TIERS = tiers.Tiers(config['table tiers'])
+
+    global EXPORT_BATCH_SIZE
+    EXPORT_BATCH_SIZE = config.get('export batch size', EXPORT_BATCH_SIZE)
+
+    global STATS_CACHE
+    settings = dict(statscache.DEFAULT_SETTINGS)
+    settings.update(config.get('stats cache', {}))
+    STATS_CACHE = statscache.StatsCache(**settings)
+
+    global STATEMENT_TIMEOUTS
+    STATEMENT_TIMEOUTS = config.get('statement timeouts', {})
+
+    global QUERY_COMPILER
+    QUERY_COMPILER = querycompiler.QueryCompiler(
+        config.get('prepared statements', False), name=ENDPOINT_NAME)
+
+    global STATS_EXECUTOR, STATS_SLICE
+    parallel = config.get('parallel stats', {})
+    STATS_SLICE = parallel.get('slice', STATS_SLICE)
+    if parallel.get('workers', 1) > 1:
+        STATS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+            max_workers=parallel['workers'])
+
+    global ROLLUP_SETTINGS, STATS_TIME_ZONE
+    if 'rollup' in config:
+        ROLLUP_SETTINGS = dict(rollup.DEFAULT_SETTINGS)
+        ROLLUP_SETTINGS.update(config['rollup'])
+        STATS_TIME_ZONE = ROLLUP_SETTINGS['time_zone']
+
+
+@hug.exception(dbpool.PoolTimeout)
+def handle_pool_timeout(exception, response):
+    log.warning(exception)
+    response.status = HTTP_SERVICE_UNAVAILABLE
+    return {"error": "The server is too busy, try again later."}
+
+
+@hug.exception(disconnect.ClientDisconnected)
+def handle_client_disconnected(exception, response):
+    log.info("Canceled query: %s", exception)
+    response.status = disconnect.HTTP_CLIENT_CLOSED_REQUEST
+    return {"error": "The client closed the connection."}
+
+
+@hug.exception(dbpool.StatementTimeout)
+def handle_statement_timeout(exception, response):
+    log.warning(exception)
+    response.status = HTTP_GATEWAY_TIMEOUT
+    return {"error": "The query took too long and was canceled, "
+                     "try to narrow it down."}
+
 
 @hug.get(ENDPOINT_PREFIX, examples="id=1")
 # @hug.post(ENDPOINT_PREFIX)
@@ -515,13 +850,48 @@ def getEvent(response, id: int=None):
     prep = query_prepare_export(querylist)
 
     try:
-        return query(prep)
+        return query(prep, endpoint_timeout('getEvent'))
+    except psycopg2.Error as e:
+        log.error(e)
+        response.status = HTTP_INTERNAL_SERVER_ERROR
+        return {"error": "The query could not be processed."}
+
+
+@hug.get(ENDPOINT_PREFIX + '/raw', examples="id=1")
+def getRaw(response, id: int=None):
+    """Return the raw payload of one Event identified by ID
+
+    The payload is left out by /search, so it has only to be transferred
+    for the events a user is looking at.
+
+    Args:
+        response: A HUG response object...
+        id: The ID of an event
+
+    Returns: A dict with the `id` and the `raw` payload of the event.
+
+    """
+    if not id:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": "You need to provide an id."}
+
+    querylist = query_build_query({"id": id})
+
+    prep = query_prepare_export(querylist,
+                                query_prepare_columns(['id', 'raw']))
+
+    try:
+        rows = query(prep, endpoint_timeout('getRaw'))
     except psycopg2.Error as e:
         log.error(e)
-        __rollback_transaction()
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "The query could not be processed."}
 
+    if not rows:
+        response.status = HTTP_NOT_FOUND
+        return {"error": "There is no event with this id."}
+    return rows[0]
+
 
 @hug.get(ENDPOINT_PREFIX + '/subqueries')
 def showSubqueries():
@@ -540,15 +910,29 @@ def showSubqueries():
          examples="time-observation_after=2017-03-01"
                   "&time-observation_before=2017-03-01")
 # @hug.post(ENDPOINT_PREFIX + '/search')
-def search(response, **params):
+def search(request, response, limit: hug.types.greater_than(0)=None,
+           cursor: str=None,
+           fields: FieldList=None,
+           **params):
     """Search for events
 
+    With `limit` the events are returned page by page, newest first.
+    To get the next page pass the `next_cursor` of the response
+    as `cursor` together with the same queries again.
+
     Args:
+        request: A HUG request object, to watch for the client going away
         response: A HUG response object...
+        limit: Maximal number of events to return
+        cursor: Token of the page to return, needs `limit`
+        fields: Comma separated names of the columns to return,
+                'all' for all columns, defaults to QUERY_SEARCH_FIELDS
         **params: Queries from QUERY_EVENT_SUBQUERY
 
     Returns: A subset of the most likely most important fields of the events
-             which are matching the query.
+             which are matching the query. If `limit` is given
+             a dict with the events as `results` and the token
+             for the next page as `next_cursor` (None for the last page).
 
     """
     for param in params:
@@ -565,34 +949,133 @@ def search(response, **params):
         response.status = HTTP_BAD_REQUEST
         return {"error": "Queries without parameters are not supported"}
 
+    if cursor is not None and limit is None:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": "A cursor can only be used together with a limit."}
+
+    fields = list(fields or QUERY_SEARCH_FIELDS)
+    if limit is not None and 'all' not in fields:
+        # the columns of the keyset are needed for the next cursor
+        fields.extend(c for c in QUERY_PAGE_COLUMNS if c not in fields)
+
+    try:
+        columns = query_prepare_columns(fields)
+    except ValueError as e:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": str(e)}
+
     querylist = query_build_query(params)
 
-    prep = query_prepare_export(querylist)
+    if cursor is not None:
+        try:
+            querylist.append((QUERY_PAGE_KEYSET, decode_page_cursor(cursor)))
+        except ValueError:
+            response.status = HTTP_BAD_REQUEST
+            return {"error": "The cursor is not valid."}
+
+    prep = query_prepare_export(querylist, columns)
+
+    if limit is not None:
+        prep = query_prepare_page(prep, limit)
+
+    prep = query_prepare_json(prep, paged=limit is not None)
 
     try:
-        rows = query(prep)
+        with disconnect.watch(request.env):
+            rows = query(prep, endpoint_timeout('search'))
     except psycopg2.Error as e:
         log.error(e)
-        __rollback_transaction()
+        if e.pgcode == errorcodes.UNDEFINED_COLUMN:
+            response.status = HTTP_BAD_REQUEST
+            return {"error": "At least one of the fields does not exist."}
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "The query could not be processed."}
 
-    events = []
-    for row in rows:
-        # remove None entries from the resulting dict
-        event = {k: v for k, v in row.items() if v is not None}
-        events.append(event)
-    return events
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor(rows[-1])
+
+    # the events are passed on as PostgreSQL encoded them
+    events = rawjson.array(row[rawjson.COLUMN] for row in rows)
+
+    if limit is None:
+        return rawjson.stream(events)
+    return rawjson.stream(events, next_cursor=next_cursor)
+
+
+# The type of the `mode` parameter of /count.
+CountMode = hug.types.one_of(('exact', 'estimate'))
+
+
+@hug.get(ENDPOINT_PREFIX + '/count',
+         examples="malware-name_is=nymaim&mode=estimate")
+def count(response,
+          mode: CountMode='exact',
+          limit: hug.types.greater_than(0)=None,
+          **params):
+    """Count the events matching the query parameters
+
+    The mode `estimate` only asks the query planner, it is fast
+    but can be far off. The mode `exact` counts the events, with `limit`
+    it stops after this number, which bounds the time needed.
+
+    Args:
+        response: A HUG response object...
+        mode: 'exact' (default) or 'estimate'
+        limit: Maximal number of events to count in the 'exact' mode
+        **params: Queries from QUERY_EVENT_SUBQUERY
+
+    Returns: A dict with the `count` and the `mode` used.
+             In the 'exact' mode `limited` tells if counting
+             stopped at the `limit`.
+
+    """
+    for param in params:
+        # Test if the parameters are sane....
+        try:
+            query_get_subquery(param)
+        except ValueError:
+            response.status = HTTP_BAD_REQUEST
+            return {"error":
+                    "At least one of the queryparameters is not allowed: %s"
+                    % (param, )}
+
+    if not params:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": "Queries without parameters are not supported"}
+
+    querylist = query_build_query(params)
+
+    try:
+        if mode == 'estimate':
+            return {'count': plan_rows(query(
+                        query_prepare_estimate(querylist),
+                        endpoint_timeout('count'))),
+                    'mode': mode}
+
+        number = query(query_prepare_count(querylist, limit),
+                       endpoint_timeout('count'))[0]['count']
+    except psycopg2.Error as e:
+        log.error(e)
+        response.status = HTTP_INTERNAL_SERVER_ERROR
+        return {"error": "The query could not be processed."}
+
+    return {'count': number, 'mode': mode,
+            'limited': limit is not None and number >= limit}
 
 
 @hug.get(ENDPOINT_PREFIX + '/stats',
          examples="malware-name_is=nymaim&timeres=day")
 # @hug.post(ENDPOINT_PREFIX + '/export')
-def stats(response, **params):
+def stats(request, response, **params):
     """Return distribution of events for query parameters.
 
     Args:
-        **params: Queries from QUERY_EVENT_SUBQUERY
+        request: A HUG request object, to watch for the client going away
+        **params: Queries from QUERY_EVENT_SUBQUERY,
+            `group_by` one of STATS_GROUP_COLUMNS to add a series per value
+            for the `top` values and one for the `other` values
 
     Returns: The distribution of found events per interval and resolution.
     """
@@ -668,6 +1151,24 @@ def stats(response, **params):
     if params.get("time-observation_before_encl"):
         del params["time-observation_before_encl"]
 
+    # Split the series by the values of a column?
+    # `top` is ignored without `group_by`.
+    group_by = params.pop("group_by", None)
+    top = params.pop("top", STATS_GROUP_TOP)
+    if group_by is not None:
+        if group_by not in STATS_GROUP_COLUMNS:
+            response.status = HTTP_BAD_REQUEST
+            return {"error": "group_by must be one of: %s" %
+                    (", ".join(STATS_GROUP_COLUMNS), )}
+        try:
+            top = int(top)
+            if not 0 < top <= STATS_GROUP_TOP_MAX:
+                raise ValueError
+        except (TypeError, ValueError):
+            response.status = HTTP_BAD_REQUEST
+            return {"error": "top must be a number from 1 to %d" %
+                    (STATS_GROUP_TOP_MAX, )}
+
     for param in params:
         # Test if the parameters are sane....
         try:
@@ -682,40 +1183,92 @@ def stats(response, **params):
         response.status = HTTP_BAD_REQUEST
         return {"error": "Queries without parameters are not supported"}
 
-    querylist = query_build_query(params)
-
-    prep = query_prepare_stats(querylist, timeres)
+    if group_by:
+        # The groups need all buckets at once,
+        # so neither the rollup nor the cache are used.
+        source = 'events'
+        prep = query_prepare_grouped_stats(query_build_query(params),
+                                           timeres, group_by, top)
+    # Use the rollup if it has all the columns needed.
+    elif ROLLUP_SETTINGS and rollup.covers(params):
+        source = 'rollup'
+        filters = {key: value for key, value in params.items()
+                   if key not in (rollup.TIME_AFTER, rollup.TIME_BEFORE)}
+        prep = rollup.query_prepare_stats(
+            query_build_query(filters), timeres,
+            params[rollup.TIME_AFTER], params[rollup.TIME_BEFORE],
+            query_relation(query_build_query(params)),
+            ROLLUP_SETTINGS['table'])
+    else:
+        source = 'events'
+        prep = None
 
     try:
-        results = query(prep)
+        with disconnect.watch(request.env):
+            if prep:
+                results = query(prep, endpoint_timeout('stats'),
+                                STATS_TIME_ZONE)
+            else:
+                results = query_stats(params, timeres,
+                                      endpoint_timeout('stats'))
+        if group_by:
+            groups, other, results = stats_group_series(results)
         totalcount = 0
         for v in results:
             totalcount += v.get('count', 0)
 
     except psycopg2.Error as e:
         log.error(e)
-        __rollback_transaction()
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "The query could not be processed."}
 
     except AttributeError as e:
         log.error(e)
-        __rollback_transaction()
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "Something went wrong."}
 
-    return {'timeres': timeres, 'total': totalcount, 'results': results}
+    answer = {'timeres': timeres, 'total': totalcount, 'results': results,
+              'source': source}
+    if group_by:
+        answer.update({'group_by': group_by, 'top': top,
+                       'groups': groups, 'other': other})
+    return answer
+
+
+@hug.get(ENDPOINT_PREFIX + '/stats/cache')
+def stats_cache():
+    """Return size and hit/miss counters of the cache of /stats."""
+    return STATS_CACHE.info()
+
+
+# The type of the `format` parameter of /export.
+ExportFormat = hug.types.one_of(tuple(jsonstream.FORMATTERS) +
+                                tuple(copystream.COPY_OPTIONS))
 
 
 @hug.get(ENDPOINT_PREFIX + '/export',
          examples="time-observation_after=2017-03-01"
-                  "&time-observation_before=2017-03-01")
+                  "&time-observation_before=2017-03-01"
+                  "&format=ndjson")
 # @hug.post(ENDPOINT_PREFIX + '/export')
-def export(response, **params):
+def export(request, response,
+           format: ExportFormat='json',
+           fields: FieldList=None,
+           **params):
     """ This interface exports all events matching the query parameters
 
+    The events are fetched in batches from a server-side cursor and
+    streamed to the client, so the memory needed does not grow with
+    the number of events. For 'csv' and 'tsv' PostgreSQL formats
+    the rows itself with COPY, which is a lot faster.
+
     Args:
+        request: A HUG request object, to watch for the client going away
         response: A HUG response object...
+        format: 'json' for one array (default), 'ndjson' for one event
+                per line, 'csv' or 'tsv'
+        fields: Comma separated names of the columns to export,
+                defaults to all columns
         **params: Queries from QUERY_EVENT_SUBQUERY
 
     Returns: If existing all events of the EventDB matching the query
@@ -734,18 +1287,46 @@ def export(response, **params):
         response.status = HTTP_BAD_REQUEST
         return {"error": "Queries without parameters are not supported"}
 
+    try:
+        columns = query_prepare_columns(fields)
+    except ValueError as e:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": str(e)}
+
     querylist = query_build_query(params)
 
-    prep = query_prepare_export(querylist)
+    prep = query_prepare_export(querylist, columns)
 
+    watcher = disconnect.Watcher.for_environ(request.env)
     try:
-        return query(prep)
+        # wait for the first rows to be able to report errors
+        # before the streaming response has started
+        if format in copystream.COPY_OPTIONS:
+            stream = copystream.CopyStream(
+                eventdb_pool, prep, format,
+                statement_timeout=endpoint_timeout('export'),
+                watcher=watcher)
+            stream.prime()
+            content_type = copystream.CONTENT_TYPES[format]
+        else:
+            batches = query_batches(
+                prep, statement_timeout=endpoint_timeout('export'),
+                watcher=watcher)
+            first_batch = next(batches, [])
+            stream = jsonstream.ChunkStream(
+                jsonstream.FORMATTERS[format](first_batch, batches))
+            content_type = jsonstream.CONTENT_TYPES[format]
     except psycopg2.Error as e:
         log.error(e)
-        __rollback_transaction()
+        if e.pgcode == errorcodes.UNDEFINED_COLUMN:
+            response.status = HTTP_BAD_REQUEST
+            return {"error": "At least one of the fields does not exist."}
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "The query could not be processed."}
 
+    response.content_type = content_type
+    return stream
+
 
 def main():
     """ Main function of this module
@@ -766,8 +1347,7 @@ def main():
     print("log effective level = \"{}\"".format(
         logging.getLevelName(log.getEffectiveLevel())))
 
-    global eventdb_conn
-    eventdb_conn = open_db_connection(config["libpg conninfo"])
+    open_db_pool(config["libpg conninfo"], config.get("connection pool"))
 
     # TODO: Maybe add a search interface for the CLI
     # params={'t.o_after': '2017-03-01', 's.ip_in_sn': '31.25.41.74'}
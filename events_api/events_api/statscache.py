@@ -0,0 +1,224 @@
+"""Cache for the event statistics of the events_api.
+
+The statistics count events per time bucket (hour, day, week or month).
+A bucket which closed well in the past will not change anymore,
+so its count is kept and only the buckets at the edges of the
+requested time range and the recent ones are queried again.
+
+The buckets are computed with naive datetimes, which are taken to be
+in the time zone of the database session, like date_trunc() does.
+So the current time given to plan() must be the one of the database
+session, too.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import copy
+import datetime
+import threading
+
+
+# Defaults for the "stats cache" section of the configuration file.
+DEFAULT_SETTINGS = {
+    "max_entries": 256,
+    "max_buckets": 100000,
+    "settle_seconds": 86400,
+}
+
+
+def truncate(dt: datetime.datetime, timeres: str) -> datetime.datetime:
+    """Returns the start of the bucket containing `dt`, like date_trunc()."""
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if timeres == 'hour':
+        return dt
+    dt = dt.replace(hour=0)
+    if timeres == 'day':
+        return dt
+    if timeres == 'week':
+        # weeks start on monday (ISO 8601), like in postgresql
+        return dt - datetime.timedelta(days=dt.weekday())
+    if timeres == 'month':
+        return dt.replace(day=1)
+    raise ValueError('Unknown time resolution {!r}.'.format(timeres))
+
+
+def next_bucket(start: datetime.datetime, timeres: str) -> datetime.datetime:
+    """Returns the start of the bucket following the one at `start`."""
+    if timeres == 'hour':
+        return start + datetime.timedelta(hours=1)
+    if timeres == 'day':
+        return start + datetime.timedelta(days=1)
+    if timeres == 'week':
+        return start + datetime.timedelta(days=7)
+    if timeres == 'month':
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    raise ValueError('Unknown time resolution {!r}.'.format(timeres))
+
+
+def buckets(after: datetime.datetime, before: datetime.datetime,
+            timeres: str):
+    """Yields (start, end) of the buckets overlapping the range."""
+    start = truncate(after, timeres)
+    while start < before:
+        end = next_bucket(start, timeres)
+        yield start, end
+        start = end
+
+
+def _bucket_key(value: datetime.datetime) -> datetime.datetime:
+    # date_trunc() of a timestamptz column is returned with the offset
+    # of the session time zone, so its wall time is the bucket start.
+    return value.replace(tzinfo=None)
+
+
+class StatsCache:
+    """Thread-safe LRU cache of the per bucket counts of statistics.
+
+    An entry holds the counts for one set of filters and time resolution.
+    Only buckets which are completely inside the requested range and
+    ended at least `settle_seconds` ago are cached.
+
+    At most `max_entries` entries with at most `max_buckets` buckets
+    altogether are kept. If a single entry has more buckets, the ones
+    stored first are dropped.
+    """
+
+    def __init__(self, max_entries: int=256, settle_seconds: float=86400,
+                 max_buckets: int=100000):
+        self.max_entries = max_entries
+        self.max_buckets = max_buckets
+        self.settle = datetime.timedelta(seconds=settle_seconds)
+
+        self._entries = collections.OrderedDict()
+        self._buckets = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def plan(self, key, after: datetime.datetime,
+             before: datetime.datetime, timeres: str,
+             now: datetime.datetime):
+        """Finds the cached buckets and the time ranges still to be queried.
+
+        The requested range excludes both `after` and `before`,
+        like the subqueries `time-observation_after` and `_before`.
+
+        Returns:
+            A tuple (rows, ranges, cacheable) of the cached result rows,
+            a list of (start, start_included, end) ranges to be queried
+            and the starts of the buckets to be stored with store().
+        """
+        closed_before = now - self.settle
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            else:
+                entry = {}
+
+            rows = []
+            ranges = []
+            cacheable = []
+            hits = 0
+            for start, end in buckets(after, before, timeres):
+                complete = start > after and end <= before
+                if complete and start in entry:
+                    hits += 1
+                    if entry[start] is not None:
+                        rows.append(copy.copy(entry[start]))
+                    continue
+
+                if complete and end <= closed_before:
+                    cacheable.append(start)
+
+                range_start, included = (start, True) if start > after \
+                    else (after, False)
+                range_end = min(end, before)
+                if ranges and ranges[-1][2] == range_start:
+                    # extend the previous range
+                    ranges[-1] = (ranges[-1][0], ranges[-1][1], range_end)
+                else:
+                    ranges.append((range_start, included, range_end))
+
+            self.hits += hits
+            self.misses += len(cacheable)
+
+        return rows, ranges, cacheable
+
+    def store(self, key, cacheable, rows):
+        """Stores the counts of closed buckets queried after plan().
+
+        Args:
+            key: the key given to plan()
+            cacheable: the bucket starts returned by plan()
+            rows: the result rows of the queries, dicts
+                with the keys 'date_trunc' and 'count'
+        """
+        if not cacheable or not self.enabled:
+            return
+
+        found = {_bucket_key(row['date_trunc']): row for row in rows}
+
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            self._entries.move_to_end(key)
+            self._buckets -= len(entry)
+            for start in cacheable:
+                # None marks a bucket without events
+                row = found.get(start)
+                entry[start] = copy.copy(row) if row is not None else None
+            self._buckets += len(entry)
+
+            # the entry of `key` is the most recently used, it is last
+            while len(self._entries) > self.max_entries or (
+                    self._buckets > self.max_buckets
+                    and len(self._entries) > 1):
+                _, evicted = self._entries.popitem(last=False)
+                self._buckets -= len(evicted)
+                self.evictions += 1
+
+            for start in list(entry)[:max(self._buckets - self.max_buckets,
+                                          0)]:
+                del entry[start]
+                self._buckets -= 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets = 0
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'buckets': self._buckets,
+                'max_buckets': self.max_buckets,
+                'settle_seconds': self.settle.total_seconds(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,167 @@
+"""Route the queries of the events_api to the tables of their time range.
+
+The events may be kept in several tables, e.g. one with the recent
+events and archive tables per month. Each tier of the configuration
+names a table and the range of "time.observation" of its events:
+
+    "table tiers": [
+        {"table": "events_hot", "from": "100 days ago"},
+        {"table": "events_2018_03", "from": "2018-03-01", "until": "2018-04-01"},
+        {"table": "events_archive", "until": "2018-03-01"}
+    ]
+
+`from` is included, `until` excluded, a missing bound is open.
+A query only reads the tables overlapping the time range of its
+subqueries, all of them combined with UNION ALL. The ranges are only
+used to leave tables out, so they may overlap, e.g. while events are
+moved to the archive. All tables need the same columns in the same order
+and ids unique over all tables.
+
+The bounds are compared as naive datetimes, with a margin of a day
+for the time zones.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import datetime
+import re
+
+import dateutil.parser
+
+
+# Conditions of the subqueries limiting "time.observation".
+LOWER_BOUNDS = ('"time.observation" > %s', '"time.observation" >= %s')
+UPPER_BOUNDS = ('"time.observation" < %s', '"time.observation" <= %s')
+
+# Allowed table names, optionally with the schema.
+TABLE_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*'
+                                r'(\.[A-Za-z_][A-Za-z0-9_]*)?$')
+
+RELATIVE_TIME_PATTERN = re.compile(r'^(\d+) days? ago$')
+
+MARGIN = datetime.timedelta(days=1)
+
+
+def parse_time(value, now: datetime.datetime):
+    """Returns `value` as naive datetime, None for an open bound.
+
+    Args:
+        value: a datetime, a string parsed by dateutil or "N days ago"
+        now: the time relative bounds are computed from
+
+    Raises:
+        ValueError: if the string is not a valid time.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, datetime.datetime):
+        match = RELATIVE_TIME_PATTERN.match(str(value).strip())
+        if match:
+            return now - datetime.timedelta(days=int(match.group(1)))
+        value = dateutil.parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def time_range(q) -> tuple:
+    """Returns the (after, before) bounds of the subqueries.
+
+    Args:
+        q: An array of Tuples created with query_build_query
+
+    Returns: naive datetimes or None for open bounds, also for values
+        which cannot be parsed, as the query fails for them anyway.
+    """
+    after = before = None
+    for condition, value in q:
+        if condition not in LOWER_BOUNDS + UPPER_BOUNDS:
+            continue
+        try:
+            value = parse_time(value, datetime.datetime.now())
+        except (ValueError, OverflowError):
+            continue
+        if condition in LOWER_BOUNDS:
+            if after is None or value > after:
+                after = value
+        elif before is None or value < before:
+            before = value
+    return after, before
+
+
+class Tiers:
+    """The tables of the events and the time ranges they hold."""
+
+    def __init__(self, tiers: list, alias: str='events'):
+        """
+        Args:
+            tiers: dicts with the keys `table`, `from` and `until`,
+                the first is used if no table matches the time range
+            alias: the name of the combined tables in the queries
+
+        Raises:
+            ValueError: if the tiers are not valid.
+        """
+        if not tiers:
+            raise ValueError('At least one table tier is needed.')
+        for tier in tiers:
+            if not TABLE_NAME_PATTERN.match(tier.get('table', '')):
+                raise ValueError('The table name of the tier {!r} is not'
+                                 ' valid.'.format(tier))
+            for key in ('from', 'until'):
+                parse_time(tier.get(key), datetime.datetime.now())
+        self.tiers = tiers
+        self.alias = alias
+
+    def tables(self, after, before, now: datetime.datetime=None) -> list:
+        """Returns the tables overlapping the time range.
+
+        Args:
+            after: naive datetime or None
+            before: naive datetime or None
+            now: the time relative bounds are computed from
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        tables = []
+        for tier in self.tiers:
+            start = parse_time(tier.get('from'), now)
+            end = parse_time(tier.get('until'), now)
+            if before is not None and start is not None \
+                    and before <= start - MARGIN:
+                continue
+            if after is not None and end is not None \
+                    and after >= end + MARGIN:
+                continue
+            tables.append(tier['table'])
+        # the query finds nothing, but still needs a table
+        return tables or [self.tiers[0]['table']]
+
+    def relation(self, q, now: datetime.datetime=None) -> str:
+        """Returns the table or subquery to select the events from.
+
+        Args:
+            q: An array of Tuples created with query_build_query
+            now: the time relative bounds are computed from
+        """
+        tables = self.tables(*time_range(q), now=now)
+        if len(tables) == 1:
+            return tables[0]
+        return "(" + " UNION ALL ".join("SELECT * FROM " + table
+                                        for table in tables) \
+            + ") AS " + self.alias
@@ -14,6 +14,7 @@ setup(
 
     packages=find_packages(),
 
-    install_requires=['hug', 'psycopg2', 'python-dateutil'],
+    install_requires=['hug', 'psycopg2', 'python-dateutil',
+                      'intelmq-fody-backend'],
 
 )
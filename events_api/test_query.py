@@ -0,0 +1,364 @@
+"""Tests for building the queries of the events_api.
+
+Copyright (C) 2017 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import base64
+import datetime
+import json
+import sqlite3
+import unittest
+from unittest import mock
+
+from intelmq_fody_backend import querycompiler
+
+from events_api import indexes, rollup, serve, statscache
+
+
+class FakeCursor:
+    def __init__(self):
+        self.connection = self
+        self.statements = []
+
+    def execute(self, operation, parameters=None):
+        self.statements.append((operation, parameters))
+
+    def fetchone(self):
+        return None
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        serve.QUERY_TABLE_NAME = 'events'
+
+    def test_page_cursor_roundtrip(self):
+        row = {'time.observation': datetime.datetime(
+                   2017, 3, 1, 12, 30, tzinfo=datetime.timezone.utc),
+               'id': 4711}
+
+        token = serve.encode_page_cursor(row)
+
+        self.assertEqual(serve.decode_page_cursor(token),
+                         ('2017-03-01T12:30:00+00:00', 4711))
+
+    def test_page_cursor_invalid(self):
+        for token in ['', 'no token', 'WzFd']:  # 'WzFd' is "[1]"
+            with self.assertRaises(ValueError):
+                serve.decode_page_cursor(token)
+
+        for values in [[{'a': 1}, 5], ['2017-03-01', [5]],
+                       ['2017-03-01', '5'], ['2017-03-01', True],
+                       ['2017-03-01', 2**64], ['no time', 5], [None, 5]]:
+            token = base64.urlsafe_b64encode(
+                json.dumps(values).encode('utf-8')).decode('ascii')
+            with self.assertRaises(ValueError):
+                serve.decode_page_cursor(token)
+
+    def test_prepare_page(self):
+        querylist = serve.query_build_query({'source-asn_is': 123})
+        querylist.append((serve.QUERY_PAGE_KEYSET, ('2017-03-01', 5)))
+
+        q_string, params = serve.query_prepare_page(
+            serve.query_prepare_export(querylist), 50)
+
+        self.assertEqual(
+            q_string,
+            'SELECT * FROM events WHERE "source.asn" = %s'
+            ' AND ("time.observation", id) < %s'
+            ' ORDER BY "time.observation" DESC, id DESC LIMIT %s')
+        self.assertEqual(params, [123, ('2017-03-01', 5), 51])
+
+    def test_prepare_json(self):
+        querylist = serve.query_build_query({'source-asn_is': 123})
+        prepared = serve.query_prepare_export(querylist)
+
+        q_string, params = serve.query_prepare_json(
+            serve.query_prepare_page(prepared, 50), paged=True)
+
+        self.assertEqual(
+            q_string,
+            'SELECT json_strip_nulls(row_to_json(e))::text AS json,'
+            ' e."time.observation", e."id"'
+            ' FROM (SELECT * FROM events WHERE "source.asn" = %s'
+            ' ORDER BY "time.observation" DESC, id DESC LIMIT %s) AS e'
+            ' ORDER BY e."time.observation" DESC, e.id DESC')
+        self.assertEqual(params, [123, 51])
+
+        # still PREPAREd, as another statement
+        unpaged = serve.query_prepare_json(prepared)
+        self.assertIsNotNone(unpaged.name)
+        self.assertNotEqual(unpaged.name, prepared.name)
+
+    def test_multiple_values(self):
+        querylist = serve.query_build_query(
+            {'source-asn_in': '64496, 64497,64498'})
+
+        q_string, params = serve.query_prepare_export(querylist)
+
+        self.assertEqual(
+            q_string,
+            'SELECT * FROM events'
+            ' WHERE "source.asn" = ANY(%s::text[]::integer[])')
+        self.assertEqual(params, [['64496', '64497', '64498']])
+
+    def test_multiple_values_empty(self):
+        for value, expected in [('', []), ('64496,, ', ['64496']),
+                                (['', '64497'], ['64497'])]:
+            self.assertEqual(
+                serve.query_build_subquery('source-asn_in', value)[1],
+                expected)
+
+    def test_array_parameters(self):
+        # psycopg2 sends lists of strings as text[], EXECUTE of a PREPAREd
+        # statement only coerces them if the parameter is text[], too
+        for name, subquery in serve.QUERY_EVENT_SUBQUERY.items():
+            if 'ANY(' in subquery['sql']:
+                self.assertIn('ANY(%s::text[]', subquery['sql'], name)
+
+    def test_execute_array_parameter(self):
+        compiler = querycompiler.QueryCompiler(prepared_statements=True)
+        querylist = serve.query_build_query({'source-asn_in': '64496,64497',
+                                             'feed-name_is': 'Spamhaus'})
+        with mock.patch.object(serve, 'QUERY_COMPILER', compiler):
+            prepared = serve.query_prepare_export(querylist)
+        cur = FakeCursor()
+
+        compiler.execute(cur, prepared)
+
+        self.assertEqual(cur.statements, [
+            (querycompiler.PREPARED_QUERY, (prepared.name, )),
+            ('PREPARE {} AS SELECT * FROM events WHERE "feed.name" = $1'
+             ' AND "source.asn" = ANY($2::text[]::integer[])'
+             ''.format(prepared.name), None),
+            ('EXECUTE {} (%s, %s)'.format(prepared.name),
+             ['Spamhaus', ['64496', '64497']])])
+
+    def test_prepare_count(self):
+        querylist = serve.query_build_query({'source-asn_is': 123})
+
+        self.assertEqual(
+            serve.query_prepare_count(querylist),
+            ('SELECT count(*) AS count FROM events'
+             ' WHERE "source.asn" = %s', [123]))
+        self.assertEqual(
+            serve.query_prepare_count(querylist, 1000),
+            ('SELECT count(*) AS count FROM (SELECT 1 FROM events'
+             ' WHERE "source.asn" = %s LIMIT %s) AS matches', [123, 1000]))
+
+    def test_plan_rows(self):
+        rows = [{'QUERY PLAN': '[{"Plan": {"Node Type": "Seq Scan",'
+                               ' "Plan Rows": 4711}}]'}]
+        self.assertEqual(serve.plan_rows(rows), 4711)
+
+    def test_stats_slices(self):
+        after = datetime.datetime(2017, 1, 15)
+        before = datetime.datetime(2017, 3, 10)
+
+        self.assertEqual(
+            serve.query_stats_slices([(after, False, before)], 'month'),
+            [(after, False, datetime.datetime(2017, 2, 1)),
+             (datetime.datetime(2017, 2, 1), True,
+              datetime.datetime(2017, 3, 1)),
+             (datetime.datetime(2017, 3, 1), True, before)])
+
+    def test_stats_cache_uses_database_time(self):
+        cache = statscache.StatsCache(settle_seconds=3600)
+        params = {'time-observation_after': datetime.datetime(2018, 3, 1, 12),
+                  'time-observation_before': datetime.datetime(2018, 3, 5, 12),
+                  'malware-name_is': 'nymaim'}
+        # the session of the database is some hours behind this host
+        db_now = [{'now': datetime.datetime(2018, 3, 4, 12)}]
+
+        with mock.patch.object(serve, 'STATS_CACHE', cache), \
+                mock.patch.object(serve, 'query', return_value=db_now), \
+                mock.patch.object(serve, 'query_stats_ranges',
+                                  return_value=[]):
+            serve.query_stats(params, 'day')
+
+        # 2018-03-04 is not over in the database yet
+        self.assertEqual(cache.info()['misses'], 2)
+
+    def test_rollup_covers(self):
+        params = {'time-observation_after': datetime.datetime(2017, 3, 1),
+                  'time-observation_before': datetime.datetime(2017, 4, 1),
+                  'malware-name_is': 'nymaim'}
+        self.assertTrue(rollup.covers(params))
+
+        self.assertFalse(rollup.covers(dict(params, **{
+            'time-observation_before': datetime.datetime(2017, 4, 1, 0, 30)
+            })))
+        self.assertFalse(rollup.covers(dict(params, **{
+            'source-asn_is': 123})))
+
+        india = datetime.timezone(datetime.timedelta(hours=5, minutes=30))
+        self.assertFalse(rollup.covers(dict(params, **{
+            'time-observation_after': datetime.datetime(2017, 3, 1,
+                                                        tzinfo=india)
+            })))
+
+    def test_rollup_prepare_stats(self):
+        querylist = serve.query_build_query({'malware-name_is': 'nymaim'})
+
+        q_string, params = rollup.query_prepare_stats(
+            querylist, 'day', '2017-03-01', '2017-04-01',
+            'events', 'events_hourly')
+
+        self.assertIn('UNION ALL', q_string)
+        self.assertEqual(q_string.count('%s'), len(params))
+        self.assertEqual(params, ['nymaim', '2017-03-01', '2017-04-01',
+                                  'nymaim', '2017-03-01',
+                                  'nymaim', '2017-03-01', '2017-04-01'])
+
+    def test_rollup_refresh(self):
+        statements = []
+        # max(id), then the last_id before and after the batch
+        rows = iter([(10, ), (0, ), (10, )])
+
+        class Cursor:
+            def execute(self, operation, parameters=None):
+                statements.append(operation)
+
+            def fetchone(self):
+                return next(rows)
+
+        class Connection:
+            def cursor(self):
+                return Cursor()
+
+            def commit(self):
+                pass
+
+            def rollback(self):
+                pass
+
+        relation = rollup.events_relation({'table tiers': [
+            {'table': 'events', 'from': '100 days ago'},
+            {'table': 'events_archive', 'until': '100 days ago'}]})
+        self.assertEqual(rollup.refresh(Connection(), relation,
+                                        'events_hourly'), 10)
+
+        self.assertEqual(statements[0], 'SET TIME ZONE %s')
+        self.assertIn('FROM (SELECT * FROM events UNION ALL'
+                      ' SELECT * FROM events_archive) AS events',
+                      statements[1])
+        insert = [s for s in statements if 'INSERT' in s][0]
+        self.assertIn('"time.observation" IS NOT NULL', insert)
+        self.assertIn('events_archive', insert)
+        self.assertEqual(rollup.events_relation({}), 'events')
+
+    def test_rollup_boundary(self):
+        # an event at exactly `after` is excluded by both routes
+        db = sqlite3.connect(':memory:')
+        db.create_function('date_trunc', 2,
+                           lambda interval, time: time[:10] + ' 00:00:00')
+        db.executescript("""
+            CREATE TABLE events (id, "time.observation", "malware.name");
+            CREATE TABLE events_hourly ("time.observation", "malware.name",
+                                        count);
+            CREATE TABLE events_hourly_state (last_id);
+            INSERT INTO events VALUES
+                (1, '2017-03-01 00:00:00', 'nymaim'),
+                (2, '2017-03-01 00:30:00', 'nymaim'),
+                (3, '2017-03-01 00:00:00', 'nymaim'),
+                (4, '2017-03-01 01:00:00', 'nymaim');
+            INSERT INTO events_hourly VALUES
+                ('2017-03-01 00:00:00', 'nymaim', 2);
+            INSERT INTO events_hourly_state VALUES (2);
+            """)
+
+        def counts(q_string, params):
+            q_string = (q_string.replace('%s', '?').replace('::bigint', '')
+                        .replace('ORDER BY date_trunc', 'ORDER BY 1'))
+            return db.execute(q_string, params).fetchall()
+
+        querylist = serve.query_build_query({'malware-name_is': 'nymaim'})
+        after, before = '2017-03-01 00:00:00', '2017-03-02 00:00:00'
+        events = counts(*serve.query_prepare_stats(querylist + [
+            ('"time.observation" > %s', after),
+            ('"time.observation" < %s', before)]))
+        self.assertEqual(events, [('2017-03-01 00:00:00', 2)])
+        self.assertEqual(counts(*rollup.query_prepare_stats(
+            querylist, 'day', after, before, 'events', 'events_hourly')),
+            events)
+
+    def test_prepare_grouped_stats(self):
+        querylist = serve.query_build_query({'malware-name_is': 'nymaim'})
+
+        q_string, params = serve.query_prepare_grouped_stats(
+            querylist, 'day', 'feed.name', 5)
+
+        self.assertIn('"feed.name" AS value', q_string)
+        self.assertEqual(q_string.count('%s'), len(params))
+        self.assertEqual(params, ['nymaim', 5])
+
+        with self.assertRaises(ValueError):
+            serve.query_prepare_grouped_stats(querylist, 'day', 'raw', 5)
+
+    def test_group_series(self):
+        day1 = datetime.datetime(2017, 3, 1)
+        day2 = datetime.datetime(2017, 3, 2)
+        rows = [
+            {'date_trunc': day1, 'value': 'a', 'other': False, 'count': 1},
+            {'date_trunc': day1, 'value': 'b', 'other': False, 'count': 5},
+            {'date_trunc': day1, 'value': None, 'other': True, 'count': 2},
+            {'date_trunc': day2, 'value': 'a', 'other': False, 'count': 3},
+        ]
+
+        groups, other, results = serve.stats_group_series(rows)
+
+        self.assertEqual([(group['value'], group['total'])
+                          for group in groups], [('b', 5), ('a', 4)])
+        self.assertEqual(other, {'total': 2, 'results': [
+            {'date_trunc': day1, 'count': 2}]})
+        self.assertEqual(results, [{'date_trunc': day1, 'count': 8},
+                                   {'date_trunc': day2, 'count': 3}])
+
+    def test_pattern_subqueries(self):
+        querylist = serve.query_build_query({
+            'feed-name_prefix': 'Spam_haus',
+            'source-fqdn_suffix': '.example',
+            'malware-name_contains': '100%'})
+
+        self.assertEqual(querylist, [
+            ('"feed.name" LIKE %s', 'Spam\\_haus%'),
+            ('"source.fqdn" LIKE %s', '%.example'),
+            ('"malware.name" LIKE %s', '%100\\%%')])
+
+    def test_index_statements(self):
+        statements = indexes.index_statements('events', ['feed.name'])
+
+        self.assertEqual(statements[1:], [
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS'
+            ' events_feed_name_pattern_idx'
+            ' ON events ("feed.name" text_pattern_ops);',
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS'
+            ' events_feed_name_trgm_idx'
+            ' ON events USING gin ("feed.name" gin_trgm_ops);'])
+
+        self.assertEqual(
+            indexes.index_statements(indexes.TICKETS_TABLE,
+                                     indexes.TICKETS_COLUMNS,
+                                     create_extension=False)[1],
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS'
+            ' directives_recipient_address_trgm_idx'
+            ' ON directives USING gin ("recipient_address" gin_trgm_ops);')
+
+    def test_index_events_tables(self):
+        self.assertEqual(indexes.events_tables({}), ['events'])
+        self.assertEqual(indexes.events_tables({'table tiers': [
+            {'table': 'events', 'from': '100 days ago'},
+            {'table': 'events_archive', 'until': '100 days ago'}]}),
+            ['events', 'events_archive'])
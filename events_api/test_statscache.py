@@ -0,0 +1,103 @@
+"""Tests for the cache of the event statistics.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import datetime
+import unittest
+
+from events_api import statscache
+
+
+def dt(*args):
+    return datetime.datetime(*args)
+
+
+class Tests(unittest.TestCase):
+    def test_buckets(self):
+        self.assertEqual(statscache.truncate(dt(2018, 3, 8, 13, 5), 'week'),
+                         dt(2018, 3, 5))
+        self.assertEqual(
+            list(statscache.buckets(dt(2017, 11, 20), dt(2018, 1, 2),
+                                    'month')),
+            [(dt(2017, 11, 1), dt(2017, 12, 1)),
+             (dt(2017, 12, 1), dt(2018, 1, 1)),
+             (dt(2018, 1, 1), dt(2018, 2, 1))])
+
+    def test_plan_and_reuse(self):
+        cache = statscache.StatsCache(max_entries=2, settle_seconds=3600)
+        after, before = dt(2018, 3, 1, 12), dt(2018, 3, 5, 12)
+        now = dt(2018, 3, 5, 13)
+
+        rows, ranges, cacheable = cache.plan('k', after, before, 'day', now)
+        self.assertEqual(rows, [])
+        self.assertEqual(ranges, [(after, False, before)])
+        self.assertEqual(cacheable, [dt(2018, 3, 2), dt(2018, 3, 3),
+                                     dt(2018, 3, 4)])
+
+        cache.store('k', cacheable,
+                    [{'date_trunc': dt(2018, 3, 2), 'count': 7},
+                     {'date_trunc': dt(2018, 3, 4), 'count': 3}])
+
+        rows, ranges, cacheable = cache.plan('k', after, before, 'day', now)
+        self.assertEqual(rows, [{'date_trunc': dt(2018, 3, 2), 'count': 7},
+                                {'date_trunc': dt(2018, 3, 4), 'count': 3}])
+        # only the buckets at the edges are queried again
+        self.assertEqual(ranges, [(after, False, dt(2018, 3, 2)),
+                                  (dt(2018, 3, 5), True, before)])
+        self.assertEqual(cacheable, [])
+        self.assertEqual(cache.info()['hits'], 3)
+        self.assertEqual(cache.info()['misses'], 3)
+
+    def test_recent_buckets_are_not_cached(self):
+        cache = statscache.StatsCache(settle_seconds=86400)
+        rows, ranges, cacheable = cache.plan(
+            'k', dt(2018, 3, 1), dt(2018, 3, 5), 'day', dt(2018, 3, 5, 12))
+
+        self.assertEqual(cacheable, [dt(2018, 3, 2), dt(2018, 3, 3)])
+
+    def test_lru_eviction(self):
+        cache = statscache.StatsCache(max_entries=2)
+        for key in ('a', 'b', 'a', 'c'):
+            rows, ranges, cacheable = cache.plan(
+                key, dt(2017, 1, 1), dt(2017, 1, 4), 'day', dt(2018, 1, 1))
+            cache.store(key, cacheable, [])
+
+        rows, ranges, cacheable = cache.plan(
+            'b', dt(2017, 1, 1), dt(2017, 1, 4), 'day', dt(2018, 1, 1))
+        self.assertEqual(len(cacheable), 2)
+        self.assertEqual(cache.info()['evictions'], 1)
+
+    def test_bucket_limit(self):
+        cache = statscache.StatsCache(max_buckets=4)
+        now = dt(2018, 1, 1)
+        for key, day in (('a', 1), ('b', 1), ('b', 10)):
+            rows, ranges, cacheable = cache.plan(
+                key, dt(2017, 1, day), dt(2017, 1, day + 3), 'day', now)
+            cache.store(key, cacheable, [])
+
+        # 'a' is evicted for the buckets of 'b'
+        self.assertEqual(cache.info()['entries'], 1)
+        self.assertEqual(cache.info()['buckets'], 4)
+
+        # a single entry keeps the buckets stored last
+        rows, ranges, cacheable = cache.plan(
+            'b', dt(2017, 1, 20), dt(2017, 1, 24), 'day', now)
+        cache.store('b', cacheable, [])
+        self.assertEqual(cache.info()['buckets'], 4)
+        rows, ranges, cacheable = cache.plan(
+            'b', dt(2017, 1, 10), dt(2017, 1, 13), 'day', now)
+        self.assertEqual(cacheable, [dt(2017, 1, 11)])
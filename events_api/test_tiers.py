@@ -0,0 +1,70 @@
+"""Tests for routing the queries to the tables of their time range.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import datetime
+import unittest
+
+from events_api import tiers
+
+NOW = datetime.datetime(2018, 6, 15, 12)
+
+TIERS = [
+    {"table": "events_hot", "from": "100 days ago"},
+    {"table": "events_2018_03", "from": "2018-03-01", "until": "2018-04-01"},
+    {"table": "events_archive", "until": "2018-03-01"},
+]
+
+
+def after(value):
+    return ('"time.observation" > %s', value)
+
+
+def before(value):
+    return ('"time.observation" < %s', value)
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.tiers = tiers.Tiers(TIERS)
+
+    def test_recent(self):
+        self.assertEqual(
+            self.tiers.relation([after('2018-06-01'),
+                                 ('"source.asn" = %s', 123)], NOW),
+            'events_hot')
+
+    def test_spanning(self):
+        self.assertEqual(
+            self.tiers.relation([after('2018-02-20'),
+                                 before(datetime.datetime(2018, 3, 5))],
+                                NOW),
+            '(SELECT * FROM events_2018_03'
+            ' UNION ALL SELECT * FROM events_archive) AS events')
+
+    def test_open_range(self):
+        self.assertEqual(self.tiers.tables(None, None, NOW),
+                         ['events_hot', 'events_2018_03', 'events_archive'])
+
+    def test_time_zone(self):
+        self.assertEqual(
+            tiers.time_range([after('2018-03-01T02:00:00+02:00')]),
+            (datetime.datetime(2018, 3, 1), None))
+
+    def test_invalid_table(self):
+        with self.assertRaises(ValueError):
+            tiers.Tiers([{"table": "events; DROP TABLE events"}])
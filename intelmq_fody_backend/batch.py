@@ -0,0 +1,162 @@
+"""Run several API requests in one HTTP round trip.
+
+Each item of a batch names an API, one of its endpoints and the
+query parameters. The items are passed through the WSGI application
+in-process, so they get the same validation and error handling as
+separate requests, and run concurrently in threads of the batch,
+each borrowing its own database connection.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import concurrent.futures
+import io
+import json
+import logging
+import time
+from urllib.parse import urlencode
+import wsgiref.util
+
+
+log = logging.getLogger(__name__)
+
+# Defaults for the "batch" section of the configuration file:
+# the maximal number of items of one batch and the number of items
+# of a batch run concurrently.
+DEFAULT_SETTINGS = {
+    "max_items": 20,
+    "workers": 4,
+}
+
+
+def _sub_environ(environ: dict, path: str, query_string: str) -> dict:
+    """Returns the WSGI environment of a GET request for `path`."""
+    if environ is None:
+        sub_environ = {}
+        wsgiref.util.setup_testing_defaults(sub_environ)
+    else:
+        sub_environ = dict(environ)
+    # the body of the batch request is not handed on
+    sub_environ.pop('CONTENT_TYPE', None)
+    sub_environ.pop('CONTENT_LENGTH', None)
+    sub_environ.update({
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'wsgi.input': io.BytesIO(),
+    })
+    return sub_environ
+
+
+def call(app, path: str, params: dict, environ: dict=None):
+    """Calls a GET endpoint of a WSGI application in-process.
+
+    Args:
+        app: the WSGI application
+        path: the path of the endpoint
+        params: the query parameters, values may be lists
+        environ: the WSGI environment of the batch request, its server
+            and client entries are handed on, e.g. the socket of the
+            client to cancel queries if it goes away
+
+    Returns:
+        A tuple of the HTTP status code and the decoded body.
+    """
+    sub_environ = _sub_environ(environ, path, urlencode(params, True))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = dict((k.lower(), v) for k, v in headers)
+
+    chunks = app(sub_environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+    if 'json' in started['headers'].get('content-type', ''):
+        data = json.loads(body.decode('utf-8')) if body else None
+    else:
+        data = body.decode('utf-8')
+    return started['status'], data
+
+
+def _run_item(app, path: str, params: dict, environ: dict) -> dict:
+    start = time.monotonic()
+    try:
+        status, data = call(app, path, params, environ)
+    except Exception as err:
+        log.exception("Batch item %s failed.", path)
+        status, data = 500, {"error": str(err)}
+    result = {"status": status,
+              "duration_ms": round((time.monotonic() - start) * 1000, 1)}
+    if 200 <= status < 300:
+        result["result"] = data
+    elif isinstance(data, dict):
+        # the sub-APIs report errors as "error" or "reason"
+        result["error"] = data.get("error", data.get("reason", data))
+    else:
+        result["error"] = data
+    return result
+
+
+def run(app, items: list, resolve, environ: dict=None,
+        workers: int=DEFAULT_SETTINGS["workers"]) -> list:
+    """Runs the items of a batch concurrently.
+
+    Each batch has its own threads, so a slow batch does not hold up
+    the others.
+
+    Args:
+        app: the WSGI application
+        items: dicts with the keys `api`, `endpoint` and `params`
+        resolve: callable returning the path for (api, endpoint)
+            or raising ValueError if the endpoint may not be used
+        environ: the WSGI environment of the batch request
+        workers: the number of items run concurrently
+
+    Returns:
+        A result dict per item in the same order, with the `status`,
+        the `duration_ms` and either the `result` or the `error`.
+    """
+    results = [None] * len(items)
+    calls = {}
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("An item must be an object.")
+            params = item.get("params") or {}
+            if not isinstance(params, dict):
+                raise ValueError("The params must be an object.")
+            calls[index] = (resolve(item.get("api"), item.get("endpoint")),
+                            params)
+        except ValueError as err:
+            results[index] = {"status": 400, "error": str(err),
+                              "duration_ms": 0}
+
+    if calls:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(workers, len(calls))) as executor:
+            futures = {index: executor.submit(_run_item, app, path, params,
+                                              environ)
+                       for index, (path, params) in calls.items()}
+            for index, future in futures.items():
+                results[index] = future.result()
+    return results
@@ -0,0 +1,209 @@
+"""Stream the output of COPY ... TO STDOUT to an HTTP response.
+
+PostgreSQL formats the rows itself (e.g. as CSV), the bytes are handed
+to the response as they arrive without building Python objects per row.
+
+psycopg2 only offers a blocking copy_expert() writing into a file,
+so it runs in a separate thread writing into a bounded queue, from which
+the response reads. If the response is not read fast enough, the thread
+waits and with it the database.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import queue
+import threading
+
+import psycopg2
+
+from intelmq_fody_backend import dbpool, disconnect, metrics
+
+
+log = logging.getLogger(__name__)
+
+# Options of the COPY statement for the supported formats.
+COPY_OPTIONS = {
+    'csv': "FORMAT csv, HEADER",
+    'tsv': "FORMAT csv, HEADER, DELIMITER E'\\t'",
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'tsv': 'text/tab-separated-values; charset=utf-8',
+}
+
+# Number of chunks buffered between the database and the response.
+QUEUE_SIZE = 16
+
+_END = object()
+
+
+class _Closed(Exception):
+    """Raised into copy_expert() to abort it after close()."""
+    pass
+
+
+class CopyStream:
+    """File-like object with the output of a COPY ... TO STDOUT statement.
+
+    Call prime() before handing the stream to the response, so errors
+    of the statement can still be answered with an error status.
+    """
+
+    def __init__(self, pool, prepared_query, format: str='csv',
+                 statement_timeout=None, watcher=None):
+        """
+        Args:
+            pool: the dbpool.ConnectionPool to borrow the connection from
+            prepared_query: a (SELECT statement, parameters) tuple
+            format: a key of COPY_OPTIONS
+            statement_timeout: see dbpool.ConnectionPool.transaction(),
+                only limits the time until the first output in prime(),
+                as the statement also waits for the client reading
+                the output
+            watcher: a disconnect.Watcher, stopped when the stream ends
+        """
+        self._pool = pool
+        self._prepared_query = prepared_query
+        self._options = COPY_OPTIONS[format]
+        self._statement_timeout = statement_timeout
+        self._watcher = watcher
+
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._closed = threading.Event()
+        self._error = None
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._chunk = b''
+        self._offset = 0
+        self._done = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="copy-stream")
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with self._pool.transaction(readonly=True) as conn:
+                with self._conn_lock:
+                    self._conn = conn
+                try:
+                    cur = conn.cursor()
+                    # COPY does not take parameters, so they are quoted
+                    # by psycopg2 beforehand.
+                    statement = b"COPY (" \
+                        + cur.mogrify(*self._prepared_query) \
+                        + b") TO STDOUT WITH (" \
+                        + self._options.encode('ascii') + b")"
+                    log.info(statement)
+                    with disconnect.guard(conn, self._watcher):
+                        cur.copy_expert(statement, self)
+                    cur.close()
+                finally:
+                    # the connection goes back to the pool,
+                    # it must not be canceled by close() anymore
+                    with self._conn_lock:
+                        self._conn = None
+        except _Closed:
+            log.info("Stopped COPY as the response was closed.")
+        except Exception as err:
+            # the response may have been closed in between
+            if not self._closed.is_set():
+                self._error = err
+        finally:
+            self._put(_END)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        if item is not _END:
+            raise _Closed()
+
+    def write(self, data):
+        """Called by copy_expert() with the chunks of the output."""
+        if data:
+            self._put(bytes(data))
+
+    def _next_chunk(self, timeout: float=None) -> bool:
+        if self._done:
+            return False
+        chunk = self._queue.get(timeout=timeout)
+        if chunk is _END:
+            self._done = True
+            if self._watcher is not None:
+                self._watcher.stop()
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            return False
+        self._chunk = chunk
+        self._offset = 0
+        return True
+
+    def prime(self):
+        """Waits for the first output, raising errors of the statement.
+
+        Raises:
+            dbpool.StatementTimeout: if there was no output within
+                the `statement_timeout`, the statement is canceled then.
+        """
+        if self._offset >= len(self._chunk):
+            timeout = None
+            if self._statement_timeout:
+                timeout = dbpool.timeout_seconds(self._statement_timeout)
+            try:
+                self._next_chunk(timeout)
+            except queue.Empty:
+                self.close()
+                error = dbpool.StatementTimeout(
+                    "COPY canceled without output after {}".format(
+                        self._statement_timeout))
+                metrics.error(error)
+                raise error
+
+    def read(self, size: int=-1) -> bytes:
+        while self._offset >= len(self._chunk):
+            if not self._next_chunk():
+                return b''
+
+        if size is None or size < 0:
+            end = len(self._chunk)
+        else:
+            end = self._offset + size
+        data = self._chunk[self._offset:end]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        """Stops the COPY statement if it is still running."""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        with self._conn_lock:
+            if self._conn is not None:
+                try:
+                    self._conn.cancel()
+                except psycopg2.Error as err:
+                    log.warning("Could not cancel COPY: %s", err)
+        if self._watcher is not None:
+            self._watcher.stop()
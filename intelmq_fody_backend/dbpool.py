@@ -0,0 +1,426 @@
+"""Pools of database connections shared by the sub-APIs.
+
+Each sub-API borrows a connection from a pool for the duration of
+a request (or a single query) instead of using one global connection.
+Thus the backend can serve several requests in parallel threads.
+
+Sub-APIs that are configured to use the same database share one pool.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from intelmq_fody_backend import metrics
+
+
+log = logging.getLogger(__name__)
+# adding a custom log level for even more details when diagnosing
+DD = logging.DEBUG-2
+logging.addLevelName(DD, "DDEBUG")
+
+# Defaults for the "connection pool" section of the configuration files.
+DEFAULT_SETTINGS = {
+    "minconn": 1,
+    "maxconn": 8,
+    "checkout_timeout": 30,
+    "validate": True,
+}
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class PoolTimeout(Error):
+    """Exception raised if no connection became available in time."""
+    pass
+
+
+class StatementTimeout(Error):
+    """Exception raised if a statement was canceled by statement_timeout."""
+    pass
+
+
+# Units of the time values of PostgreSQL in seconds.
+TIME_UNITS = {'us': 0.000001, 'ms': 0.001, 's': 1, 'min': 60,
+              'h': 3600, 'd': 86400}
+
+
+def timeout_seconds(statement_timeout) -> float:
+    """Returns a value for statement_timeout in seconds.
+
+    Args:
+        statement_timeout: milliseconds or a string with unit like "30s"
+
+    Raises:
+        ValueError: if the value is not valid.
+    """
+    value = str(statement_timeout).strip()
+    number = value.rstrip('abcdefghijklmnopqrstuvwxyz').strip()
+    unit = value[len(number):].strip() or 'ms'
+    if unit not in TIME_UNITS:
+        raise ValueError("Invalid time unit: {!r}".format(statement_timeout))
+    return float(number) * TIME_UNITS[unit]
+
+
+def endpoint_timeout(timeouts: dict, endpoint: str):
+    """ Returns the statement timeout configured for an endpoint
+
+    Args:
+        timeouts: the "statement timeouts" section of the configuration
+        endpoint: name of the endpoint function, e.g. 'search'
+
+    Returns: The value for statement_timeout, or None for no limit.
+
+    """
+    return timeouts.get(endpoint, timeouts.get('default'))
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections.
+
+    At most `maxconn` connections are opened. If all of them are in use,
+    getconn() waits up to `checkout_timeout` seconds for one to be
+    returned and raises PoolTimeout afterwards.
+
+    With `validate` each connection is checked before it is handed out,
+    broken ones (e.g. after a restart of the database) are replaced.
+    """
+
+    def __init__(self, connect, minconn: int=1, maxconn: int=8,
+                 checkout_timeout: float=30, validate: bool=True):
+        """
+        Args:
+            connect: callable without parameters returning a new connection
+        """
+        if not 0 <= minconn <= maxconn or maxconn < 1:
+            raise ValueError("Needs 0 <= minconn <= maxconn and maxconn > 0.")
+
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.validate = validate
+
+        self._idle = []
+        self._size = 0  # number of open connections, idle or in use
+        self._closed = False
+        self._cond = threading.Condition()
+
+        for i in range(minconn):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    @property
+    def size(self) -> int:
+        """Number of open connections."""
+        return self._size
+
+    @property
+    def idle(self) -> int:
+        """Number of connections available for checkout."""
+        return len(self._idle)
+
+    def _is_usable(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if not self.validate:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            if not conn.autocommit:
+                conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            log.info("Discarding broken database connection: %s", err)
+            return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self, wait: bool=True):
+        """Borrows a connection, which must be given back with putconn().
+
+        Args:
+            wait: if False, return None at once if no connection
+                is available instead of waiting for one
+
+        Raises:
+            PoolTimeout: if no connection became available in time.
+        """
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise Error("The connection pool is closed.")
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1  # reserve the slot for a new one
+                        break
+                    if not wait:
+                        return None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        err = PoolTimeout(
+                            "No database connection available after {}s."
+                            "".format(self.checkout_timeout))
+                        metrics.observe_pool_wait(time.monotonic() - start)
+                        metrics.error(err)
+                        raise err
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                log.log(DD, "Opened new connection, pool size = %d",
+                        self._size)
+                metrics.observe_pool_wait(time.monotonic() - start)
+                return conn
+
+            if self._is_usable(conn):
+                metrics.observe_pool_wait(time.monotonic() - start)
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, close: bool=False):
+        """Gives a borrowed connection back.
+
+        An unfinished transaction is rolled back, so the next borrower
+        starts with a clean session.
+        """
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        if close or conn.closed or self._closed:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager borrowing a connection for the `with` block."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    @contextlib.contextmanager
+    def transaction(self, readonly: bool=False, statement_timeout=None,
+                    time_zone: str=None):
+        """Context manager borrowing a connection for one transaction.
+
+        The transaction is committed at the end of the `with` block
+        and rolled back if the block raises, so the connection is
+        never left "idle in transaction".
+
+        Args:
+            readonly: run the transaction as READ ONLY
+            statement_timeout: limit for each statement of the transaction,
+                milliseconds or a string with unit like "30s"
+            time_zone: the TimeZone of the transaction, e.g. "UTC",
+                instead of the one of the session
+
+        Raises:
+            StatementTimeout: if a statement took longer than
+                `statement_timeout`.
+        """
+        conn = self.getconn()
+        close = False
+        try:
+            if readonly:
+                conn.set_session(readonly=True)
+            if statement_timeout:
+                cur = conn.cursor()
+                cur.execute("SET LOCAL statement_timeout = %s",
+                            (statement_timeout,))
+                cur.close()
+            if time_zone:
+                cur = conn.cursor()
+                cur.execute("SET LOCAL TIME ZONE %s", (time_zone,))
+                cur.close()
+            yield conn
+            conn.commit()
+        except psycopg2.extensions.QueryCanceledError as err:
+            if not statement_timeout:
+                metrics.error(err)
+                raise
+            timeout = StatementTimeout(
+                "Statement canceled after {}: {}".format(
+                    statement_timeout, err))
+            metrics.error(timeout)
+            raise timeout from err
+        except psycopg2.Error as err:
+            metrics.error(err)
+            raise
+        finally:
+            try:
+                if conn.get_transaction_status() != \
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if readonly:
+                    conn.set_session(readonly="default")
+            except psycopg2.Error:
+                close = True
+            self.putconn(conn, close)
+
+    def closeall(self):
+        """Closes the idle connections and refuses further checkouts.
+
+        Connections in use are closed when they are given back.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+
+class ThreadConnection:
+    """A connection of a pool bound to the current thread until released.
+
+    Serves code written for a single global connection, which ends
+    each request with a commit or a rollback: the connection is borrowed
+    with the first get() in a thread and given back to the pool
+    by commit(), rollback() or release().
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.pool.getconn()
+            self._local.conn = conn
+        return conn
+
+    def release(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            self.pool.putconn(conn)
+
+    def commit(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            try:
+                conn.commit()
+            finally:
+                self.release()
+
+    def rollback(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            try:
+                conn.rollback()
+            finally:
+                self.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key: str, connect, settings: dict=None) -> ConnectionPool:
+    """Returns the pool for `key`, creating it on first use.
+
+    Args:
+        key: identifies the database, e.g. the libpq connection string
+        connect: callable without parameters returning a new connection
+        settings: overrides for DEFAULT_SETTINGS, used when creating the pool
+
+    Returns:
+        The pool shared by all callers using the same key.
+    """
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool._closed:
+            arguments = dict(DEFAULT_SETTINGS)
+            arguments.update(settings or {})
+            pool = ConnectionPool(connect, **arguments)
+            _pools[key] = pool
+            log.debug("Created connection pool with %r", arguments)
+        return pool
+
+
+def pool_for_dsn(dsn: str, settings: dict=None) -> ConnectionPool:
+    """Returns the shared pool for a libpq connection string."""
+    return get_pool(dsn, lambda: psycopg2.connect(dsn=dsn), settings)
+
+
+def _pool_label(key: str) -> str:
+    """Returns a name for the pool without the password of the dsn."""
+    try:
+        dsn = psycopg2.extensions.parse_dsn(key)
+    except psycopg2.ProgrammingError:
+        return key
+    return "{}@{}".format(dsn.get("dbname", ""), dsn.get("host", ""))
+
+
+def _collect_metrics():
+    with _pools_lock:
+        pools = [(_pool_label(key), pool) for key, pool in _pools.items()]
+    samples = []
+    for label, pool in sorted(pools, key=lambda item: item[0]):
+        idle = pool.idle
+        samples.append(({"pool": label, "state": "idle"}, idle))
+        samples.append(({"pool": label, "state": "in_use"}, pool.size - idle))
+    yield ("fody_pool_connections", "gauge",
+           "Open connections of the database connection pools.", samples)
+
+
+metrics.register_collector(_collect_metrics)
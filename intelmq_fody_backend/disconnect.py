@@ -0,0 +1,227 @@
+"""Cancel database queries of HTTP clients which went away.
+
+While an endpoint waits for the database, a watcher thread polls the
+socket of the client. If the client closed the connection, the running
+queries are canceled, freeing the worker and the database.
+
+This needs the WSGI server to hand out the socket in the environment,
+like gunicorn ("gunicorn.socket") and werkzeug ("werkzeug.socket") do.
+With other servers (e.g. mod_wsgi) queries just run to completion.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import contextlib
+import logging
+import select
+import socket
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from intelmq_fody_backend import metrics
+
+
+log = logging.getLogger(__name__)
+
+# Seconds between two checks of the client socket.
+POLL_INTERVAL = 0.5
+
+# Keys of the WSGI environment which may hold the client socket.
+SOCKET_KEYS = ("gunicorn.socket", "werkzeug.socket")
+
+# HTTP status for the response nobody reads anymore, as used by nginx.
+HTTP_CLIENT_CLOSED_REQUEST = "499 Client Closed Request"
+
+_counters = collections.Counter()
+_counters_lock = threading.Lock()
+_local = threading.local()
+
+
+class ClientDisconnected(Exception):
+    """Exception raised if a query was canceled as the client went away."""
+    pass
+
+
+def _count(name: str):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def counters() -> dict:
+    """Returns the number of `disconnects` and `cancelled_queries`."""
+    with _counters_lock:
+        return {"disconnects": _counters["disconnects"],
+                "cancelled_queries": _counters["cancelled_queries"]}
+
+
+def is_closed(sock) -> bool:
+    """Tests without blocking if the peer closed the socket."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        # readable without data means the peer closed the connection,
+        # data (e.g. a pipelined request) is left for the server
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except ValueError:
+        # ssl.SSLSocket does not take flags, the client may still be there
+        return False
+    except OSError:
+        return True
+
+
+class Watcher:
+    """Polls a client socket and cancels the registered connections.
+
+    Use register() and unregister() around the queries,
+    stop() when the response is done.
+    """
+
+    def __init__(self, sock, interval: float=POLL_INTERVAL):
+        self._sock = sock
+        self._interval = interval
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.disconnected = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="disconnect-watcher")
+
+    @classmethod
+    def for_environ(cls, environ: dict):
+        """Returns a started watcher or None if there is no socket."""
+        for key in SOCKET_KEYS:
+            sock = environ.get(key)
+            if sock is not None:
+                watcher = cls(sock)
+                watcher._thread.start()
+                return watcher
+        return None
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            if is_closed(self._sock):
+                _count("disconnects")
+                # canceling under the lock, as a connection may be lent
+                # to another request as soon as guard() unregistered it
+                with self._lock:
+                    self.disconnected = True
+                    log.info("Client disconnected, canceling %d queries.",
+                             len(self._connections))
+                    for conn in self._connections:
+                        self._cancel(conn)
+                return
+
+    def _cancel(self, conn):
+        try:
+            conn.cancel()
+            _count("cancelled_queries")
+        except psycopg2.Error as err:
+            log.warning("Could not cancel query: %s", err)
+
+    def register(self, conn):
+        with self._lock:
+            if self.disconnected:
+                raise ClientDisconnected("The client went away.")
+            self._connections.add(conn)
+
+    def unregister(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def current():
+    """Returns the watcher of the current thread or None."""
+    return getattr(_local, "watcher", None)
+
+
+@contextlib.contextmanager
+def use(watcher: Watcher):
+    """Context manager making `watcher` the one of the current thread.
+
+    Hands the watcher of a request to the threads working for it.
+    """
+    previous = current()
+    _local.watcher = watcher
+    try:
+        yield watcher
+    finally:
+        _local.watcher = previous
+
+
+@contextlib.contextmanager
+def watch(environ: dict):
+    """Context manager watching the client of the request in this thread.
+
+    Queries run with guard() in the `with` block are canceled
+    when the client disconnects.
+    """
+    watcher = Watcher.for_environ(environ)
+    try:
+        with use(watcher):
+            yield watcher
+    finally:
+        if watcher is not None:
+            watcher.stop()
+
+
+@contextlib.contextmanager
+def guard(conn, watcher: Watcher=None):
+    """Context manager letting `watcher` cancel the queries on `conn`.
+
+    Defaults to the watcher of the current thread set by watch(),
+    does nothing without one.
+
+    Raises:
+        ClientDisconnected: if the query was canceled because
+            the client went away.
+    """
+    if watcher is None:
+        watcher = current()
+    if watcher is None:
+        yield conn
+        return
+
+    watcher.register(conn)
+    try:
+        yield conn
+    except psycopg2.extensions.QueryCanceledError as err:
+        if watcher.disconnected:
+            raise ClientDisconnected("The client went away.") from err
+        raise
+    finally:
+        watcher.unregister(conn)
+
+
+def _collect_metrics():
+    counts = counters()
+    yield ("fody_client_disconnects_total", "counter",
+           "Clients which went away while their queries ran.",
+           [({}, counts["disconnects"])])
+    yield ("fody_cancelled_queries_total", "counter",
+           "Queries canceled as their client went away.",
+           [({}, counts["cancelled_queries"])])
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,95 @@
+"""Stream lists of rows fetched in batches as JSON or NDJSON.
+
+The sub-APIs fetch large results batch by batch and hand a generator
+of the encoded chunks to the response:
+
+    batches = ...  # a generator of lists of rows
+    first_batch = next(batches, [])  # errors can still be answered
+    response.content_type = jsonstream.CONTENT_TYPES[format]
+    return jsonstream.ChunkStream(
+        jsonstream.FORMATTERS[format](first_batch, batches))
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import itertools
+
+import hug
+
+
+CONTENT_TYPES = {
+    'json': 'application/json; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+class ChunkStream:
+    """File-like object handing the chunks of a generator to the response.
+
+    falcon reads the response stream block by block until it gets b''
+    and calls close() when done or when the client disconnected,
+    which in turn closes the generator.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = b''
+        self._offset = 0
+
+    def read(self, size: int=-1) -> bytes:
+        while self._offset >= len(self._chunk):
+            try:
+                self._chunk = next(self._chunks)
+            except StopIteration:
+                return b''
+            self._offset = 0
+
+        if size is None or size < 0:
+            end = len(self._chunk)
+        else:
+            end = self._offset + size
+        data = self._chunk[self._offset:end]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        self._chunks.close()
+
+
+def json_array(first_batch, batches):
+    """Yields the rows as one JSON array."""
+    yield b'['
+    separator = b''
+    for rows in itertools.chain([first_batch], batches):
+        if rows:
+            yield separator + b','.join(
+                hug.output_format.json(row) for row in rows)
+            separator = b','
+    yield b']'
+
+
+def ndjson(first_batch, batches):
+    """Yields the rows as newline delimited JSON, one row per line."""
+    for rows in itertools.chain([first_batch], batches):
+        yield b''.join(hug.output_format.json(row) + b'\n' for row in rows)
+
+
+FORMATTERS = {
+    'json': json_array,
+    'ndjson': ndjson,
+}
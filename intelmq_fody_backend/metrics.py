@@ -0,0 +1,332 @@
+"""Metrics of the requests in the text format of Prometheus.
+
+The Middleware measures each request of the aggregated API and keeps
+per endpoint (the route like /api/events/search):
+
+ * histograms of the duration of the request and the parts of it spent
+   executing database statements, fetching rows and serialising the
+   result,
+ * counters of the requests per status, rows, response bytes
+   and errors per type.
+
+Also the time waiting for a pooled connection is kept.
+The sub-APIs report their database time with timer() and add_rows(),
+the serialisation is timed by their output format from timed_output().
+For streamed responses only the time until the stream starts is counted,
+the bytes are counted as they are sent.
+
+render() returns all metrics for a /metrics endpoint. The values are
+per process, with several worker processes each one has its own.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import bisect
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+
+# Upper bounds of the buckets of the histograms in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = []
+_collectors = []
+_local = threading.local()
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A counter per combination of label values."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = collections.Counter()
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] += amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            yield self.name + _format_labels(self.labels, labelvalues), value
+
+
+class Histogram:
+    """A histogram with cumulative buckets per combination of label values."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                # counts per bucket (the last one is +Inf) and the sum
+                counts = self._values[labelvalues] = \
+                    [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labelvalues, (list(counts[0]), counts[1]))
+                            for labelvalues, counts in self._values.items())
+        names = self.labels + ('le', )
+        for labelvalues, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                yield (self.name + '_bucket' + _format_labels(
+                    names, labelvalues + (_format_value(float(bound)), )),
+                       cumulative)
+            labels = _format_labels(self.labels, labelvalues)
+            yield self.name + '_sum' + labels, total
+            yield self.name + '_count' + labels, cumulative
+
+
+REQUEST_DURATION = Histogram(
+    'fody_request_duration_seconds',
+    'Time to answer a request, until a streamed response starts.',
+    ('endpoint', ))
+DB_DURATION = Histogram(
+    'fody_db_duration_seconds',
+    'Time of a request spent executing database statements.',
+    ('endpoint', ))
+FETCH_DURATION = Histogram(
+    'fody_fetch_duration_seconds',
+    'Time of a request spent fetching rows from the database.',
+    ('endpoint', ))
+SERIALIZE_DURATION = Histogram(
+    'fody_serialize_duration_seconds',
+    'Time of a request spent serialising the result.',
+    ('endpoint', ))
+POOL_WAIT = Histogram(
+    'fody_pool_wait_seconds',
+    'Time waiting for a connection of a database connection pool.')
+REQUESTS = Counter(
+    'fody_requests_total', 'Requests answered, by HTTP status.',
+    ('endpoint', 'status'))
+ROWS = Counter(
+    'fody_rows_total', 'Rows fetched from the database.', ('endpoint', ))
+RESPONSE_BYTES = Counter(
+    'fody_response_bytes_total', 'Bytes of the response bodies.',
+    ('endpoint', ))
+ERRORS = Counter(
+    'fody_errors_total',
+    'Requests answered with an error, by exception or HTTP status.',
+    ('endpoint', 'type'))
+
+
+def register_collector(collect):
+    """Adds gauges or counters computed when the metrics are rendered.
+
+    Args:
+        collect: a callable returning (name, type, help, samples) tuples,
+            the samples a list of (dict of labels, value) tuples
+    """
+    _collectors.append(collect)
+
+
+class RequestStats:
+    """The measurements of one request, possibly from several threads."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.durations = collections.Counter()
+        self.rows = 0
+        self.error = None
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, seconds: float):
+        with self._lock:
+            self.durations[kind] += seconds
+
+    def add_rows(self, rows: int):
+        with self._lock:
+            self.rows += rows
+
+
+def current():
+    """Returns the RequestStats of the current thread or None."""
+    return getattr(_local, "stats", None)
+
+
+@contextlib.contextmanager
+def use(stats: RequestStats):
+    """Context manager making `stats` the one of the current thread.
+
+    Hands the measurements of a request to the threads working for it.
+    """
+    previous = current()
+    _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+
+
+@contextlib.contextmanager
+def timer(kind: str):
+    """Context manager adding the time of the block to the request.
+
+    Args:
+        kind: 'db', 'fetch' or 'serialize'
+    """
+    stats = current()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.add(kind, time.monotonic() - start)
+
+
+def add_rows(rows: int):
+    """Adds the number of rows fetched to the current request."""
+    stats = current()
+    if stats is not None:
+        stats.add_rows(rows)
+
+
+def error(exception):
+    """Records the type of the error the current request is failing with."""
+    stats = current()
+    if stats is not None:
+        stats.error = type(exception).__name__
+
+
+def observe_pool_wait(seconds: float):
+    POOL_WAIT.observe(seconds)
+
+
+def timed_output(formatter):
+    """Wraps a hug output format to time the serialisation."""
+    @functools.wraps(formatter)
+    def timed_formatter(content, request=None, response=None, **kwargs):
+        with timer('serialize'):
+            return formatter(content, request=request, response=response,
+                             **kwargs)
+    return timed_formatter
+
+
+class _CountingStream:
+    """Counts the bytes of a streamed response as they are read."""
+
+    def __init__(self, stream, endpoint: str):
+        self._stream = stream
+        self._endpoint = endpoint
+
+    def read(self, size: int=-1) -> bytes:
+        data = self._stream.read(size)
+        if data:
+            RESPONSE_BYTES.inc(self._endpoint, amount=len(data))
+        return data
+
+    def close(self):
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+
+
+class Middleware:
+    """Falcon middleware measuring the requests."""
+
+    def process_request(self, req, resp):
+        _local.stats = RequestStats()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        stats = current()
+        _local.stats = None
+        if stats is None:
+            return
+        endpoint = getattr(req, 'uri_template', None) or 'other'
+
+        REQUEST_DURATION.observe(time.monotonic() - stats.start, endpoint)
+        DB_DURATION.observe(stats.durations['db'], endpoint)
+        FETCH_DURATION.observe(stats.durations['fetch'], endpoint)
+        SERIALIZE_DURATION.observe(stats.durations['serialize'], endpoint)
+        if stats.rows:
+            ROWS.inc(endpoint, amount=stats.rows)
+
+        status = str(resp.status).split(' ', 1)[0]
+        REQUESTS.inc(endpoint, status)
+        if not req_succeeded:
+            ERRORS.inc(endpoint, stats.error or 'unhandled')
+        elif not status.startswith(('1', '2', '3')):
+            ERRORS.inc(endpoint, stats.error or 'http_' + status)
+
+        if resp.stream is not None:
+            resp.stream = _CountingStream(resp.stream, endpoint)
+        elif resp.data is not None:
+            RESPONSE_BYTES.inc(endpoint, amount=len(resp.data))
+        elif resp.body is not None:
+            RESPONSE_BYTES.inc(endpoint,
+                               amount=len(resp.body.encode('utf-8')))
+
+
+def render() -> str:
+    """Returns all metrics in the text format of Prometheus."""
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for name, value in metric.samples():
+            lines.append('{} {}'.format(name, _format_value(value)))
+    for collect in _collectors:
+        for name, type_, help_, samples in collect():
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} {}'.format(name, type_))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(tuple(labels), tuple(labels.values())),
+                    _format_value(value)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,101 @@
+"""Keyset pagination of the search results of the sub-APIs.
+
+A page ends with the row with the lowest sort key, the next page
+starts after it. The client gets this key as an opaque cursor token
+and sends it back for the next page:
+
+    q.append((KEYSET, pages.decode_cursor(cursor, COLUMNS)))
+    prep = pages.prepare_page(query_prepare_search(q), ORDER, limit)
+    ...
+    next_cursor = pages.encode_cursor(rows[limit - 1], COLUMNS)
+
+The first column of the key is a timestamp, the others are ids.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import base64
+import datetime
+import json
+
+import dateutil.parser
+
+
+def prepare_page(prepared_query, order: str, limit: int):
+    """ Adds ordering and limit for one page of a keyset pagination
+
+    One more row than `limit` is requested to find out if there
+    is a next page.
+
+    Args:
+        prepared_query: A QueryString, Paramater pair created
+                        with query_prepare
+        order: the ORDER BY clause of the sort key, descending
+        limit: the maximal number of rows for the page
+
+    Returns: A Tuple consisting of a query string and an array of parameters.
+
+    """
+    q_string = prepared_query[0] + order + " LIMIT %s"
+    params = list(prepared_query[1]) + [limit + 1]
+    return q_string, params
+
+
+def encode_cursor(row, columns) -> str:
+    """Returns an opaque token for the page after the given row.
+
+    Args:
+        row: a dict with the values of the columns
+        columns: the names of the columns of the sort key
+    """
+    values = [row[column] for column in columns]
+    values = [v.isoformat() if isinstance(v, datetime.datetime) else v
+              for v in values]
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token: str, columns) -> tuple:
+    """Returns the keyset values of a token from encode_cursor().
+
+    Args:
+        token: the cursor sent by the client
+        columns: the names of the columns of the sort key
+
+    Raises:
+        ValueError: if the token is not valid.
+    """
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, ValueError) as err:
+        raise ValueError("Invalid cursor: {}".format(err))
+
+    if not (isinstance(values, list) and len(values) == len(columns)):
+        raise ValueError("Invalid cursor.")
+
+    # the time as string and the ids, as made by encode_cursor()
+    time, ids = values[0], values[1:]
+    if not isinstance(time, str) or not all(
+            type(i) is int and -2**63 <= i < 2**63 for i in ids):
+        raise ValueError("Invalid cursor.")
+    try:
+        dateutil.parser.parse(time)
+    except (OverflowError, ValueError) as err:
+        raise ValueError("Invalid cursor: {}".format(err))
+    return tuple(values)
@@ -0,0 +1,240 @@
+"""Compile the SQL of the search queries from the subqueries once.
+
+The sub-APIs build their queries from a list of (condition, value)
+tuples, the conditions taken from their registry of subqueries,
+see subqueries.py.
+A QueryCompiler puts together the statement for each endpoint and set of
+conditions only once and keeps it as a template, so a request only
+has to collect the values in the order of the template.
+
+Optionally the templates are PREPAREd on each connection of the pool
+when they are used for the first time and then run with EXECUTE,
+which saves PostgreSQL parsing and planning repeated queries.
+Templates with LIKE or ILIKE conditions are not PREPAREd, as
+a generic plan cannot use an index for a pattern given as parameter.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import hashlib
+import logging
+import re
+import threading
+import weakref
+
+import psycopg2
+from psycopg2 import errorcodes
+
+from intelmq_fody_backend import metrics
+
+
+log = logging.getLogger(__name__)
+
+# Number of templates kept per compiler, the least recently used
+# is dropped first. Also the number of statements PREPAREd on a
+# connection before they are deallocated.
+MAX_TEMPLATES = 512
+
+# Names of the statements PREPAREd per connection, for all compilers
+# as the sub-APIs may share connections.
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+_compilers = weakref.WeakSet()
+
+# Tests if a statement is PREPAREd on the connection.
+PREPARED_QUERY = "SELECT 1 FROM pg_prepared_statements WHERE name = %s"
+
+# Conditions matching a pattern, which are planned for each query.
+PATTERN_CONDITION = re.compile(r'\bI?LIKE\b')
+
+Template = collections.namedtuple('Template', ['sql', 'repeats', 'name'])
+Template.__doc__ = """A compiled statement.
+
+    sql: the statement with a %s placeholder per parameter
+    repeats: the number of placeholders for each condition
+    name: the name of the statement when PREPAREd,
+        None if it is not PREPAREd
+"""
+
+
+class Query(tuple):
+    """A (statement, parameters) tuple with the name of its template.
+
+    Can be used like the tuples built by hand, operations on it
+    give plain tuples which are not PREPAREd.
+    """
+
+    def __new__(cls, sql: str, params: list, name: str=None):
+        query = super().__new__(cls, (sql, params))
+        query.name = name
+        return query
+
+
+def statement_name(sql: str) -> str:
+    """Returns the name of the PREPAREd statement for `sql`.
+
+    Equal statements get the same name in all processes.
+    """
+    return "fody_" + hashlib.sha1(sql.encode('utf-8')).hexdigest()[:24]
+
+
+def numbered(sql: str) -> str:
+    """Replaces the %s placeholders of psycopg2 by $1, $2, ..."""
+    parts = sql.split('%s')
+    return "".join(part + ("${}".format(i) if i < len(parts) else "")
+                   for i, part in enumerate(parts, 1)).replace('%%', '%')
+
+
+class QueryCompiler:
+    """Keeps the templates of the statements of an API."""
+
+    def __init__(self, prepared_statements: bool=False,
+                 max_templates: int=MAX_TEMPLATES, name: str=''):
+        """
+        Args:
+            prepared_statements: run the templates as PREPAREd statements
+            max_templates: the number of templates kept
+            name: of the API, used in the metrics
+        """
+        self.name = name
+        self.prepared_statements = prepared_statements
+        self.max_templates = max_templates
+        self._templates = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        _compilers.add(self)
+
+    def compile(self, endpoint, conditions, build) -> Template:
+        """Returns the template for the endpoint and the conditions.
+
+        Args:
+            endpoint: hashable key of the statement without its conditions,
+                it must include everything changing the result of `build`
+            conditions: the sorted SQL of the conditions
+            build: a callable returning the statement for the
+                WHERE clause given to it (an empty string without conditions)
+
+        """
+        key = (endpoint, tuple(conditions))
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        sql = build(where)
+        if any(PATTERN_CONDITION.search(c) for c in conditions):
+            name = None
+        else:
+            name = statement_name(sql)
+        template = Template(sql, tuple(c.count('%s') for c in conditions),
+                            name)
+
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+        return template
+
+    def prepare(self, endpoint, q, build, extra_params=()) -> Query:
+        """Returns the statement and the parameters for the subqueries.
+
+        Args:
+            endpoint: see compile()
+            q: An array of Tuples created with query_build_query,
+                their order does not matter
+            build: see compile()
+            extra_params: the values of the placeholders `build` adds
+                after the WHERE clause
+
+        """
+        q = sorted(q, key=lambda subquerytuple: subquerytuple[0])
+        template = self.compile(endpoint, [sql for sql, _ in q], build)
+        params = []
+        for (_, value), repeat in zip(q, template.repeats):
+            params.extend((value, ) * repeat)
+        params.extend(extra_params)
+        return Query(template.sql, params, template.name)
+
+    def execute(self, cur, prepared_query):
+        """Runs the prepared query on the cursor.
+
+        PREPAREs the statement on the connection first if needed.
+        """
+        sql, params = prepared_query
+        name = getattr(prepared_query, 'name', None)
+        if not self.prepared_statements or name is None:
+            cur.execute(sql, params)
+            return
+
+        with _prepared_lock:
+            names = _prepared.setdefault(cur.connection, set())
+        if name not in names:
+            if len(names) >= self.max_templates:
+                cur.execute("DEALLOCATE ALL")
+                names.clear()
+            # The names may be missing, e.g. after an error, then a failing
+            # PREPARE would abort the transaction of the request.
+            cur.execute(PREPARED_QUERY, (name, ))
+            if cur.fetchone() is None:
+                cur.execute("PREPARE {} AS {}".format(name, numbered(sql)))
+                log.debug("Prepared %s on connection %x.", name,
+                          id(cur.connection))
+            names.add(name)
+
+        try:
+            if params:
+                cur.execute("EXECUTE {} ({})".format(
+                    name, ", ".join(["%s"] * len(params))), params)
+            else:
+                cur.execute("EXECUTE " + name)
+        except psycopg2.Error as err:
+            if err.pgcode == errorcodes.INVALID_SQL_STATEMENT_NAME:
+                names.discard(name)
+            raise
+
+    def info(self) -> dict:
+        """Returns the number of templates and the hit/miss counters."""
+        with self._lock:
+            return {"templates": len(self._templates),
+                    "hits": self.hits, "misses": self.misses,
+                    "prepared_statements": self.prepared_statements}
+
+
+def _collect_metrics():
+    compilers = sorted((c for c in list(_compilers) if c.name),
+                       key=lambda c: c.name)
+    infos = [({"api": c.name}, c.info()) for c in compilers]
+    yield ("fody_query_templates", "gauge",
+           "Compiled statements kept by the query compilers.",
+           [(labels, info["templates"]) for labels, info in infos])
+    yield ("fody_query_template_hits_total", "counter",
+           "Statements taken from the compiled templates.",
+           [(labels, info["hits"]) for labels, info in infos])
+    yield ("fody_query_template_misses_total", "counter",
+           "Statements compiled as there was no template.",
+           [(labels, info["misses"]) for labels, info in infos])
+
+
+metrics.register_collector(_collect_metrics)
@@ -33,7 +33,13 @@ Author(s):
 """
 
 import hug
+import json
 import logging
+import os
+
+from falcon import HTTP_BAD_REQUEST
+
+from intelmq_fody_backend import batch, metrics
 
 # Logging
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s - %(message)s')
@@ -42,6 +48,42 @@ log.setLevel(logging.INFO)  # using INFO as default, otherwise it's WARNING
 
 ENDPOINTS = {}
 
+EXAMPLE_CONF_FILE = r"""
+{
+  "batch": {"max_items": 20, "workers": 4}
+}
+"""
+
+# Settings of /api/batch, see batch.py. Set in setup().
+BATCH_SETTINGS = dict(batch.DEFAULT_SETTINGS)
+
+
+def read_configuration() -> dict:
+    """Read configuration file.
+
+    If the environment variable FODY_BACKEND_SERVE_CONF_FILE exist,
+    use it for the file name. Otherwise uses a default.
+
+    Returns:
+        The configuration values, possibly containing more dicts.
+    """
+    config = None
+    config_file_name = os.environ.get(
+                        "FODY_BACKEND_SERVE_CONF_FILE",
+                        "/etc/intelmq/fody-backend-serve.conf")
+
+    if os.path.isfile(config_file_name):
+        with open(config_file_name) as config_handle:
+                config = json.load(config_handle)
+
+    return config if isinstance(config, dict) else {}
+
+
+# Measure all requests, see metrics.py.
+hug.API(__name__).http.add_middleware(metrics.Middleware())
+hug.API(__name__).http.output_format = metrics.timed_output(
+    hug.output_format.json)
+
 # if possible add the contactdb_api to our endpoints
 try:
     import contactdb_api.contactdb_api.serve
@@ -94,9 +136,73 @@ try:
 except ImportError as err:
     log.warning(err)
 
+# The endpoints which may be used in a batch, by api name.
+# Only endpoints reading and answering with JSON.
+BATCH_ENDPOINTS = {
+    'ContactDB': {'ping', 'searchasn', 'searchorg', 'searchcontact',
+                  'searchdisabledcontact', 'searchcidr', 'searchfqdn',
+                  'searchnational', 'annotation/search'},
+    'Events': {'', 'raw', 'subqueries', 'search', 'count', 'stats'},
+    'Tickets': {'', 'subqueries', 'search', 'stats', 'getRecipient'},
+    'Checkticket': {'getEventIDsForTicket', 'getEvents',
+                    'getEventsForTicket', 'getLastTicketNumber'},
+}
+
+
+def batch_path(api: str, endpoint: str) -> str:
+    """Returns the path of an endpoint allowed in a batch.
+
+    Raises:
+        ValueError: if the endpoint is unknown or not allowed.
+    """
+    if api not in ENDPOINTS or endpoint not in BATCH_ENDPOINTS.get(api, ()):
+        raise ValueError("The endpoint {!r} of the api {!r} cannot be used"
+                         " in a batch.".format(endpoint, api))
+    if endpoint:
+        return ENDPOINTS[api] + '/' + endpoint
+    return ENDPOINTS[api]
+
+
 @hug.startup()
 def setup(api):
-    pass
+    global BATCH_SETTINGS
+    config = read_configuration()
+    BATCH_SETTINGS = dict(batch.DEFAULT_SETTINGS)
+    BATCH_SETTINGS.update(config.get("batch", {}))
+
+
+@hug.post('/api/batch')
+def run_batch(request, response, body=None):
+    """Run several requests and return all results at once.
+
+    The body is a JSON list of objects with the `api` (e.g. "Events"),
+    the `endpoint` (e.g. "stats", "" for the base endpoint) and the
+    query `params`. The items run concurrently.
+
+    Returns: A dict with a list of `results` in the order of the items,
+             each with the HTTP `status`, the `duration_ms` and
+             the `result` or the `error`.
+    """
+    if not isinstance(body, list) or not body:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": "The body must be a non-empty JSON list."}
+    if len(body) > BATCH_SETTINGS["max_items"]:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": "A batch may contain at most {} items."
+                         "".format(BATCH_SETTINGS["max_items"])}
+
+    # the falcon application serving this request
+    app = hug.API(__name__).http.falcon
+    return {"results": batch.run(app, body, batch_path, request.env,
+                                 BATCH_SETTINGS["workers"])}
+
+
+@hug.get('/metrics', output=hug.output_format.text)
+def get_metrics(response):
+    """Return the metrics of this process in the Prometheus text format."""
+    response.content_type = metrics.CONTENT_TYPE
+    return metrics.render()
+
 
 # TODO for now show the full api documentation that hug generates
 #@hug.get("/")
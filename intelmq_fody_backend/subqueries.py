@@ -0,0 +1,423 @@
+"""Subqueries shared by the events_api and the tickets_api.
+
+Each sub-API keeps a registry of its subqueries, a dict mapping the
+name of a query parameter to the SQL condition and its description
+for the clients. The registries of the events_api and the tickets_api
+start with a copy of EVENT_SUBQUERIES on the columns of the events.
+
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Substring searches matching the value literally and case sensitive.
+# Their SQL can use an index, a btree index with text_pattern_ops for
+# `_prefix` and a trigram index for `_suffix` and `_contains`, which
+# serves `_icontains`, too, see events_api/indexes.py.
+QUERY_PATTERNS = {
+    # suffix: ['pattern of the LIKE operand', 'label']
+    'prefix': ('{}%', 'starts with'),
+    'suffix': ('%{}', 'ends with'),
+    'contains': ('%{}%', 'contains, case sensitive'),
+}
+
+
+def pattern_subqueries(columns) -> dict:
+    """Returns the subqueries of QUERY_PATTERNS for the columns.
+
+    Args:
+        columns: (queryname prefix, column expression, label) tuples
+
+    """
+    subqueries = {}
+    for name, column, label in columns:
+        for mode, (pattern, mode_label) in QUERY_PATTERNS.items():
+            subqueries[name + '_' + mode] = {
+                'sql': column + ' LIKE %s',
+                'description': 'Wildcards in the value are matched'
+                               ' literally.',
+                'label': label + ' ' + mode_label,
+                'exp_type': 'string',
+                'pattern': pattern
+            }
+    return subqueries
+
+
+def escape_like(value: str) -> str:
+    """Escapes the wildcards of LIKE in `value`."""
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+
+
+# The subqueries on the columns of the events table.
+EVENT_SUBQUERIES = {
+    # queryname: ['sqlstatement', 'description', 'label', 'Expected-Type']
+    'id': {
+        'sql': 'id = %s',
+        'description': 'Query for an Event matching this ID.',
+        'label': 'EventID',
+        'exp_type': 'integer'
+    },
+    # Time
+    'time-observation_before': {
+        'sql': '"time.observation" < %s',
+        'description': '',
+        'label': 'Observation Time before',
+        'exp_type': 'datetime'
+    },
+    'time-observation_before_encl': {
+        'sql': '"time.observation" <= %s',
+        'description': '',
+        'label': 'Observation Time before, including',
+        'exp_type': 'datetime'
+    },
+    'time-observation_after': {
+        'sql': '"time.observation" > %s',
+        'description': '',
+        'label': 'Observation Time after',
+        'exp_type': 'datetime'
+    },
+    'time-observation_after_encl': {
+        'sql': '"time.observation" > %s',
+        'description': '',
+        'label': 'Observation Time after, including',
+        'exp_type': 'datetime'
+    },
+    'time-source_before': {
+        'sql': '"time.source" < %s',
+        'description': '',
+        'label': 'Source Time before',
+        'exp_type': 'datetime'
+    },
+    'time-source_before_encl': {
+        'sql': '"time.source" <= %s',
+        'description': '',
+        'label': 'Source Time before, including',
+        'exp_type': 'datetime'
+    },
+    'time-source_after': {
+        'sql': '"time.source" > %s',
+        'description': '',
+        'label': 'Source Time after',
+        'exp_type': 'datetime'
+    },
+    'time-source_after_encl': {
+        'sql': '"time.source" > %s',
+        'description': '',
+        'label': 'Source Time after, including',
+        'exp_type': 'datetime'
+    },
+    # Source
+    'source-ip_in_sn': {
+        'sql': '"source.ip" <<= %s',
+        'description': '',
+        'label': 'Source IP-Network',
+        'exp_type': 'cidr'
+    },
+    'source-ip_is': {
+        'sql': '"source.ip" = %s',
+        'description': '',
+        'label': 'Source IP-Address',
+        'exp_type': 'ip'
+    },
+    'source-ip_in': {
+        'sql': '"source.ip" = ANY(%s::text[]::inet[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Source IP-Address, one of',
+        'exp_type': 'ip',
+        'multiple': True
+    },
+    'source-asn_is': {
+        'sql': '"source.asn" = %s',
+        'description': '',
+        'label': 'Source ASN',
+        'exp_type': 'integer'
+    },
+    'source-asn_in': {
+        'sql': '"source.asn" = ANY(%s::text[]::integer[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Source ASN, one of',
+        'exp_type': 'integer',
+        'multiple': True
+    },
+    'source-fqdn_is': {
+        'sql': '"source.fqdn" = %s',
+        'description': '',
+        'label': 'Source FQDN',
+        'exp_type': 'string'
+    },
+    'source-fqdn_in': {
+        'sql': '"source.fqdn" = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Source FQDN, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
+    'source-fqdn_icontains': {
+        'sql': '"source.fqdn" ILIKE %s',
+        'description': '',
+        'label': 'Source FQDN contains',
+        'exp_type': 'string'
+    },
+
+    # Destinations
+    'destination-ip_in_sn': {
+        'sql': '"destination.ip" <<= %s',
+        'description': '',
+        'label': 'Destination IP-Network',
+        'exp_type': 'cidr'
+    },
+    'destination-ip_is': {
+        'sql': '"destination.ip" = %s',
+        'description': '',
+        'label': 'Destination IP-Address',
+        'exp_type': 'ip'
+    },
+    'destination-ip_in': {
+        'sql': '"destination.ip" = ANY(%s::text[]::inet[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Destination IP-Address, one of',
+        'exp_type': 'ip',
+        'multiple': True
+    },
+    'destination-asn_is': {
+        'sql': '"destination.asn" = %s',
+        'description': '',
+        'label': 'Destination ASN',
+        'exp_type': 'integer'
+    },
+    'destination-asn_in': {
+        'sql': '"destination.asn" = ANY(%s::text[]::integer[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Destination ASN, one of',
+        'exp_type': 'integer',
+        'multiple': True
+    },
+    'destination-fqdn_is': {
+        'sql': '"destination.fqdn" = %s',
+        'description': '',
+        'label': 'Destination FQDN',
+        'exp_type': 'string'
+    },
+    'destination-fqdn_in': {
+        'sql': '"destination.fqdn" = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Destination FQDN, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
+    'destination-fqdn_icontains': {
+        'sql': '"destination.fqdn" ILIKE %s',
+        'description': '',
+        'label': 'Destination FQDN contains',
+        'exp_type': 'string'
+    },
+
+    # Classification
+    'classification-taxonomy_is': {
+        'sql': '"classification.taxonomy" = %s',
+        'description': '',
+        'label': 'Classification Taxonomy',
+        'exp_type': 'string'
+    },
+    'classification-taxonomy_in': {
+        'sql': '"classification.taxonomy" = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Classification Taxonomy, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
+    'classification-taxonomy_icontains': {
+        'sql': '"classification.taxonomy" ILIKE %s',
+        'description': '',
+        'label': 'Classification Taxonomy contains',
+        'exp_type': 'string'
+    },
+    'classification-type_is': {
+        'sql': '"classification.type" = %s',
+        'description': '',
+        'label': 'Classification Type',
+        'exp_type': 'string'
+    },
+    'classification-type_in': {
+        'sql': '"classification.type" = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Classification Type, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
+    'classification-type_icontains': {
+        'sql': '"classification.type" ILIKE %s',
+        'description': '',
+        'label': 'Classification Type contains',
+        'exp_type': 'string'
+    },
+    'classification-identifier_is': {
+        'sql': '"classification.identifier" = %s',
+        'description': '',
+        'label': 'Classification Identifier',
+        'exp_type': 'string'
+    },
+    'classification-identifier_in': {
+        'sql': '"classification.identifier" = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Classification Identifier, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
+    'classification-identifier_icontains': {
+        'sql': '"classification.identifier" ILIKE %s',
+        'description': '',
+        'label': 'Classification Identifier contains',
+        'exp_type': 'string'
+    },
+    'malware-name_is': {
+        'sql': '"malware.name" = %s',
+        'description': '',
+        'label': 'Malware Name',
+        'exp_type': 'string'
+    },
+    'malware-name_in': {
+        'sql': '"malware.name" = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Malware Name, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
+    'malware-name_icontains': {
+        'sql': '"malware.name" ILIKE %s',
+        'description': '',
+        'label': 'Malware Name contains',
+        'exp_type': 'string'
+    },
+
+    # Feed
+    'feed-provider_is': {
+        'sql': '"feed.provider" = %s',
+        'description': '',
+        'label': 'Feed Provider',
+        'exp_type': 'string'
+    },
+    'feed-provider_in': {
+        'sql': '"feed.provider" = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Feed Provider, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
+    'feed-provider_icontains': {
+        'sql': '"feed.provider" ILIKE %s',
+        'description': '',
+        'label': 'Feed Provider contains',
+        'exp_type': 'string'
+    },
+    'feed-name_is': {
+        'sql': '"feed.name" = %s',
+        'description': '',
+        'label': 'Feed Name',
+        'exp_type': 'string'
+    },
+    'feed-name_in': {
+        'sql': '"feed.name" = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Feed Name, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
+    'feed-name_icontains': {
+        'sql': '"feed.name" ILIKE %s',
+        'description': '',
+        'label': 'Feed Name contains',
+        'exp_type': 'string'
+    },
+}
+
+# The columns of the events with pattern subqueries:
+# (queryname prefix, column, label)
+EVENT_PATTERN_COLUMNS = (
+    ('source-fqdn', 'source.fqdn', 'Source FQDN'),
+    ('destination-fqdn', 'destination.fqdn', 'Destination FQDN'),
+    ('classification-taxonomy', 'classification.taxonomy',
+     'Classification Taxonomy'),
+    ('classification-type', 'classification.type', 'Classification Type'),
+    ('classification-identifier', 'classification.identifier',
+     'Classification Identifier'),
+    ('malware-name', 'malware.name', 'Malware Name'),
+    ('feed-provider', 'feed.provider', 'Feed Provider'),
+    ('feed-name', 'feed.name', 'Feed Name'),
+)
+
+EVENT_SUBQUERIES.update(pattern_subqueries(
+    (name, '"{}"'.format(column), label)
+    for name, column, label in EVENT_PATTERN_COLUMNS))
+
+
+def get_subquery(registry: dict, q: str) -> str:
+    """ Return the query-Statement from the registry
+
+    Args:
+        registry: the subqueries of a sub-API
+        q: A Key which can be found in the registry
+
+    Returns: The SQL of the subquery.
+
+    Raises:
+        ValueError: if there is no subquery `q`.
+    """
+    s = registry.get(q, {}).get('sql', '')
+    if s:
+        return s
+    else:
+        raise ValueError('The Query-Paramter you asked for is not supported.')
+
+
+def build_subquery(registry: dict, q: str, p) -> tuple:
+    """Resolves the query-operation and the parameters into a tuple.
+
+    Args:
+        registry: the subqueries of a sub-API
+        q: the column which should match the search value
+        p: the search value
+
+    Returns: a tuple containing Query an Search Value
+
+    """
+    if registry.get(q, {}).get('multiple'):
+        # a list of values for an array parameter
+        if isinstance(p, str):
+            p = p.split(',')
+        p = [value.strip() if isinstance(value, str) else value
+             for value in p]
+        # empty items, e.g. of "64496,", cannot be cast to the column type
+        p = [value for value in p if value != '']
+    elif 'pattern' in registry.get(q, {}):
+        # hug splits values with a comma into a list
+        if isinstance(p, list):
+            p = ','.join(p)
+        p = registry[q]['pattern'].format(escape_like(p))
+
+    return (get_subquery(registry, q), p)
+
+
+def build_query(registry: dict, params) -> list:
+    """Returns the (SQL, value) tuples of the subqueries in `params`.
+
+    Args:
+        registry: the subqueries of a sub-API
+        params: a dict mapping names of subqueries to their values
+    """
+    return [build_subquery(registry, key, params[key]) for key in params]
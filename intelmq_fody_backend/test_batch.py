@@ -0,0 +1,101 @@
+"""Tests for running several API requests at once.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import io
+import json
+import threading
+import unittest
+from urllib.parse import parse_qs
+import wsgiref.util
+
+from intelmq_fody_backend import batch
+
+
+def app(environ, start_response):
+    """Echoes the query parameters, fails for /fail."""
+    if environ['PATH_INFO'] == '/fail':
+        status, data = '400 Bad Request', {'reason': 'no good'}
+    else:
+        status, data = '200 OK', parse_qs(environ['QUERY_STRING'])
+    start_response(status, [('Content-Type', 'application/json')])
+    return [json.dumps(data).encode('utf-8')]
+
+
+def resolve(api, endpoint):
+    if api != 'Test':
+        raise ValueError('unknown api')
+    return '/' + endpoint
+
+
+class Tests(unittest.TestCase):
+    def test_run(self):
+        results = batch.run(app, [
+            {'api': 'Test', 'endpoint': 'echo',
+             'params': {'id': 5, 'ip': ['192.0.2.1', '192.0.2.2']}},
+            {'api': 'Other', 'endpoint': 'echo'},
+            {'api': 'Test', 'endpoint': 'fail'},
+            'no item',
+        ], resolve)
+
+        self.assertEqual(results[0]['status'], 200)
+        self.assertEqual(results[0]['result'],
+                         {'id': ['5'], 'ip': ['192.0.2.1', '192.0.2.2']})
+        self.assertIn('duration_ms', results[0])
+        self.assertEqual(results[1], {'status': 400, 'error': 'unknown api',
+                                      'duration_ms': 0})
+        self.assertEqual(results[2]['status'], 400)
+        self.assertEqual(results[2]['error'], 'no good')
+        self.assertEqual(results[3]['status'], 400)
+
+    def test_call_environ(self):
+        environ = {}
+        wsgiref.util.setup_testing_defaults(environ)
+        environ.update({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/api/batch',
+                        'CONTENT_TYPE': 'application/json',
+                        'CONTENT_LENGTH': '2', 'wsgi.input': io.BytesIO(b'[]'),
+                        'HTTP_AUTHORIZATION': 'Basic dGVzdDp0ZXN0',
+                        'gunicorn.socket': object()})
+        seen = {}
+
+        def echo(sub_environ, start_response):
+            seen.update(sub_environ)
+            return app(sub_environ, start_response)
+
+        self.assertEqual(batch.call(echo, '/echo', {'id': 5}, environ),
+                         (200, {'id': ['5']}))
+        self.assertEqual(seen['REQUEST_METHOD'], 'GET')
+        self.assertEqual(seen['PATH_INFO'], '/echo')
+        self.assertNotIn('CONTENT_LENGTH', seen)
+        self.assertEqual(seen['wsgi.input'].read(), b'')
+        for key in ('HTTP_AUTHORIZATION', 'gunicorn.socket', 'SERVER_NAME'):
+            self.assertIs(seen[key], environ[key])
+
+    def test_workers(self):
+        # both items must run at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wait(environ, start_response):
+            barrier.wait()
+            return app(environ, start_response)
+
+        items = [{'api': 'Test', 'endpoint': 'echo', 'params': {'id': i}}
+                 for i in range(2)]
+        results = batch.run(wait, items, resolve, workers=2)
+
+        self.assertEqual([result['result'] for result in results],
+                         [{'id': ['0']}, {'id': ['1']}])
@@ -0,0 +1,132 @@
+"""Tests for streaming the output of COPY.
+
+Uses fake connections, so no database is needed.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import contextlib
+import threading
+import unittest
+
+import psycopg2
+
+from intelmq_fody_backend import copystream, dbpool
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def mogrify(self, operation, parameters):
+        return (operation % tuple(repr(p) for p in parameters)).encode()
+
+    def copy_expert(self, sql, file):
+        self.conn.statements.append(sql)
+        if self.conn.wait is not None:
+            self.conn.wait.wait(5)
+        if self.conn.error:
+            raise self.conn.error
+        for chunk in self.conn.chunks:
+            file.write(chunk)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, chunks=(), error=None, wait=None):
+        self.chunks = chunks
+        self.error = error
+        self.wait = wait
+        self.statements = []
+        self.canceled = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def cancel(self):
+        self.canceled = True
+        if self.wait is not None:
+            self.wait.set()
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+        self.returned = threading.Event()
+
+    @contextlib.contextmanager
+    def transaction(self, readonly=False, statement_timeout=None):
+        self.statement_timeout = statement_timeout
+        try:
+            yield self.conn
+        finally:
+            self.returned.set()
+
+
+class Tests(unittest.TestCase):
+    def test_streams_output(self):
+        conn = FakeConnection([b'id,name\n', b'1,a\n', b'2,b\n'])
+        stream = copystream.CopyStream(
+            FakePool(conn), ("SELECT * FROM events WHERE id > %s", [0]),
+            'tsv')
+        stream.prime()
+
+        data = b''
+        chunk = stream.read(5)
+        while chunk:
+            data += chunk
+            chunk = stream.read(5)
+        stream.close()
+
+        self.assertEqual(data, b'id,name\n1,a\n2,b\n')
+        self.assertEqual(conn.statements, [
+            b"COPY (SELECT * FROM events WHERE id > 0) TO STDOUT"
+            b" WITH (FORMAT csv, HEADER, DELIMITER E'\\t')"])
+
+    def test_error_before_output(self):
+        conn = FakeConnection(error=psycopg2.ProgrammingError("no column"))
+        stream = copystream.CopyStream(
+            FakePool(conn), ("SELECT nothing FROM events", []))
+
+        with self.assertRaises(psycopg2.ProgrammingError):
+            stream.prime()
+
+    def test_close_stops_copy(self):
+        conn = FakeConnection([b'x\n'] * (copystream.QUEUE_SIZE * 4))
+        pool = FakePool(conn)
+        stream = copystream.CopyStream(pool, ("SELECT 1", []))
+        stream.prime()
+
+        stream.close()
+
+        self.assertTrue(pool.returned.wait(5))
+        self.assertTrue(conn.canceled)
+
+    def test_timeout_until_first_output(self):
+        conn = FakeConnection([b'x\n'], wait=threading.Event())
+        pool = FakePool(conn)
+        stream = copystream.CopyStream(pool, ("SELECT 1", []),
+                                       statement_timeout=50)
+
+        with self.assertRaises(dbpool.StatementTimeout):
+            stream.prime()
+
+        self.assertTrue(conn.canceled)
+        # the statement itself is not limited, it waits for the client
+        self.assertTrue(pool.returned.wait(5))
+        self.assertIsNone(pool.statement_timeout)
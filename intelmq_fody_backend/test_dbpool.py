@@ -0,0 +1,201 @@
+"""Tests for the pool of database connections.
+
+Uses fake connections, so no database is needed.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import unittest
+
+import psycopg2
+import psycopg2.extensions
+
+from intelmq_fody_backend import dbpool
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, operation, parameters=None):
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+        self.conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        self.conn.statements.append((operation, parameters))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.autocommit = False
+        self.rollbacks = 0
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.readonly = None
+        self.statements = []
+
+    def set_session(self, readonly=None):
+        self.readonly = None if readonly == "default" else readonly
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+
+    def connect(self):
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    def test_reuses_connections(self):
+        pool = dbpool.ConnectionPool(self.connect, minconn=1, maxconn=2)
+
+        with pool.connection() as conn1:
+            pass
+        with pool.connection() as conn2:
+            pass
+
+        self.assertIs(conn1, conn2)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_rolls_back_unfinished_transactions(self):
+        pool = dbpool.ConnectionPool(self.connect, validate=False)
+
+        with pool.connection() as conn:
+            conn.cursor().execute("SELECT 1")
+
+        self.assertEqual(conn.get_transaction_status(),
+                         psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        self.assertEqual(conn.rollbacks, 1)
+
+    def test_replaces_broken_connections(self):
+        pool = dbpool.ConnectionPool(self.connect, minconn=1, maxconn=1)
+        self.connections[0].broken = True
+
+        with pool.connection() as conn:
+            self.assertIsNot(conn, self.connections[0])
+
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(pool.size, 1)
+
+    def test_checkout_timeout(self):
+        pool = dbpool.ConnectionPool(self.connect, minconn=0, maxconn=1,
+                                     checkout_timeout=0.05)
+        conn = pool.getconn()
+
+        with self.assertRaises(dbpool.PoolTimeout):
+            pool.getconn()
+
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+
+    def test_getconn_without_waiting(self):
+        pool = dbpool.ConnectionPool(self.connect, minconn=0, maxconn=1,
+                                     checkout_timeout=5)
+        conn = pool.getconn(wait=False)
+        self.assertIsNotNone(conn)
+
+        self.assertIsNone(pool.getconn(wait=False))
+
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(wait=False), conn)
+
+    def test_waits_for_returned_connection(self):
+        pool = dbpool.ConnectionPool(self.connect, minconn=0, maxconn=1,
+                                     checkout_timeout=5)
+        conn = pool.getconn()
+        threading.Timer(0.05, pool.putconn, (conn,)).start()
+
+        self.assertIs(pool.getconn(), conn)
+
+    def test_thread_connection(self):
+        pool = dbpool.ConnectionPool(self.connect, minconn=0, maxconn=2)
+        thread_conn = dbpool.ThreadConnection(pool)
+
+        self.assertIs(thread_conn.get(), thread_conn.get())
+        self.assertEqual(pool.idle, 0)
+
+        thread_conn.commit()
+        self.assertEqual(pool.idle, 1)
+
+        # without a borrowed connection there is nothing to do
+        thread_conn.rollback()
+        self.assertEqual(pool.idle, 1)
+
+    def test_transaction_is_always_ended(self):
+        pool = dbpool.ConnectionPool(self.connect, validate=False)
+
+        with pool.transaction(readonly=True) as conn:
+            self.assertTrue(conn.readonly)
+            conn.cursor().execute("SELECT 1")
+
+        self.assertEqual(conn.get_transaction_status(),
+                         psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        self.assertIsNone(conn.readonly)
+        self.assertEqual(conn.rollbacks, 0)
+        self.assertEqual(pool.idle, 1)
+
+        with self.assertRaises(psycopg2.ProgrammingError):
+            with pool.transaction(readonly=True) as conn:
+                conn.cursor().execute("SELECT 1")
+                raise psycopg2.ProgrammingError("syntax error")
+
+        self.assertEqual(conn.get_transaction_status(),
+                         psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        self.assertEqual(conn.rollbacks, 1)
+
+    def test_statement_timeout(self):
+        pool = dbpool.ConnectionPool(self.connect, validate=False)
+
+        with self.assertRaises(dbpool.StatementTimeout):
+            with pool.transaction(statement_timeout="30s") as conn:
+                raise psycopg2.extensions.QueryCanceledError(
+                    "canceling statement due to statement timeout")
+
+        self.assertEqual(conn.statements,
+                         [("SET LOCAL statement_timeout = %s", ("30s",))])
+        self.assertEqual(conn.get_transaction_status(),
+                         psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        self.assertEqual(pool.idle, 1)
+
+    def test_time_zone(self):
+        pool = dbpool.ConnectionPool(self.connect, validate=False)
+
+        with pool.transaction(time_zone="UTC") as conn:
+            pass
+
+        self.assertEqual(conn.statements,
+                         [("SET LOCAL TIME ZONE %s", ("UTC",))])
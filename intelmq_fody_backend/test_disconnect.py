@@ -0,0 +1,101 @@
+"""Tests for canceling queries of clients which went away.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import socket
+import threading
+import unittest
+
+import psycopg2.extensions
+
+from intelmq_fody_backend import disconnect
+
+
+class FakeConnection:
+    def __init__(self):
+        self.canceled = threading.Event()
+
+    def cancel(self):
+        self.canceled.set()
+
+
+class PeekRefusingSocket:
+    """Like ssl.SSLSocket, which raises ValueError for flags of recv()."""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def recv(self, bufsize, flags=0):
+        if flags:
+            raise ValueError("non-zero flags not allowed in calls to recv()")
+        return self._sock.recv(bufsize)
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def test_is_closed(self):
+        self.assertFalse(disconnect.is_closed(self.server))
+
+        # pipelined data is no disconnect
+        self.client.sendall(b'GET')
+        self.assertFalse(disconnect.is_closed(self.server))
+        self.server.recv(3)
+
+        self.client.close()
+        self.assertTrue(disconnect.is_closed(self.server))
+
+    def test_is_closed_tls(self):
+        self.client.sendall(b'GET')
+
+        self.assertFalse(disconnect.is_closed(
+            PeekRefusingSocket(self.server)))
+
+    def test_cancels_query_of_disconnected_client(self):
+        conn = FakeConnection()
+        before = disconnect.counters()
+
+        with self.assertRaises(disconnect.ClientDisconnected):
+            with disconnect.watch({"gunicorn.socket": self.server}) as w:
+                w._interval = 0.01
+                with disconnect.guard(conn):
+                    self.client.close()
+                    self.assertTrue(conn.canceled.wait(5))
+                    raise psycopg2.extensions.QueryCanceledError(
+                        "canceling statement due to user request")
+
+        after = disconnect.counters()
+        self.assertEqual(after["cancelled_queries"],
+                         before["cancelled_queries"] + 1)
+
+    def test_without_socket(self):
+        conn = FakeConnection()
+
+        with disconnect.watch({}) as watcher:
+            with disconnect.guard(conn):
+                pass
+
+        self.assertIsNone(watcher)
+        self.assertFalse(conn.canceled.is_set())
@@ -0,0 +1,70 @@
+"""Tests for the metrics of the requests.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import unittest
+
+import falcon
+import falcon.testing
+
+from intelmq_fody_backend import metrics
+
+
+class Resource:
+    def on_get(self, req, resp, name):
+        with metrics.timer('db'):
+            pass
+        metrics.add_rows(3)
+        if name == 'fail':
+            metrics.error(ValueError())
+            resp.status = falcon.HTTP_500
+        resp.data = b'{"ok": true}'
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        app = falcon.API(middleware=[metrics.Middleware()])
+        app.add_route('/test/{name}', Resource())
+        self.client = falcon.testing.TestClient(app)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('kind', ),
+                                      buckets=(0.1, 1))
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+
+        self.assertEqual(list(histogram.samples()), [
+            ('test_seconds_bucket{kind="a",le="0.1"}', 1),
+            ('test_seconds_bucket{kind="a",le="1.0"}', 2),
+            ('test_seconds_bucket{kind="a",le="+Inf"}', 2),
+            ('test_seconds_sum{kind="a"}', 0.55),
+            ('test_seconds_count{kind="a"}', 2)])
+
+    def test_middleware(self):
+        self.client.simulate_get('/test/ok')
+        self.client.simulate_get('/test/fail')
+
+        text = metrics.render()
+        self.assertIn('fody_requests_total{endpoint="/test/{name}",'
+                      'status="200"} 1', text)
+        self.assertIn('fody_errors_total{endpoint="/test/{name}",'
+                      'type="ValueError"} 1', text)
+        self.assertIn('fody_rows_total{endpoint="/test/{name}"} 6', text)
+        self.assertIn('fody_response_bytes_total{endpoint="/test/{name}"}'
+                      ' 24', text)
+        self.assertIn('fody_db_duration_seconds_count'
+                      '{endpoint="/test/{name}"} 2', text)
@@ -0,0 +1,51 @@
+"""Tests for the keyset pagination shared by the sub-APIs.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import datetime
+import unittest
+
+from intelmq_fody_backend import pages
+
+
+# the sort key of the tickets_api
+COLUMNS = ('time.observation', 'id', 'directive_id')
+
+
+class Tests(unittest.TestCase):
+    def test_cursor_roundtrip(self):
+        row = {'time.observation': datetime.datetime(2017, 3, 1, 12, 30),
+               'id': 4711, 'directive_id': 12, 'sent_at': None}
+
+        token = pages.encode_cursor(row, COLUMNS)
+
+        self.assertEqual(pages.decode_cursor(token, COLUMNS),
+                         ('2017-03-01T12:30:00', 4711, 12))
+
+    def test_cursor_other_key(self):
+        token = pages.encode_cursor({'time.observation': '2017-03-01',
+                                     'id': 4711}, COLUMNS[:2])
+
+        with self.assertRaises(ValueError):
+            pages.decode_cursor(token, COLUMNS)
+
+    def test_prepare_page(self):
+        self.assertEqual(
+            pages.prepare_page(('SELECT * FROM events WHERE id > %s', [5]),
+                               ' ORDER BY id DESC', 20),
+            ('SELECT * FROM events WHERE id > %s ORDER BY id DESC LIMIT %s',
+             [5, 21]))
@@ -0,0 +1,145 @@
+"""Tests for the templates of the query compiler.
+
+Uses fake connections, so no database is needed.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import unittest
+
+from intelmq_fody_backend import querycompiler
+
+
+class FakeConnection:
+    def __init__(self, prepared=()):
+        # the statements PREPAREd on the server
+        self.prepared = set(prepared)
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+
+    def execute(self, operation, parameters=None):
+        self.statements.append((operation, parameters))
+
+    def fetchone(self):
+        operation, parameters = self.statements[-1]
+        if operation == querycompiler.PREPARED_QUERY \
+                and parameters[0] in self.connection.prepared:
+            return (1, )
+        return None
+
+
+def build(where):
+    return "SELECT * FROM events" + where + " LIMIT %s"
+
+
+class Tests(unittest.TestCase):
+    def test_prepare(self):
+        compiler = querycompiler.QueryCompiler()
+        q = [('"source.asn" = %s', 123),
+             ('("source.ip" = %s OR "destination.ip" = %s)', '192.0.2.1')]
+
+        prepared = compiler.prepare('search', q, build, [10])
+
+        self.assertEqual(prepared, (
+            'SELECT * FROM events'
+            ' WHERE "source.asn" = %s'
+            ' AND ("source.ip" = %s OR "destination.ip" = %s) LIMIT %s',
+            [123, '192.0.2.1', '192.0.2.1', 10]))
+
+        # the same conditions in another order and with other values
+        again = compiler.prepare('search', list(reversed(q)), build, [10])
+        self.assertEqual(again[0], prepared[0])
+        self.assertEqual(again.name, prepared.name)
+        self.assertEqual(compiler.info()['hits'], 1)
+
+        compiler.prepare('search', [], build, [10])
+        self.assertEqual(compiler.info()['templates'], 2)
+
+    def test_execute_prepared(self):
+        compiler = querycompiler.QueryCompiler(prepared_statements=True)
+        prepared = compiler.prepare('search', [('id = %s', 5)], build, [10])
+        cur = FakeCursor(FakeConnection())
+
+        compiler.execute(cur, prepared)
+        compiler.execute(cur, compiler.prepare('search', [('id = %s', 6)],
+                                               build, [10]))
+
+        self.assertEqual(cur.statements, [
+            (querycompiler.PREPARED_QUERY, (prepared.name, )),
+            ("PREPARE {} AS SELECT * FROM events WHERE id = $1 LIMIT $2"
+             "".format(prepared.name), None),
+            ("EXECUTE {} (%s, %s)".format(prepared.name), [5, 10]),
+            ("EXECUTE {} (%s, %s)".format(prepared.name), [6, 10])])
+
+    def test_execute_already_prepared(self):
+        compiler = querycompiler.QueryCompiler(prepared_statements=True)
+        prepared = compiler.prepare('search', [('id = %s', 5)], build, [10])
+        # e.g. PREPAREd by a compiler whose names were lost
+        cur = FakeCursor(FakeConnection([prepared.name]))
+
+        compiler.execute(cur, prepared)
+
+        self.assertEqual(cur.statements, [
+            (querycompiler.PREPARED_QUERY, (prepared.name, )),
+            ("EXECUTE {} (%s, %s)".format(prepared.name), [5, 10])])
+
+    def test_execute_plain(self):
+        compiler = querycompiler.QueryCompiler(prepared_statements=True)
+        cur = FakeCursor(FakeConnection())
+
+        compiler.execute(cur, ("SELECT 1", []))
+
+        self.assertEqual(cur.statements, [("SELECT 1", [])])
+
+    def test_execute_array_parameter(self):
+        compiler = querycompiler.QueryCompiler(prepared_statements=True)
+        prepared = compiler.prepare(
+            'search', [('"source.ip" = ANY(%s::text[]::inet[])',
+                        ['192.0.2.1', '192.0.2.2'])], build, [10])
+        cur = FakeCursor(FakeConnection())
+
+        compiler.execute(cur, prepared)
+
+        # $1 is typed text[] like the list sent by psycopg2,
+        # the elements are cast to inet by the statement
+        self.assertEqual(cur.statements, [
+            (querycompiler.PREPARED_QUERY, (prepared.name, )),
+            ('PREPARE {} AS SELECT * FROM events'
+             ' WHERE "source.ip" = ANY($1::text[]::inet[]) LIMIT $2'
+             ''.format(prepared.name), None),
+            ("EXECUTE {} (%s, %s)".format(prepared.name),
+             [['192.0.2.1', '192.0.2.2'], 10])])
+
+    def test_execute_pattern(self):
+        compiler = querycompiler.QueryCompiler(prepared_statements=True)
+        cur = FakeCursor(FakeConnection())
+
+        for condition in ['"feed.name" LIKE %s', '"feed.name" ILIKE %s']:
+            prepared = compiler.prepare('search', [(condition, 'Spam%')],
+                                        build, [10])
+            self.assertIsNone(prepared.name)
+            compiler.execute(cur, prepared)
+
+        # planned with the pattern, which may use an index
+        self.assertEqual(cur.statements, [
+            ('SELECT * FROM events WHERE "feed.name" LIKE %s LIMIT %s',
+             ['Spam%', 10]),
+            ('SELECT * FROM events WHERE "feed.name" ILIKE %s LIMIT %s',
+             ['Spam%', 10])])
@@ -0,0 +1,35 @@
+"""Tests for the subqueries shared by the events and tickets APIs.
+
+Copyright (C) 2018 by Bundesamt für Sicherheit in der Informationstechnik
+Software engineering by Intevation GmbH
+
+This program is Free Software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import unittest
+
+from intelmq_fody_backend import subqueries
+
+
+class Tests(unittest.TestCase):
+    def test_pattern_with_comma(self):
+        # hug passes `feed-name_contains=a,b` as ['a', 'b']
+        self.assertEqual(
+            subqueries.build_subquery(subqueries.EVENT_SUBQUERIES,
+                                      'feed-name_contains', ['a', 'b_c']),
+            ('"feed.name" LIKE %s', '%a,b\\_c%'))
+
+    def test_unknown_subquery(self):
+        with self.assertRaises(ValueError):
+            subqueries.build_query(subqueries.EVENT_SUBQUERIES,
+                                   {'no-such_is': 1})
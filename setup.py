@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='intelmq-fody-backend',
@@ -9,5 +9,6 @@ setup(
     license='AGPLv3',
     author='Dustin Demuth',
     author_email='dustin@intevation.de',
-    description=''
+    description='',
+    install_requires=['hug', 'psycopg2', 'python-dateutil'],
 )
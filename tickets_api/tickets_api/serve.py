@@ -40,7 +40,7 @@ import sys
 # except:
 #    pass
 
-from falcon import HTTP_BAD_REQUEST, HTTP_NOT_FOUND, HTTP_SERVICE_UNAVAILABLE, HTTP_INTERNAL_SERVER_ERROR
+from falcon import HTTP_BAD_REQUEST, HTTP_NOT_FOUND, HTTP_SERVICE_UNAVAILABLE, HTTP_INTERNAL_SERVER_ERROR, HTTP_GATEWAY_TIMEOUT
 import hug
 import psycopg2
 import datetime
@@ -49,6 +49,9 @@ import copy
 
 from psycopg2.extras import RealDictCursor
 
+from intelmq_fody_backend import copystream, dbpool, disconnect, \
+    metrics, pages, querycompiler, subqueries
+
 log = logging.getLogger(__name__)
 # adding a custom log level for even more details when diagnosing
 DD = logging.DEBUG-2
@@ -58,6 +61,9 @@ EXAMPLE_CONF_FILE = r"""
 {
   "libpg conninfo":
     "host=localhost dbname=eventdb user=apiuser password='USER\\'s DB PASSWORD'",
+  "connection pool": {"minconn": 1, "maxconn": 8, "checkout_timeout": 30},
+  "statement timeouts": {"default": "60s", "search": "30s"},
+  "prepared statements": false,
   "logging_level": "INFO"
 }
 """
@@ -65,6 +71,18 @@ EXAMPLE_CONF_FILE = r"""
 ENDPOINT_PREFIX = '/api/tickets'
 ENDPOINT_NAME = 'Tickets'
 
+# Times the serialisation of the results, see metrics.py.
+hug.API(__name__).http.output_format = metrics.timed_output(
+    hug.output_format.json)
+
+# Templates of the statements, PREPAREd on the connections
+# if "prepared statements" is configured. Replaced in setup().
+QUERY_COMPILER = querycompiler.QueryCompiler(name=ENDPOINT_NAME)
+
+# Limits for the statements of each endpoint, e.g. "30s",
+# can be set by the configuration file.
+STATEMENT_TIMEOUTS = {}
+
 def read_configuration() -> dict:
     """Read configuration file.
 
@@ -103,231 +121,32 @@ def read_configuration() -> dict:
     return config if isinstance(config, dict) else {}
 
 
-eventdb_conn = None
-# Using a global object for the database connection
-# must be initialised once
+eventdb_pool = None
+# Using a global pool of database connections,
+# must be initialised once. Each query borrows a connection.
 
 
-def open_db_connection(dsn: str):
-    """ Open the Connection to the EventDB
+def open_db_pool(dsn: str, settings: dict=None):
+    """ Open the pool of Connections to the EventDB
 
     Args:
         dsn: a Connection - String
+        settings: the "connection pool" section of the configuration
 
-    Returns: a Database Connection
+    Returns: a ConnectionPool
 
     """
-    global eventdb_conn
-
-    eventdb_conn = psycopg2.connect(dsn=dsn)
-    return eventdb_conn
+    global eventdb_pool
 
+    eventdb_pool = dbpool.pool_for_dsn(dsn, settings)
+    return eventdb_pool
 
-def __rollback_transaction():
-    global eventdb_conn
-    log.log(DD, "Calling rollback()")
-    eventdb_conn.rollback()
 
-QUERY_EVENT_SUBQUERY = {
-    # TODO BEGINNING OF EVENTS-API COPY
-    # queryname: ['sqlstatement', 'description', 'label', 'Expected-Type']
-    'id': {
-        'sql': 'events.id = %s',
-        'description': 'Query for an Event matching this ID.',
-        'label': 'EventID',
-        'exp_type': 'integer'
-    },
-    # Time
-    'time-observation_before': {
-        'sql': '"time.observation" < %s',
-        'description': '',
-        'label': 'Observation Time before',
-        'exp_type': 'datetime'
-    },
-    'time-observation_before_encl': {
-        'sql': '"time.observation" <= %s',
-        'description': '',
-        'label': 'Observation Time before, including',
-        'exp_type': 'datetime'
-    },
-    'time-observation_after': {
-        'sql': '"time.observation" > %s',
-        'description': '',
-        'label': 'Observation Time after',
-        'exp_type': 'datetime'
-    },
-    'time-observation_after_encl': {
-        'sql': '"time.observation" > %s',
-        'description': '',
-        'label': 'Observation Time after, including',
-        'exp_type': 'datetime'
-    },
-    'time-source_before': {
-        'sql': '"time.source" < %s',
-        'description': '',
-        'label': 'Source Time before',
-        'exp_type': 'datetime'
-    },
-    'time-source_before_encl': {
-        'sql': '"time.source" <= %s',
-        'description': '',
-        'label': 'Source Time before, including',
-        'exp_type': 'datetime'
-    },
-    'time-source_after': {
-        'sql': '"time.source" > %s',
-        'description': '',
-        'label': 'Source Time after',
-        'exp_type': 'datetime'
-    },
-    'time-source_after_encl': {
-        'sql': '"time.source" > %s',
-        'description': '',
-        'label': 'Source Time after, including',
-        'exp_type': 'datetime'
-    },
-    # Source
-    'source-ip_in_sn': {
-        'sql': '"source.ip" <<= %s',
-        'description': '',
-        'label': 'Source IP-Network',
-        'exp_type': 'cidr'
-    },
-    'source-ip_is': {
-        'sql': '"source.ip" = %s',
-        'description': '',
-        'label': 'Source IP-Address',
-        'exp_type': 'ip'
-    },
-    'source-asn_is': {
-        'sql': '"source.asn" = %s',
-        'description': '',
-        'label': 'Source ASN',
-        'exp_type': 'integer'
-    },
-    'source-fqdn_is': {
-        'sql': '"source.fqdn" = %s',
-        'description': '',
-        'label': 'Source FQDN',
-        'exp_type': 'string'
-    },
-    'source-fqdn_icontains': {
-        'sql': '"source.fqdn" ILIKE %s',
-        'description': '',
-        'label': 'Source FQDN contains',
-        'exp_type': 'string'
-    },
-
-    # Destinations
-    'destination-ip_in_sn': {
-        'sql': '"destination.ip" <<= %s',
-        'description': '',
-        'label': 'Destination IP-Network',
-        'exp_type': 'cidr'
-    },
-    'destination-ip_is': {
-        'sql': '"destination.ip" = %s',
-        'description': '',
-        'label': 'Destination IP-Address',
-        'exp_type': 'ip'
-    },
-    'destination-asn_is': {
-        'sql': '"destination.asn" = %s',
-        'description': '',
-        'label': 'Destination ASN',
-        'exp_type': 'integer'
-    },
-    'destination-fqdn_is': {
-        'sql': '"destination.fqdn" = %s',
-        'description': '',
-        'label': 'Destination FQDN',
-        'exp_type': 'string'
-    },
-    'destination-fqdn_icontains': {
-        'sql': '"destination.fqdn" ILIKE %s',
-        'description': '',
-        'label': 'Destination FQDN contains',
-        'exp_type': 'string'
-    },
-
-    # Classification
-    'classification-taxonomy_is': {
-        'sql': '"classification.taxonomy" = %s',
-        'description': '',
-        'label': 'Classification Taxonomy',
-        'exp_type': 'string'
-    },
-    'classification-taxonomy_icontains': {
-        'sql': '"classification.taxonomy" ILIKE %s',
-        'description': '',
-        'label': 'Classification Taxonomy contains',
-        'exp_type': 'string'
-    },
-    'classification-type_is': {
-        'sql': '"classification.type" = %s',
-        'description': '',
-        'label': 'Classification Type',
-        'exp_type': 'string'
-    },
-    'classification-type_icontains': {
-        'sql': '"classification.type" ILIKE %s',
-        'description': '',
-        'label': 'Classification Type contains',
-        'exp_type': 'string'
-    },
-    'classification-identifier_is': {
-        'sql': '"classification.identifier" = %s',
-        'description': '',
-        'label': 'Classification Identifier',
-        'exp_type': 'string'
-    },
-    'classification-identifier_icontains': {
-        'sql': '"classification.identifier" ILIKE %s',
-        'description': '',
-        'label': 'Classification Identifier contains',
-        'exp_type': 'string'
-    },
-    'malware-name_is': {
-        'sql': '"malware.name" = %s',
-        'description': '',
-        'label': 'Malware Name',
-        'exp_type': 'string'
-    },
-    'malware-name_icontains': {
-        'sql': '"malware.name" ILIKE %s',
-        'description': '',
-        'label': 'Malware Name contains',
-        'exp_type': 'string'
-    },
-
-    # Feed
-    'feed-provider_is': {
-        'sql': '"feed.provider" = %s',
-        'description': '',
-        'label': 'Feed Provider',
-        'exp_type': 'string'
-    },
-    'feed-provider_icontains': {
-        'sql': '"feed.provider" ILIKE %s',
-        'description': '',
-        'label': 'Feed Provider contains',
-        'exp_type': 'string'
-    },
-    'feed-name_is': {
-        'sql': '"feed.name" = %s',
-        'description': '',
-        'label': 'Feed Name',
-        'exp_type': 'string'
-    },
-    'feed-name_icontains': {
-        'sql': '"feed.name" ILIKE %s',
-        'description': '',
-        'label': 'Feed Name contains',
-        'exp_type': 'string'
-    },
-
-    # TODO END OF EVENTS-API COPY
+QUERY_EVENT_SUBQUERY = copy.deepcopy(subqueries.EVENT_SUBQUERIES)
+# the tables joined by the queries have an id column, too
+QUERY_EVENT_SUBQUERY['id']['sql'] = 'events.id = %s'
 
+QUERY_EVENT_SUBQUERY.update({
     # Ticket-Related-Stuff
     'ticketnumber': {
         'sql': 'sent.intelmq_ticket = %s',
@@ -335,6 +154,13 @@ QUERY_EVENT_SUBQUERY = {
         'label': 'Ticketnumber',
         'exp_type': 'string'
     },
+    'ticketnumber_in': {
+        'sql': 'sent.intelmq_ticket = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Ticketnumber, one of',
+        'exp_type': 'string',
+        'multiple': True
+    },
     'sent-at_before': {
         'sql': 'sent.sent_at < %s',
         'description': '',
@@ -367,65 +193,43 @@ QUERY_EVENT_SUBQUERY = {
         'label': 'Recipients E-Mail address',
         'exp_type': 'email'
     },
+    'recipient-address_in': {
+        'sql': 'directives.recipient_address = ANY(%s::text[])',
+        'description': 'Comma separated list of values, one must match.',
+        'label': 'Recipients E-Mail address, one of',
+        'exp_type': 'email',
+        'multiple': True
+    },
     'recipient-address_icontains': {
         'sql': 'directives.recipient_address ILIKE %s',
         'description': '',
         'label': 'Recipients E-Mail address cointains',
         'exp_type': 'string'
     },
-}
+})
 
-# TODO DUPLICATE OF EVENTS-API
-def query_get_subquery(q: str):
-    """ Return the query-Statement from the QUERY_EVENT_SUBQUERY
+QUERY_EVENT_SUBQUERY.update(subqueries.pattern_subqueries([
+    ('recipient-address', 'directives.recipient_address',
+     'Recipients E-Mail address')]))
 
-    Basically this is a getter for the dict...
 
-    Args:
-        q: A Key which can be found in QUERY_EVENT_SUBQUERY
-
-    Returns: The subquery from QUERY_EVENT_SUBQUERY
+def query_get_subquery(q: str):
+    """ Return the query-Statement from the QUERY_EVENT_SUBQUERY
 
+    Raises:
+        ValueError: if there is no subquery `q`.
     """
-    r = QUERY_EVENT_SUBQUERY.get(q, '')
-    s = None
-    if r:
-        s = r.get('sql', '')
-    if s:
-        return s
-    else:
-        raise ValueError('The Query-Paramter you asked for is not supported.')
+    return subqueries.get_subquery(QUERY_EVENT_SUBQUERY, q)
 
 
-# TODO DUPLICATE OF EVENTS-API
 def query_build_subquery(q: str, p: str):
-    """Resolves the Query-Operaton and the Parameter into a tuple of SQL and the parameter
+    """Resolves the query-operation and the parameters into a tuple."""
+    return subqueries.build_subquery(QUERY_EVENT_SUBQUERY, q, p)
 
-    Args:
-        q: the column which should match the search value
-        p: the search value
-
-    Returns: a tuple containing Query an Search Value
 
-    """
-    t = (query_get_subquery(q), p)
-    return t
-
-
-# TODO DUPLICATE OF EVENTS-API
 def query_build_query(params):
-    """
-
-    Args:
-        params:
-
-    Returns: An Array of tuples
-
-    """
-    queries = []
-    for key in params:
-        queries.append(query_build_subquery(key, params[key]))
-    return queries
+    """Returns the (SQL, value) tuples of the subqueries in `params`."""
+    return subqueries.build_query(QUERY_EVENT_SUBQUERY, params)
 
 
 def query_prepare_export(q):
@@ -439,28 +243,17 @@ def query_prepare_export(q):
     """
     q_string = "SELECT * FROM events" \
                " JOIN directives on directives.events_id = events.id " \
-               " JOIN sent on sent.id = directives.sent_id "
-    params = []
-    # now iterate over q (which had to be created with query_build_query
-    # previously) and should be a list of tuples an concatenate the resulting query.
-    # and a list of query parameters
-    counter = 0
-    for subquerytuple in q:
-        if counter > 0:
-            q_string = q_string + " AND " + subquerytuple[0]
-            params.append(subquerytuple[1])
-        else:
-            q_string = q_string + " WHERE " + subquerytuple[0]
-            params.append(subquerytuple[1])
-        counter += 1
-    return q_string, params
+               " JOIN sent on sent.id = directives.sent_id"
+    return QUERY_COMPILER.prepare('export', q, lambda where: q_string + where)
 
 
-def query_prepare_search(q):
+def query_prepare_search(q, paged: bool=False):
     """ Prepares a Query-string in order to Export Everything from the DB
 
     Args:
         q: An array of Tuples created with query_build_query
+        paged: select the id of the directive, too, which is part of
+               the keyset of the pages
 
     Returns: A Tuple consisting of a query sting and an array of parameters.
 
@@ -477,24 +270,12 @@ def query_prepare_search(q):
                " \"feed.provider\", "\
                " \"feed.name\", " \
                " sent_at, recipient_address, intelmq_ticket " \
+               + (", directives.id AS directive_id " if paged else "") + \
                " FROM events " \
                " JOIN directives on directives.events_id = events.id " \
-               " JOIN sent on sent.id = directives.sent_id "
-
-    params = []
-    # now iterate over q (which had to be created with query_build_query
-    # previously) and should be a list of tuples an concatenate the resulting query.
-    # and a list of query parameters
-    counter = 0
-    for subquerytuple in q:
-        if counter > 0:
-            q_string = q_string + " AND " + subquerytuple[0]
-            params.append(subquerytuple[1])
-        else:
-            q_string = q_string + " WHERE " + subquerytuple[0]
-            params.append(subquerytuple[1])
-        counter += 1
-    return q_string, params
+               " JOIN sent on sent.id = directives.sent_id"
+    return QUERY_COMPILER.prepare(('search', paged), q,
+                                  lambda where: q_string + where)
 
 
 def query_prepare_stats(q, interval = 'day'):
@@ -516,52 +297,82 @@ def query_prepare_stats(q, interval = 'day'):
     q_string = "SELECT %s, count(distinct(intelmq_ticket)) " \
                " FROM events " \
                " JOIN directives on directives.events_id = events.id " \
-               " JOIN sent on sent.id = directives.sent_id " % (trunc, )
+               " JOIN sent on sent.id = directives.sent_id" % (trunc, )
 
     # SELECT date_trunc('day', sent_at), count(intelmq_ticket) FROM sent GROUP BY date_trunc('day', sent_at);
     # Would be much faster, but do not just want to count the tickets, but also
     # might need to filter for certain attributes....
 
-    params = []
-    # now iterate over q (which had to be created with query_build_query
-    # previously) and should be a list of tuples an concatenate the resulting query.
-    # and a list of query parameters
-    counter = 0
-    for subquerytuple in q:
-        if counter > 0:
-            q_string = q_string + " AND " + subquerytuple[0]
-            params.append(subquerytuple[1])
-        else:
-            q_string = q_string + " WHERE " + subquerytuple[0]
-            params.append(subquerytuple[1])
-        counter += 1
-    q_string = q_string + " GROUP BY %s" % (trunc, )
-    return q_string, params
+    return QUERY_COMPILER.prepare(
+        ('stats', interval), q,
+        lambda where: q_string + where + " GROUP BY %s" % (trunc, ))
+
+
+# Keyset pagination of /search over the sort key of the search results.
+# An event can have several directives, so their id is needed to make
+# the key unique.
+QUERY_PAGE_KEYSET = '("time.observation", events.id, directives.id) < %s'
+QUERY_PAGE_ORDER = ' ORDER BY "time.observation" DESC, events.id DESC,' \
+                   ' directives.id DESC'
+QUERY_PAGE_COLUMNS = ('time.observation', 'id', 'directive_id')
+
+
+def query_prepare_page(prepared_query, limit: int):
+    """ Adds ordering and limit for one page, see pages.prepare_page()"""
+    return pages.prepare_page(prepared_query, QUERY_PAGE_ORDER, limit)
+
+
+def encode_page_cursor(row) -> str:
+    """Returns an opaque token for the page after the given row."""
+    return pages.encode_cursor(row, QUERY_PAGE_COLUMNS)
+
+
+def decode_page_cursor(token: str) -> tuple:
+    """Returns the keyset values of a token from encode_page_cursor().
+
+    Raises:
+        ValueError: if the token is not valid.
+    """
+    return pages.decode_cursor(token, QUERY_PAGE_COLUMNS)
+
+
+def endpoint_timeout(endpoint: str):
+    """Returns the statement timeout configured for an endpoint."""
+    return dbpool.endpoint_timeout(STATEMENT_TIMEOUTS, endpoint)
 
 
 # TODO DUPLICATE OF EVENTS-API
-def query(prepared_query):
+def query(prepared_query, statement_timeout=None):
     """ Queries the Database for Events
 
     Args:
         prepared_query: A QueryString, Paramater pair created with query_prepare
+        statement_timeout: see endpoint_timeout()
 
     Returns: The results of the databasequery in JSON-Format.
 
     """
-    global eventdb_conn
-
-    # psycopgy2.4 does not offer 'with' for cursor()
-    # FUTURE use with
-    cur = eventdb_conn.cursor(cursor_factory=RealDictCursor)
-
-    operation = prepared_query[0]
-    parameters = prepared_query[1]
-    log.info(cur.mogrify(operation, parameters))
-    cur.execute(operation, parameters)
-    log.log(DD, "Ran query={}".format(repr(cur.query.decode('utf-8'))))
-    # description = cur.description
-    results = cur.fetchall()
+    global eventdb_pool
+
+    # a short read only transaction, which is always ended,
+    # so the connection is never left idle in transaction
+    with eventdb_pool.transaction(
+            readonly=True, statement_timeout=statement_timeout) as conn:
+        # psycopgy2.4 does not offer 'with' for cursor()
+        # FUTURE use with
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+        operation = prepared_query[0]
+        parameters = prepared_query[1]
+        log.info(cur.mogrify(operation, parameters))
+        # canceled if the client of a watched request goes away
+        with disconnect.guard(conn), metrics.timer('db'):
+            QUERY_COMPILER.execute(cur, prepared_query)
+        log.log(DD, "Ran query={}".format(repr(cur.query.decode('utf-8'))))
+        # description = cur.description
+        with metrics.timer('fetch'):
+            results = cur.fetchall()
+        metrics.add_rows(len(results))
 
     return results
 
@@ -571,8 +382,37 @@ def setup(api):
     config = read_configuration()
     if "logging_level" in config:
         log.setLevel(config["logging_level"])
-    open_db_connection(config["libpg conninfo"])
-    log.debug("Initialised DB connection for events_api.")
+    open_db_pool(config["libpg conninfo"], config.get("connection pool"))
+    log.debug("Initialised DB connection pool for %s.", __name__)
+
+    global STATEMENT_TIMEOUTS
+    STATEMENT_TIMEOUTS = config.get('statement timeouts', {})
+
+    global QUERY_COMPILER
+    QUERY_COMPILER = querycompiler.QueryCompiler(
+        config.get('prepared statements', False), name=ENDPOINT_NAME)
+
+
+@hug.exception(dbpool.PoolTimeout)
+def handle_pool_timeout(exception, response):
+    log.warning(exception)
+    response.status = HTTP_SERVICE_UNAVAILABLE
+    return {"error": "The server is too busy, try again later."}
+
+
+@hug.exception(disconnect.ClientDisconnected)
+def handle_client_disconnected(exception, response):
+    log.info("Canceled query: %s", exception)
+    response.status = disconnect.HTTP_CLIENT_CLOSED_REQUEST
+    return {"error": "The client closed the connection."}
+
+
+@hug.exception(dbpool.StatementTimeout)
+def handle_statement_timeout(exception, response):
+    log.warning(exception)
+    response.status = HTTP_GATEWAY_TIMEOUT
+    return {"error": "The query took too long and was canceled, "
+                     "try to narrow it down."}
 
 
 @hug.get(ENDPOINT_PREFIX, examples="id=1")
@@ -599,7 +439,7 @@ def getTicket(response, id: int = None, ticketnumber: hug.types.length(17, 18) =
 
     prep = query_prepare_export(querylist)
 
-    result = query(prep)
+    result = query(prep, endpoint_timeout('getTicket'))
 
     # Hug cannot serialize datetime.timedelta objects.
     # Therefor we need to do it on our own...
@@ -614,7 +454,6 @@ def getTicket(response, id: int = None, ticketnumber: hug.types.length(17, 18) =
         return result
     except psycopg2.Error as e:
         log.error(e)
-        __rollback_transaction()
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "The query could not be processed."}
 
@@ -635,14 +474,23 @@ def showSubqueries():
 
 
 @hug.get(ENDPOINT_PREFIX + '/search', examples="sent-at_after=2017-03-01&sent-at_before=2017-03-01")
-def search(response, **params):
+def search(request, response, limit: hug.types.greater_than(0) = None,
+           cursor: str = None, **params):
     """Search for events and tickets
 
+    With `limit` the results are returned page by page, newest events first.
+    To get the next page pass the `next_cursor` of the response
+    as `cursor` together with the same queries again.
+
     Args:
         response: A HUG response object...
+        limit: Maximal number of results to return
+        cursor: Token of the page to return, needs `limit`
         **params: Queries from QUERY_EVENT_SUBQUERY
 
     Returns: A subset of the most likely most important fields of the events and their tickets which are matching the query.
+             If `limit` is given a dict with the rows as `results` and the token for the next page as `next_cursor`
+             (None for the last page).
 
     """
     for param in params:
@@ -657,21 +505,94 @@ def search(response, **params):
         response.status = HTTP_BAD_REQUEST
         return {"error": "Queries without parameters are not supported"}
 
+    if cursor is not None and limit is None:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": "A cursor can only be used together with a limit."}
+
     querylist = query_build_query(params)
 
-    prep = query_prepare_search(querylist)
+    if cursor is not None:
+        try:
+            querylist.append((QUERY_PAGE_KEYSET, decode_page_cursor(cursor)))
+        except ValueError:
+            response.status = HTTP_BAD_REQUEST
+            return {"error": "The cursor is not valid."}
+
+    prep = query_prepare_search(querylist, paged=limit is not None)
+
+    if limit is not None:
+        prep = query_prepare_page(prep, limit)
 
     try:
-        return query(prep)
+        with disconnect.watch(request.env):
+            rows = query(prep, endpoint_timeout('search'))
     except psycopg2.Error as e:
         log.error(e)
-        __rollback_transaction()
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "The query could not be processed."}
 
+    if limit is None:
+        return rows
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor(rows[-1])
+    # the id of the directive is only needed for the cursor
+    for row in rows:
+        del row['directive_id']
+    return {'results': rows, 'next_cursor': next_cursor}
+
+
+@hug.get(ENDPOINT_PREFIX + '/export', examples="sent-at_after=2017-03-01&sent-at_before=2017-03-02&format=csv")
+def export(request, response,
+           format: hug.types.one_of(tuple(copystream.COPY_OPTIONS)) = 'csv',
+           **params):
+    """Export the events and tickets matching the query parameters
+
+    PostgreSQL formats the rows with COPY and they are streamed
+    to the client as they arrive.
+
+    Args:
+        format: 'csv' (default) or 'tsv'
+        **params: Queries from QUERY_EVENT_SUBQUERY
+
+    Returns: The same fields as /search for all matching rows.
+
+    """
+    for param in params:
+        # Test if the parameters are sane....
+        try:
+            query_get_subquery(param)
+        except ValueError:
+            response.status = HTTP_BAD_REQUEST
+            return {"error": "At least one of the queryparameters is not allowed: %s" % (param, )}
+
+    if not params:
+        response.status = HTTP_BAD_REQUEST
+        return {"error": "Queries without parameters are not supported"}
+
+    prep = query_prepare_search(query_build_query(params))
+
+    stream = copystream.CopyStream(
+        eventdb_pool, prep, format,
+        statement_timeout=endpoint_timeout('export'),
+        watcher=disconnect.Watcher.for_environ(request.env))
+    try:
+        # wait for the first rows to be able to report errors
+        # before the streaming response has started
+        stream.prime()
+    except psycopg2.Error as e:
+        log.error(e)
+        response.status = HTTP_INTERNAL_SERVER_ERROR
+        return {"error": "The query could not be processed."}
+
+    response.content_type = copystream.CONTENT_TYPES[format]
+    return stream
+
 
 @hug.get(ENDPOINT_PREFIX + '/stats', examples="malware-name_is=nymaim&recipient-address_icontains=%telekom%&timeres=day")
-def stats(response, **params):
+def stats(request, response, **params):
     """ This interface returns a statistic of all tickets matching the query parameters
 
     Args:
@@ -768,20 +689,19 @@ def stats(response, **params):
 
 
     try:
-        results = query(prep)
+        with disconnect.watch(request.env):
+            results = query(prep, endpoint_timeout('stats'))
         totalcount = 0
         for v in results:
             totalcount += v.get('count', 0)
 
     except psycopg2.Error as e:
         log.error(e)
-        __rollback_transaction()
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "The query could not be processed."}
 
     except AttributeError as e:
         log.error(e)
-        __rollback_transaction()
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "Something went wrong."}
 
@@ -799,10 +719,9 @@ def getDirective(response, ticketnumber:hug.types.length(17, 18)):
             " WHERE sent.intelmq_ticket = %s;", (ticketnumber,))
 
     try:
-        result = query(prep)
+        result = query(prep, endpoint_timeout('getDirective'))
     except psycopg2.Error as e:
         log.error(e)
-        __rollback_transaction()
         response.status = HTTP_INTERNAL_SERVER_ERROR
         return {"error": "The query could not be processed."}
 
@@ -836,8 +755,7 @@ def main():
     print("log effective level = \"{}\"".format(
         logging.getLevelName(log.getEffectiveLevel())))
 
-    global eventdb_conn
-    eventdb_conn = open_db_connection(config["libpg conninfo"])
+    open_db_pool(config["libpg conninfo"], config.get("connection pool"))
 
     # TODO: Maybe add a search interface for the CLI
     # params={'t.o_after': '2017-03-01', 's.ip_in_sn': '31.25.41.74'}